@@ -2,18 +2,26 @@
 Convenience script to build the Cython extension module.
 Usage: python cython_build.py build_ext --inplace
 """
+import platform
+import sys
+
 from setuptools import setup, Extension
 from Cython.Build import cythonize
 import numpy
 
+# OpenMP powers the parallel batch kernel; Apple's clang does not support -fopenmp.
+openmp_flags = [] if sys.platform == 'darwin' else ['-fopenmp']
+# The popcount kernel wants the hardware POPCNT instruction on x86-64.
+popcnt_flags = ['-mpopcnt'] if platform.machine() in ('x86_64', 'AMD64') and sys.platform != 'win32' else []
+
 # Define the extension module
 extensions = [
     Extension(
         "shop.recommender.cy_similarity",
         ["shop/recommender/cy_similarity.pyx"],
         include_dirs=[numpy.get_include()],
-        extra_compile_args=["-O3"], # Optimization flag
-        extra_link_args=[],
+        extra_compile_args=["-O3"] + openmp_flags + popcnt_flags, # Optimization flag
+        extra_link_args=openmp_flags,
     )
 ]
 
@@ -68,6 +68,28 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # A file rather than the default in-memory database, whose shared cache fails
+        # concurrent writers at once instead of letting them wait (see shop.tests).
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+    }
+}
+
+
+# Cache
+# One cache shared by every worker process: the product-tag index keeps its current
+# version in it, and the cart and recommendations their per-product and per-user
+# entries. (Pending tag and search edits live next to each published index instead,
+# where culling cannot drop them.) The database is a local SQLite file, so one
+# host's file cache is shared widely enough; switch to Redis or Memcached along with
+# the database. MAX_ENTRIES is generous because culling drops entries at random;
+# Django's file cache would list all of them before every write, so
+# SharedFileCache only counts them every CULL_EVERY writes per process.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'shop.cache_backends.SharedFileCache',
+        'LOCATION': BASE_DIR / 'var' / 'cache',
+        'OPTIONS': {'MAX_ENTRIES': 100_000, 'CULL_EVERY': 1000},
     }
 }
 
@@ -120,6 +142,12 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Custom settings
 CART_SESSION_ID = 'cart'
 
+# Products per page of the (cursor-paginated) product list
+PRODUCTS_PAGE_SIZE = 24
+
+# Most common categories / tags listed in the product list's filter sidebar (see shop.facets)
+PRODUCT_FACETS_LIMIT = 20
+
 # URL to redirect to after a successful login.
 LOGIN_REDIRECT_URL = '/'
 
@@ -131,4 +159,71 @@ LOGOUT_REDIRECT_URL = '/'
 
 # Media files (for user-uploaded content like product images)
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
\ No newline at end of file
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Recommender artifacts built offline (e.g. by `manage.py build_similar_products`)
+RECOMMENDER_DATA_DIR = BASE_DIR / 'var' / 'recommender'
+
+# Product-tag row encoding: 'sparse' (CSR), 'bitset' (uint64 words + popcount kernel)
+# or 'minhash' (approximate: MinHash-LSH candidates, re-ranked exactly).
+# 'bitset' adds ceil(tags / 64) words per product on top of the CSR arrays, so
+# it only pays off for small tag vocabularies; run benchmark_similarity first.
+RECOMMENDER_TAG_ENCODING = 'sparse'
+
+# MinHash-LSH layout (build time) and bands looked up per query (None = all).
+# More bands, fewer rows per band or more probed bands raise recall and latency.
+RECOMMENDER_MINHASH_BANDS = 32
+RECOMMENDER_MINHASH_BAND_ROWS = 2
+RECOMMENDER_MINHASH_PROBE_BANDS = 8
+
+# Tag edits since the last product-tag index build are kept in a small overlay that
+# queries consult; once it holds this many products, a background rebuild merges it
+RECOMMENDER_TAG_OVERLAY_LIMIT = 500
+
+# Seconds a user's "Recommended for You" list is cached (interaction changes invalidate it sooner)
+RECOMMENDER_USER_CACHE_TIMEOUT = 60 * 15
+
+# User profile weights: each interaction counts its action's weight, scaled by (1 + rating / 5)
+# and halved every RECOMMENDER_PROFILE_HALF_LIFE_DAYS days
+RECOMMENDER_ACTION_WEIGHTS = {'view': 1.0, 'like': 3.0, 'purchase': 5.0}
+RECOMMENDER_PROFILE_HALF_LIFE_DAYS = 30
+
+# Recommender engine: 'content' (tag similarity), 'collaborative' (item-item co-interaction,
+# built by `manage.py build_similar_products --engine collaborative`), 'trending' (popularity)
+# or 'blend' of the engines in RECOMMENDER_BLEND_WEIGHTS
+RECOMMENDER_ENGINE = 'content'
+RECOMMENDER_BLEND_WEIGHTS = {'content': 0.5, 'collaborative': 0.5}
+
+# Product views are spooled to local files and written in batches by a background thread
+# (see shop.events): flushed every INTERACTION_SPOOL_FLUSH_INTERVAL seconds or BATCH_SIZE events,
+# and record_view blocks once MAX_PENDING events are waiting
+INTERACTION_SPOOL_DIR = BASE_DIR / 'var' / 'interaction_spool'
+INTERACTION_SPOOL_BATCH_SIZE = 500
+INTERACTION_SPOOL_FLUSH_INTERVAL = 2.0
+INTERACTION_SPOOL_MAX_PENDING = 10_000
+
+# Product search: an inverted index published under SEARCH_INDEX_DIR (see shop.search).
+# Product changes are kept in a cached delta until it holds SEARCH_INDEX_DELTA_LIMIT
+# products (or the index is 45 minutes old), which triggers a background rebuild
+SEARCH_INDEX_DIR = BASE_DIR / 'var' / 'search'
+SEARCH_INDEX_DELTA_LIMIT = 1000
+SEARCH_RESULTS_LIMIT = 48
+
+# Interaction rollups (see shop.rollups, run `manage.py rollup_interactions` periodically):
+# rows older than INTERACTION_ROLLUP_LAG seconds are folded into per-day and per-user stats,
+# INTERACTION_ROLLUP_WINDOW_HOURS of them per transaction, and rolled-up VIEW rows older than
+# INTERACTION_VIEW_RETENTION_DAYS are then deleted
+INTERACTION_ROLLUP_LAG = 600
+INTERACTION_ROLLUP_WINDOW_HOURS = 6
+INTERACTION_VIEW_RETENTION_DAYS = 90
+
+# Trending products, the fallback when an engine finds nothing (see shop.recommender.trending):
+# interactions are summed per product into TRENDING_BUCKET_MINUTES buckets as they happen, weighted
+# by RECOMMENDER_ACTION_WEIGHTS and halved every TRENDING_HALF_LIFE_HOURS; buckets older than
+# TRENDING_WINDOW_DAYS are dropped. The top TRENDING_LIMIT IDs are cached and recomputed in the
+# background every TRENDING_REFRESH_INTERVAL seconds
+TRENDING_BUCKET_MINUTES = 60
+TRENDING_HALF_LIFE_HOURS = 24
+TRENDING_WINDOW_DAYS = 7
+TRENDING_LIMIT = 50
+TRENDING_REFRESH_INTERVAL = 60
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Tag, Product, Interaction
+from .models import Tag, Product, Interaction, ProductDailyStats, UserProductStats
 
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
@@ -24,4 +24,17 @@ class InteractionAdmin(admin.ModelAdmin):
     list_display = ('user', 'product', 'action', 'rating', 'created_at')
     list_filter = ('action', 'created_at')
     search_fields = ('user__username', 'product__name')
-    list_select_related = ('user', 'product')
\ No newline at end of file
+    list_select_related = ('user', 'product')
+
+@admin.register(ProductDailyStats)
+class ProductDailyStatsAdmin(admin.ModelAdmin):
+    list_display = ('product', 'day', 'views', 'likes', 'purchases', 'last_seen')
+    list_filter = ('day',)
+    search_fields = ('product__name',)
+    list_select_related = ('product',)
+
+@admin.register(UserProductStats)
+class UserProductStatsAdmin(admin.ModelAdmin):
+    list_display = ('user', 'product', 'views', 'last_viewed', 'max_rating')
+    search_fields = ('user__username', 'product__name')
+    list_select_related = ('user', 'product')
@@ -0,0 +1,29 @@
+import itertools
+
+from django.core.cache.backends.filebased import FileBasedCache
+
+_write_counters = {}  # One write counter per cache directory, shared by this process's threads
+
+
+class SharedFileCache(FileBasedCache):
+    """
+    A ``FileBasedCache`` that checks its size every ``CULL_EVERY`` writes (an
+    ``OPTIONS`` entry, 1000 by default) rather than on every write.
+
+    Django's file cache lists the whole cache directory before each write to
+    decide whether to cull, so with a large MAX_ENTRIES every cache miss pays
+    for a directory scan. Here each process scans once per CULL_EVERY writes,
+    so the cache may overshoot MAX_ENTRIES by up to that many entries per
+    worker between culls.
+    """
+
+    def __init__(self, dir, params):
+        options = dict(params.get('OPTIONS', {}))
+        self._cull_every = max(1, int(options.pop('CULL_EVERY', 1000)))
+        super().__init__(dir, {**params, 'OPTIONS': options})
+        self._writes = _write_counters.setdefault(self._dir, itertools.count())
+
+    def _cull(self):
+        # next() on an itertools.count is atomic, so threads never skip a cull between them.
+        if next(self._writes) % self._cull_every == 0:
+            super()._cull()
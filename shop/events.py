@@ -0,0 +1,262 @@
+import atexit
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Case, DateTimeField, F, Q, Value, When
+from django.db.models.functions import Greatest
+
+from .models import Interaction, Product
+from .recommender import content, trending
+
+logger = logging.getLogger(__name__)
+
+
+class InteractionSpool:
+    """
+    Records product views off the request path.
+
+    ``record_view`` appends one line to this process's spool file and returns;
+    a background thread periodically seals the file and writes its events to
+    the database with one ``bulk_create(update_conflicts=True)``, so a page
+    view never takes the database write lock.
+
+    * Flushes happen every ``flush_interval`` seconds, or as soon as
+      ``batch_size`` events are pending.
+    * Backpressure: once ``max_pending`` events are waiting (e.g. the database
+      is slow or locked), ``record_view`` blocks until the worker catches up,
+      and after ``flush_interval`` flushes inline itself. Events count as
+      waiting until their batch is committed, sealed or not, so a failing
+      database engages it too.
+    * At least once: events are on disk before ``record_view`` returns, and a
+      sealed file is only deleted after its batch is committed. Files left
+      behind by a crashed process are picked up by the next flush in any
+      process; replaying a batch is harmless because the write is an upsert
+      that only ever moves a view's ``created_at`` forward, and only views it
+      inserts or moves forward are added to the trending buckets.
+    """
+
+    # Rows per UPDATE of existing views; each adds a term to the WHERE and the CASE.
+    UPDATE_CHUNK_SIZE = 200
+
+    def __init__(self, directory, batch_size=500, flush_interval=2.0, max_pending=10_000):
+        self.directory = Path(directory)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        self._sequence = 0
+        self._pending = 0  # Events in the active file
+        self._sealed = {}  # Events in each of this process's sealed files, until committed
+        self._worker = None
+
+    def record_view(self, user_id: int, product_id: int):
+        """Queues one VIEW interaction; it reaches the database within about ``flush_interval`` seconds."""
+        with self._lock:
+            self._ensure_worker()
+            if self._waiting() >= self.max_pending:
+                self._wakeup.set()
+                if not self._drained.wait_for(lambda: self._waiting() < self.max_pending, timeout=self.flush_interval):
+                    # The worker is stuck; make progress on this thread instead.
+                    self._lock.release()
+                    try:
+                        self.flush()
+                    finally:
+                        self._lock.acquire()
+            self._spool_file().write(f"{user_id},{product_id},{time.time():.6f}\n")
+            # Handing the line to the OS is enough to survive a crash of this process.
+            self._file.flush()
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._wakeup.set()
+
+    def flush(self):
+        """Seals the current spool file and writes every sealed file (including orphans) to the database."""
+        with self._flush_lock:
+            with self._lock:
+                if self._pending:
+                    self._seal()
+            for path in self._claim_sealed_files():
+                try:
+                    self._write_batch(path)
+                except Exception:
+                    logger.exception("Could not flush interaction spool %s; it will be retried.", path)
+                    break
+                path.unlink()
+                with self._lock:
+                    self._sealed.pop(path.name, None)
+                    self._drained.notify_all()
+
+    def _waiting(self):
+        """Events recorded by this process and not yet committed; caller holds ``_lock``."""
+        return self._pending + sum(self._sealed.values())
+
+    def _ensure_worker(self):
+        if self._pid != os.getpid():
+            # First use in this (possibly forked) process: start a fresh file and worker.
+            self._pid, self._file, self._pending, self._sequence = os.getpid(), None, 0, 0
+            self._sealed = {}
+            self._worker = threading.Thread(target=self._run, name='interaction-spool', daemon=True)
+            self._worker.start()
+            atexit.register(self.flush)
+
+    def _spool_file(self):
+        if self._file is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.directory / f'{self._pid}.spool', 'a')
+        return self._file
+
+    def _seal(self):
+        """Renames the active file to ``<pid>-<seq>.sealed``; caller holds ``_lock``."""
+        self._file.close()
+        self._file = None
+        self._sequence += 1
+        sealed_name = f'{self._pid}-{self._sequence}.sealed'
+        os.replace(self.directory / f'{self._pid}.spool', self.directory / sealed_name)
+        # The events still wait for the database; flush() forgets them once committed.
+        self._sealed[sealed_name] = self._pending
+        self._pending = 0
+
+    def _claim_sealed_files(self):
+        """Returns this process's sealed files, after adopting those of processes that have exited."""
+        if not self.directory.exists():
+            return []
+        # Oldest first, so an orphan's files keep their order once renumbered here.
+        for path in sorted(filter(_spool_order, self.directory.iterdir()), key=_spool_order):
+            owner = _spool_order(path)[0]
+            if owner == os.getpid() or _is_running(owner):
+                continue
+            self._sequence += 1
+            try:
+                # Renaming is atomic, so only one process adopts each orphan.
+                os.replace(path, self.directory / f'{os.getpid()}-{self._sequence}.sealed')
+            except FileNotFoundError:
+                pass
+        return sorted(filter(_spool_order, self.directory.glob(f'{os.getpid()}-*.sealed')), key=_spool_order)
+
+    def _write_batch(self, path):
+        latest = {}
+        with open(path) as f:
+            for line in f:
+                try:
+                    user_id, product_id, timestamp = line.split(',')
+                    key = (int(user_id), int(product_id))
+                    latest[key] = max(latest.get(key, 0.0), float(timestamp))
+                except ValueError:
+                    continue  # A torn last line from a crash
+        if not latest:
+            return
+
+        # Users or products deleted since the view would fail the foreign keys.
+        user_ids = set(User.objects.filter(id__in={user for user, _ in latest}).values_list('id', flat=True))
+        product_ids = set(Product.objects.filter(id__in={product for _, product in latest}).values_list('id', flat=True))
+        interactions = [
+            Interaction(
+                user_id=user_id, product_id=product_id, action=Interaction.Action.VIEW,
+                created_at=datetime.fromtimestamp(timestamp, tz=dt_timezone.utc),
+            )
+            for (user_id, product_id), timestamp in latest.items()
+            if user_id in user_ids and product_id in product_ids
+        ]
+        chunks = [
+            interactions[start:start + self.UPDATE_CHUNK_SIZE]
+            for start in range(0, len(interactions), self.UPDATE_CHUNK_SIZE)
+        ]
+        with transaction.atomic():
+            stored = {
+                (user_id, product_id): created_at
+                for chunk in chunks
+                for user_id, product_id, created_at in Interaction.objects.filter(
+                    _pairs(chunk), action=Interaction.Action.VIEW,
+                ).values_list('user_id', 'product_id', 'created_at')
+            }
+            Interaction.objects.bulk_create(interactions, ignore_conflicts=True)
+            # Views seen before keep the later time, so a replayed or late batch never moves one back.
+            for chunk in chunks:
+                Interaction.objects.filter(_pairs(chunk), action=Interaction.Action.VIEW).update(created_at=Greatest(
+                    F('created_at'),
+                    Case(
+                        *(When(user_id=interaction.user_id, product_id=interaction.product_id,
+                               then=Value(interaction.created_at)) for interaction in chunk),
+                        output_field=DateTimeField(),
+                    ),
+                ))
+            # Committed with the views, and only for those this batch inserted or moved
+            # forward, so a replayed batch adds nothing to the trends.
+            new_views = [
+                interaction for interaction in interactions
+                if (interaction.user_id, interaction.product_id) not in stored
+                or stored[interaction.user_id, interaction.product_id] < interaction.created_at
+            ]
+            trending.record((view.product_id, view.action, view.created_at) for view in new_views)
+        # bulk_create sends no post_save signals.
+        content.invalidate_user_recommendations(*user_ids)
+
+    def _run(self):
+        while True:
+            try:
+                self._wakeup.wait(timeout=self.flush_interval)
+                self._wakeup.clear()
+                self.flush()
+            except Exception:
+                # Keep the worker alive; whatever failed is retried on the next round.
+                logger.exception("Interaction spool flush failed.")
+            finally:
+                connection.close()
+
+
+def _pairs(interactions):
+    """A ``Q`` matching the ``(user_id, product_id)`` pairs of ``interactions``."""
+    pairs = Q()
+    for interaction in interactions:
+        pairs |= Q(user_id=interaction.user_id, product_id=interaction.product_id)
+    return pairs
+
+
+def _spool_order(path):
+    """
+    Sort key of a spool file, ``(pid, sequence)``; a process's active
+    ``<pid>.spool`` sorts after its sealed files. None for any other file.
+    """
+    if path.suffix not in ('.spool', '.sealed'):
+        return None
+    owner, _, sequence = path.stem.partition('-')
+    try:
+        return int(owner), int(sequence) if sequence else math.inf
+    except ValueError:
+        return None
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+spool = InteractionSpool(
+    settings.INTERACTION_SPOOL_DIR,
+    batch_size=settings.INTERACTION_SPOOL_BATCH_SIZE,
+    flush_interval=settings.INTERACTION_SPOOL_FLUSH_INTERVAL,
+    max_pending=settings.INTERACTION_SPOOL_MAX_PENDING,
+)
+
+
+def record_view(user_id: int, product_id: int):
+    """Queues a VIEW interaction for the background writer (see ``InteractionSpool``)."""
+    spool.record_view(user_id, product_id)
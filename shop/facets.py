@@ -0,0 +1,169 @@
+from functools import cached_property
+
+import numpy as np
+
+from .search import CATEGORY_FILTER, TAG_FILTER, get_delta, get_search_index
+
+FACETS = {'category': CATEGORY_FILTER, 'tag': TAG_FILTER}
+
+
+class Selection:
+    """
+    The products matching a set of exact category/tag filters, combining the
+    published search index with the products changed since it was built.
+
+    ``rows`` are the matching index rows (sorted); products in the delta are
+    never among them, and ``delta`` holds the matching ones instead, as
+    ``{product_id: filters}``, read from a ``search.SearchDelta``.
+    """
+
+    def __init__(self, index, delta, filters):
+        self.index = index
+        self.filters = filters
+        # Changed products are judged by their new terms only.
+        self.changed_rows = _rows_of(index, delta.product_ids)
+        self.delta = {product_id: delta.entries[product_id][1] for product_id in delta.query((), filters)}
+
+    @cached_property
+    def _matched_rows(self):
+        """The index rows carrying every filter term (sorted), changed products included."""
+        index = self.index
+        term_ids = [index.term(term) for term in self.filters]
+        if None in term_ids:
+            return np.array([], dtype=np.int32)
+        if not term_ids:
+            return np.arange(len(index), dtype=np.int32)
+        # Intersect the filters' sorted postings, smallest first.
+        postings = sorted((index.postings(term_id) for term_id in term_ids), key=len)
+        rows = np.asarray(postings[0])
+        for other in postings[1:]:
+            if not len(rows):
+                break
+            positions = np.minimum(np.searchsorted(other, rows), len(other) - 1)
+            rows = rows[other[positions] == rows]
+        return rows
+
+    @cached_property
+    def rows(self):
+        rows = self._matched_rows
+        if len(self.changed_rows):
+            rows = rows[~np.isin(rows, self.changed_rows)]
+        return rows
+
+    def page(self, after: int, size: int):
+        """
+        The first ``size`` matching product IDs above ``after``, sorted. Index
+        rows sort like their product IDs, so the cursor is found by binary
+        search, and only the rows and delta entries past it are merged.
+        """
+        index = self.index
+        rows = self._matched_rows
+        start = np.searchsorted(rows, np.searchsorted(index.product_ids, after, side='right'))
+        # Enough rows to fill the page even if every changed product is among them.
+        rows = rows[start:start + size + len(self.changed_rows)]
+        if len(self.changed_rows):
+            rows = rows[~np.isin(rows, self.changed_rows)]
+        product_ids = index.product_ids[rows[:size]]
+        delta_ids = [product_id for product_id in self.delta if product_id > after]
+        if delta_ids:
+            product_ids = np.union1d(product_ids, np.array(delta_ids, dtype=np.int64))
+        return product_ids[:size]
+
+    def counts(self):
+        """
+        Counts the matching products under every filter term. Returns an array
+        of counts over the index's filter terms, plus ``{term: count}`` and
+        ``{term: label}`` for terms only the delta knows.
+        """
+        index = self.index
+        n_filter_terms = len(index.filter_labels)
+        if not self.filters:
+            # Everything matches: the counts are the filter terms' posting lengths,
+            # less the changed products' old terms.
+            counts = np.diff(index.indptr[:n_filter_terms + 1])
+            counts = counts - _forward_counts(index, self.changed_rows, n_filter_terms)
+        else:
+            counts = _forward_counts(index, self.rows, n_filter_terms)
+
+        extra_counts, extra_labels = {}, {}
+        for filters in self.delta.values():
+            for term, label in filters.items():
+                term_id = index.term(term)
+                if term_id is not None:
+                    counts[term_id] += 1
+                else:
+                    extra_counts[term] = extra_counts.get(term, 0) + 1
+                    extra_labels[term] = label
+        return counts, extra_counts, extra_labels
+
+
+def _rows_of(index, product_ids):
+    """Index rows of those ``product_ids`` that are in the index."""
+    if not len(product_ids) or not len(index):
+        return np.array([], dtype=np.int32)
+    positions = np.minimum(np.searchsorted(index.product_ids, product_ids), len(index) - 1)
+    return positions[index.product_ids[positions] == product_ids].astype(np.int32)
+
+
+def _forward_counts(index, rows, n_filter_terms):
+    """How many of ``rows`` carry each filter term, read from the forward index."""
+    starts = index.filter_indptr[rows]
+    lengths = index.filter_indptr[rows + 1] - starts
+    # Positions of every selected row's entries, without a Python loop.
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    entries = np.repeat(starts, lengths) + offsets
+    return np.bincount(index.filter_terms[entries], minlength=n_filter_terms)
+
+
+def selection_terms(category: str = '', tags=()):
+    """The filter terms of a category/tag selection, as ``search.parse_query`` makes them."""
+    terms = [CATEGORY_FILTER + category.strip().lower()] if category else []
+    terms += sorted({TAG_FILTER + tag.strip().lower() for tag in tags if tag.strip()})
+    return terms
+
+
+def select(category: str = '', tags=()):
+    """Returns the ``Selection`` of products in ``category`` carrying every one of ``tags``."""
+    return Selection(get_search_index(), get_delta(), selection_terms(category, tags))
+
+
+def facet_counts(category: str = '', tags=(), limit: int = 20):
+    """
+    Returns the category and tag facets for a selection, as
+    ``{'category': [...], 'tag': [...]}`` of ``(label, count)`` pairs,
+    most common first (at most ``limit`` each).
+
+    Tag counts are for the whole selection. Category counts ignore the
+    selected category, so the other categories stay visible with the number
+    of products each would show.
+    """
+    index = get_search_index()
+    delta = get_delta()
+    tag_selection = Selection(index, delta, selection_terms('', tags))
+    selections = {
+        'category': tag_selection,
+        'tag': Selection(index, delta, selection_terms(category, tags)) if category else tag_selection,
+    }
+    selected = set(selection_terms(category, tags))
+    facets = {}
+    for facet, prefix in FACETS.items():
+        counts, extra_counts, extra_labels = selections[facet].counts()
+        lo = index.vocabulary.search(prefix, hi=len(index.filter_labels))
+        hi = index.vocabulary.search(prefix + '\uffff', lo, len(index.filter_labels))
+        counts = counts[lo:hi]
+        top = np.flatnonzero(counts)
+        if len(top) > limit:
+            top = top[np.argpartition(-counts[top], limit - 1)[:limit]]
+        selected_ids = [term_id - lo for term_id in map(index.term, selected) if term_id is not None and lo <= term_id < hi]
+        top = np.union1d(top, selected_ids).astype(np.int64)
+        values = {
+            index.vocabulary[lo + i]: (index.filter_labels[lo + i], int(counts[i])) for i in top
+        }
+        values.update((term, (extra_labels[term], count)) for term, count in extra_counts.items() if term.startswith(prefix))
+        values = sorted(
+            ((term, label, count) for term, (label, count) in values.items() if label),  # e.g. a blank category
+            key=lambda value: (-value[2], value[1].lower()),
+        )
+        # Selected values are always listed, so they can be deselected.
+        facets[facet] = [(label, count) for i, (term, label, count) in enumerate(values) if i < limit or term in selected]
+    return facets
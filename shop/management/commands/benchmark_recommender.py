@@ -0,0 +1,151 @@
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from shop.models import Interaction, Product, Tag
+from shop.recommender import content, engines, py_similarity
+
+try:
+    from shop.recommender import cy_similarity
+except ImportError:
+    cy_similarity = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the recommender against the current database (see generate_demo_data / load_demo_data) '
+        'and writes latency percentiles, throughput and peak RSS as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200, help='Timed calls per benchmark.')
+        parser.add_argument('--builds', type=int, default=3, help='Timed index rebuilds.')
+        parser.add_argument('-k', type=int, default=4)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', type=Path, help='Write the JSON report here instead of stdout.')
+        parser.add_argument('--compare', type=Path, help='A previous JSON report to print p50 changes against.')
+
+    def handle(self, *args, **options):
+        self.rng = np.random.default_rng(options['seed'])
+        self.calls, self.k = options['calls'], options['k']
+
+        product_ids = np.fromiter(Product.objects.values_list('id', flat=True), dtype=np.int64)
+        user_ids = np.fromiter(
+            Interaction.objects.order_by().values_list('user_id', flat=True).distinct(), dtype=np.int64
+        )
+        if not len(product_ids) or not len(user_ids):
+            self.stderr.write("The database has no products or interactions; load a catalog first.")
+            return
+
+        report = {
+            'commit': git_commit(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'settings': {
+                'engine': settings.RECOMMENDER_ENGINE,
+                'tag_encoding': content.TAG_ENCODING,
+                'cython': cy_similarity is not None,
+            },
+            'dataset': {
+                'products': len(product_ids),
+                'tags': Tag.objects.count(),
+                'users': len(user_ids),
+                'interactions': Interaction.objects.count(),
+            },
+            'benchmarks': {},
+        }
+        benchmarks = report['benchmarks']
+
+        benchmarks['index_build'] = self.measure(lambda _: content.rebuild_product_tag_matrix(), [None] * options['builds'])
+        benchmarks['get_product_tag_matrix'] = self.measure(lambda _: content.get_product_tag_matrix(), [None] * self.calls)
+
+        sample_products = self.sample(product_ids)
+        benchmarks['similar_products'] = self.measure(lambda pid: list(engines.similar_products(pid, self.k)), sample_products)
+
+        users = list(User.objects.filter(id__in=self.sample(user_ids)))
+
+        def cold_recommendations(user):
+            content.invalidate_user_recommendations(user.pk)
+            return list(engines.recommendations_for_user(user, self.k))
+
+        benchmarks['recommendations_for_user_cold'] = self.measure(cold_recommendations, users)
+        benchmarks['recommendations_for_user_warm'] = self.measure(
+            lambda user: list(engines.recommendations_for_user(user, self.k)), users
+        )
+
+        matrix = content.get_product_tag_matrix()
+        queries = [matrix.row_vector(row) for row in self.sample(np.arange(len(matrix)))]
+        kernels = {'py_similarity': py_similarity.cosine_similarity_top_k}
+        if cy_similarity is not None:
+            kernels['cy_similarity'] = cy_similarity.cosine_similarity_top_k
+        for name, kernel in kernels.items():
+            benchmarks[f'kernel_{name}'] = self.measure(lambda query: kernel(matrix, query, self.k + 1), queries)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            options['output'].write_text(output)
+            self.stderr.write(f"Wrote {options['output']}")
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            self.compare(json.loads(options['compare'].read_text()), report)
+
+    def sample(self, values):
+        return self.rng.choice(values, size=self.calls).tolist()
+
+    def measure(self, function, arguments):
+        """Calls ``function`` once per argument (after one warm-up call) and summarizes the latencies."""
+        function(arguments[0])
+        latencies = []
+        started = time.perf_counter()
+        for argument in arguments:
+            call_started = time.perf_counter()
+            function(argument)
+            latencies.append(time.perf_counter() - call_started)
+        elapsed = time.perf_counter() - started
+
+        p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+        return {
+            'calls': len(arguments),
+            'p50_ms': round(p50, 4),
+            'p95_ms': round(p95, 4),
+            'p99_ms': round(p99, 4),
+            'throughput_per_sec': round(len(arguments) / elapsed, 2),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+
+    def compare(self, baseline, report):
+        self.stderr.write(f"p50 vs {baseline.get('commit') or 'baseline'}:")
+        for name, result in report['benchmarks'].items():
+            before = baseline.get('benchmarks', {}).get(name)
+            if before is None:
+                continue
+            change = result['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('inf')
+            self.stderr.write(f"  {name:<32} {before['p50_ms']:10.3f} -> {result['p50_ms']:10.3f} ms  ({change:.2f}x)")
@@ -0,0 +1,90 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from shop.search import SearchIndex
+
+from .benchmark_recommender import peak_rss_mb
+from .generate_demo_data import zipf_weights
+
+
+def synthetic_documents(n_products, n_words, words_per_product, n_categories, n_tags, seed=0):
+    """
+    Yields ``(product_id, name, category, description, tag_names)`` tuples with
+    Zipf-distributed words, like real catalog text: a few words are in most
+    products, most words in a few.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f'w{i}' for i in range(n_words)])
+    word_p = zipf_weights(n_words, 1.0)
+    for start in range(0, n_products, 10_000):
+        size = min(10_000, n_products - start)
+        names = vocabulary[rng.choice(n_words, size=(size, 3), p=word_p)]
+        descriptions = vocabulary[rng.choice(n_words, size=(size, words_per_product), p=word_p)]
+        categories = rng.integers(0, n_categories, size=size)
+        tags = rng.integers(0, n_tags, size=(size, 4))
+        for i in range(size):
+            yield (
+                start + i + 1,
+                ' '.join(names[i]),
+                f'Category {categories[i]}',
+                ' '.join(descriptions[i]),
+                [f'tag{tag}' for tag in tags[i]],
+            )
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks search query latency (p50/p95/p99) on a synthetic catalog.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1_000_000)
+        parser.add_argument('--words', type=int, default=50_000, help='Size of the text vocabulary.')
+        parser.add_argument('--words-per-product', type=int, default=20, help='Description length.')
+        parser.add_argument('--categories', type=int, default=200)
+        parser.add_argument('--tags', type=int, default=2_000)
+        parser.add_argument('--queries', type=int, default=500, help='Timed queries per query shape.')
+        parser.add_argument('--limit', type=int, default=48)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        index = SearchIndex.from_documents(synthetic_documents(
+            options['products'], options['words'], options['words_per_product'],
+            options['categories'], options['tags'], seed=options['seed'],
+        ))
+        self.stdout.write(
+            f"Built index over {len(index)} products: {len(index.vocabulary)} terms, {len(index.rows)} postings, "
+            f"in {time.perf_counter() - started:.1f}s (peak RSS {peak_rss_mb():.0f} MB)."
+        )
+
+        # Queries draw words by popularity, as users mostly type common words.
+        rng = np.random.default_rng(options['seed'] + 1)
+        n = options['queries']
+        word_p = zipf_weights(options['words'], 1.0)
+
+        def words(count):
+            return [[f'w{i}' for i in row] for row in rng.choice(options['words'], size=(n, count), p=word_p)]
+
+        shapes = {
+            'one term': [(query, []) for query in words(1)],
+            'two terms (AND)': [(query, []) for query in words(2)],
+            'three terms (AND)': [(query, []) for query in words(3)],
+            'prefix': [([query[0][:-1] or query[0]], []) for query in words(1)],
+            'term + prefix': [([first, second[:-1] or second], []) for first, second in words(2)],
+            'term + category': [
+                (query, [f'\x01category:category {c}']) for query, c in zip(words(1), rng.integers(0, options['categories'], n))
+            ],
+            'tag only': [([], [f'\x01tag:tag{t}']) for t in rng.integers(0, options['tags'], n)],
+        }
+
+        self.stdout.write(f"{'query':<20} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'hits p50':>10}")
+        for name, queries in shapes.items():
+            latencies, hits = [], []
+            for tokens, filters in queries:
+                call_started = time.perf_counter()
+                ids, _ = index.query(tokens, filters, limit=options['limit'])
+                latencies.append(time.perf_counter() - call_started)
+                hits.append(len(ids))
+            p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+            self.stdout.write(f"{name:<20} {p50:9.3f} {p95:9.3f} {p99:9.3f} {int(np.median(hits)):10d}")
@@ -0,0 +1,141 @@
+import time
+from functools import partial
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from shop.recommender import py_similarity
+from shop.recommender.index import BitPackedTagIndex, MinHashTagIndex, ProductTagIndex
+
+try:
+    from shop.recommender import cy_similarity
+except ImportError:
+    cy_similarity = None
+
+
+def synthetic_index(n_products, n_tags, tags_per_product, seed=0, index_class=ProductTagIndex, clusters=0, **options):
+    """
+    Builds a random product-tag index without touching the database.
+
+    With ``clusters``, every product draws its tags from a small pool shared
+    by its cluster (like products of one category), instead of uniformly from
+    the whole vocabulary; approximate indexes rely on that kind of structure.
+    Extra ``options`` are passed on to ``index_class``.
+    """
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, 2 * tags_per_product, size=n_products)
+    rows = np.repeat(np.arange(n_products, dtype=np.int64), counts)
+    if clusters:
+        pool_offsets = rng.integers(0, n_tags, size=clusters)[rng.integers(0, clusters, size=n_products)]
+        tags = (np.repeat(pool_offsets, counts) + rng.integers(0, 4 * tags_per_product, size=len(rows))) % n_tags
+    else:
+        tags = rng.integers(0, n_tags, size=len(rows))
+    # Sort each row's random tags and drop repeats so every row stays binary.
+    keys = np.unique(rows * n_tags + tags)
+    rows, indices = np.divmod(keys, n_tags)
+    indptr = np.zeros(n_products + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_products), out=indptr[1:])
+    return index_class(np.arange(1, n_products + 1), indptr, indices.astype(np.int32), n_tags, **options)
+
+
+def recompute_norms_top_k(matrix, vector, k):
+    """The pre-v2 scoring path, which derived every row norm on each call."""
+    vector_1d = np.asarray(vector, dtype=np.float32).ravel()
+    dot_product = py_similarity.sparse_dot(matrix.indptr, matrix.indices, vector_1d)
+    denominator = np.sqrt(np.diff(matrix.indptr)).astype(np.float32) * np.linalg.norm(vector_1d)
+    similarities = np.zeros_like(denominator)
+    valid = denominator > 0
+    similarities[valid] = dot_product[valid] / denominator[valid]
+    top_k = np.argpartition(similarities, -k)[-k:]
+    return top_k[np.argsort(similarities[top_k])][::-1]
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the per-call cost of the cosine similarity kernels on synthetic catalogs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+        parser.add_argument('--tags', type=int, default=5000, help='Size of the tag vocabulary.')
+        parser.add_argument('--tags-per-product', type=int, default=8)
+        parser.add_argument('--repeat', type=int, default=20, help='Timed calls per kernel and size.')
+        parser.add_argument('-k', type=int, default=5)
+        parser.add_argument('--clusters', type=int, default=0,
+                            help='Draw tags from this many per-cluster pools instead of uniformly.')
+        parser.add_argument('--minhash-bands', type=int, default=32)
+        parser.add_argument('--minhash-band-rows', type=int, default=2)
+        parser.add_argument('--probe-bands', type=int, nargs='+', default=[None],
+                            help='Bands probed per query; one minhash row is timed per value.')
+
+    def handle(self, *args, **options):
+        kernels = [
+            ('recompute norms', recompute_norms_top_k, ProductTagIndex),
+            ('py_similarity', py_similarity.cosine_similarity_top_k, ProductTagIndex),
+            ('py popcount', py_similarity.popcount_similarity_top_k, BitPackedTagIndex),
+        ]
+        # Approximate kernels also report recall@k against the exact scores.
+        approximate = {
+            f"minhash/{probe_bands or 'all'}": partial(py_similarity.minhash_similarity_top_k, probe_bands=probe_bands)
+            for probe_bands in options['probe_bands']
+        }
+        kernels += [(name, kernel, MinHashTagIndex) for name, kernel in approximate.items()]
+        if cy_similarity is not None:
+            kernels += [
+                ('cy_similarity', cy_similarity.cosine_similarity_top_k, ProductTagIndex),
+                ('cy popcount', cy_similarity.popcount_similarity_top_k, BitPackedTagIndex),
+            ]
+        else:
+            self.stderr.write("Cython module not built; skipping cy_similarity.")
+
+        k = options['k']
+        for n_products in options['sizes']:
+            index_options = {
+                MinHashTagIndex: {'n_bands': options['minhash_bands'], 'band_rows': options['minhash_band_rows']},
+            }
+            indexes = {
+                index_class: synthetic_index(
+                    n_products, options['tags'], options['tags_per_product'],
+                    index_class=index_class, clusters=options['clusters'], **index_options.get(index_class, {}),
+                )
+                for index_class in (ProductTagIndex, BitPackedTagIndex, MinHashTagIndex)
+            }
+            matrix = indexes[ProductTagIndex]
+            queries = [matrix.row_vector(i) for i in range(min(options['repeat'], n_products))]
+            self.stdout.write(
+                f"{n_products:>9,} products ({matrix.nnz:,} tags set; "
+                f"CSR {_mb(matrix.indptr, matrix.indices)}, bitset {_mb(indexes[BitPackedTagIndex].bits)}, "
+                f"minhash {_mb(*(getattr(indexes[MinHashTagIndex], name) for name in ('signatures', 'band_keys', 'band_order')))}, "
+                f"dense int8 {n_products * options['tags'] / 1e6:.1f} MB):"
+            )
+
+            # Exact reference scores, to measure the approximate kernels' recall.
+            reference = [
+                py_similarity.sparse_dot(matrix.indptr, matrix.indices, query.ravel()) * matrix.inv_norms
+                for query in queries
+            ]
+
+            baseline = None
+            for name, kernel, index_class in kernels:
+                kernel_matrix = indexes[index_class]
+                kernel(kernel_matrix, queries[0], k)  # warm-up
+                results = []
+                start = time.perf_counter()
+                for query in queries:
+                    results.append(kernel(kernel_matrix, query, k))
+                per_call_ms = (time.perf_counter() - start) * 1000 / len(queries)
+                baseline = baseline or per_call_ms
+
+                line = f"  {name:<16} {per_call_ms:9.3f} ms/call  ({baseline / per_call_ms:4.1f}x)"
+                if name in approximate:
+                    # Kernels return only rows scoring above 0, so fewer than k of them may exist.
+                    expected = [np.sort(scores[scores > 0])[::-1][:k] for scores in reference]
+                    # A hit is any returned row scoring at least the exact k-th best score.
+                    recall = np.mean([
+                        np.sum(scores[result] >= top[-1] - 1e-5) / len(top)
+                        for scores, result, top in zip(reference, results, expected) if len(top)
+                    ])
+                    line += f'  recall@{k} {recall:.3f}'
+                self.stdout.write(line)
+
+
+def _mb(*arrays):
+    return f"{sum(a.nbytes for a in arrays) / 1e6:.1f} MB"
@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.recommender import collaborative, content
+from shop.recommender.index import ProductTagIndex
+from shop.recommender.neighbors import NeighborTable
+
+
+class Command(BaseCommand):
+    help = 'Precomputes the "similar products" neighbor table served by similar_products().'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-k', type=int, default=20, help='Neighbors to store per product.')
+        parser.add_argument('--engine', choices=['content', 'collaborative'], default='content')
+        parser.add_argument('--block-size', type=int, default=256, help='Products scored per batch (content engine).')
+        parser.add_argument(
+            '--max-block-elements', type=int, default=1 << 24,
+            help='Co-occurrence pairs expanded per batch (collaborative engine).',
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['engine'] == 'collaborative':
+            table, path = self.build_collaborative(options)
+        else:
+            table, path = self.build_content(options)
+        table.save(path)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f"Wrote {len(table)} x {table.k} neighbors to {path} in {elapsed:.1f}s."))
+
+    def build_content(self, options):
+        matrix = ProductTagIndex.from_db()
+        self.stdout.write(f"Built product-tag index: {len(matrix)} products, {matrix.nnz} tags set.")
+
+        table = NeighborTable.build(
+            matrix,
+            k=options['k'],
+            similarity_batch_function=content.SIMILARITY_BATCH_FUNCTION,
+            block_size=options['block_size'],
+            progress=self.progress(len(matrix)),
+        )
+        return table, content.neighbor_table_path()
+
+    def build_collaborative(self, options):
+        matrix = collaborative.ItemUserMatrix.from_db()
+        self.stdout.write(
+            f"Built item-user matrix: {len(matrix)} products, {len(matrix.user_ids)} users, "
+            f"{matrix.nnz} interactions."
+        )
+
+        table = collaborative.build_neighbor_table(
+            matrix,
+            k=options['k'],
+            max_block_elements=options['max_block_elements'],
+            progress=self.progress(len(matrix)),
+        )
+        return table, collaborative.neighbor_table_path()
+
+    def progress(self, total):
+        def report(done):
+            self.stdout.write(f"  {done}/{total} products scored", ending='\r')
+        return report
@@ -0,0 +1,144 @@
+import re
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.utils import timezone
+
+from shop.models import Interaction, Product
+
+# SQLite's EXPLAIN QUERY PLAN: a bare "SCAN <table>" reads every row of the table
+# (unlike "SCAN <table> USING INDEX ...", which walks an index in order, e.g. up
+# to a LIMIT); a temp B-tree is a sort or DISTINCT done in memory per query.
+FULL_SCAN_RE = re.compile(r'\bSCAN (\w+)\s*$')
+TEMP_BTREE_RE = re.compile(r'\bUSE TEMP B-TREE\b')
+
+
+def admin_changelist_queries(params):
+    """The admin's changelist queryset for ``params`` (the list_filter query string), first page only."""
+    superuser = User(username='plan-check', is_active=True, is_staff=True, is_superuser=True)
+    request = RequestFactory().get('/admin/shop/interaction/', params)
+    request.user = superuser
+    changelist = admin.site._registry[Interaction].get_changelist_instance(request)
+    return changelist.queryset[:changelist.list_per_page]
+
+
+def hot_queries(user_id):
+    """The Interaction queries on hot paths, by name, as querysets to EXPLAIN."""
+    # The admin's date filter links pass aware midnights, e.g. "Past 7 days".
+    today = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+    last_week, tomorrow = str(today - timedelta(days=7)), str(today + timedelta(days=1))
+    return {
+        # content.interaction_weights: every interaction of one user.
+        'user interactions': Interaction.objects.filter(user_id=user_id).order_by()
+        .values_list('product_id', 'action', 'rating', 'created_at'),
+        'user product ids': Interaction.objects.filter(user_id=user_id).order_by().values_list('product_id', flat=True),
+        'user actions': Interaction.objects.filter(
+            user_id=user_id, action__in=[Interaction.Action.LIKE, Interaction.Action.PURCHASE]
+        ).order_by().values_list('product_id', 'action'),
+        'user recent': Interaction.objects.filter(user_id=user_id, action=Interaction.Action.VIEW)[:20],
+        'admin changelist': admin_changelist_queries({}),
+        'admin filter action': admin_changelist_queries({'action__exact': Interaction.Action.PURCHASE}),
+        'admin filter date': admin_changelist_queries({'created_at__gte': last_week, 'created_at__lt': tomorrow}),
+        'admin filter action and date': admin_changelist_queries({
+            'action__exact': Interaction.Action.VIEW, 'created_at__gte': last_week, 'created_at__lt': tomorrow,
+        }),
+        'admin count action': Interaction.objects.filter(action=Interaction.Action.LIKE).order_by().values('pk'),
+    }
+
+
+def plan_problems(plan):
+    """The full scans and temp B-tree sorts in an EXPLAIN QUERY PLAN, as messages."""
+    problems = [f"full scan of {match.group(1)}" for line in plan.splitlines() if (match := FULL_SCAN_RE.search(line))]
+    problems += ['temp B-tree sort' for line in plan.splitlines() if TEMP_BTREE_RE.search(line)]
+    return problems
+
+
+def seed_interactions(n, n_users, n_products):
+    """
+    Bulk-inserts ``n`` Zipf-skewed interactions (with the users and products
+    they need), then ANALYZEs. Returns the number inserted (repeats are skipped).
+    """
+    rng = np.random.default_rng(0)
+    user_ids = np.array([user.pk for user in User.objects.bulk_create(
+        User(username=f'plan-check-{i}', password='!') for i in range(n_users)
+    )])
+    product_ids = np.array([product.pk for product in Product.objects.bulk_create(
+        Product(name=f'Plan check {i}', category='Plan check', price=1) for i in range(n_products)
+    )])
+
+    users = user_ids[rng.zipf(1.3, size=n) % n_users]
+    products = product_ids[rng.zipf(1.3, size=n) % n_products]
+    actions = rng.choice(Interaction.Action.values, size=n, p=[0.8, 0.15, 0.05])
+    now = time.time()
+    created_at = now - rng.exponential(30 * 86400, size=n)
+    seen = set()
+    batch = []
+    for user_id, product_id, action, timestamp in zip(users.tolist(), products.tolist(), actions.tolist(), created_at.tolist()):
+        if (user_id, product_id, action) in seen:
+            continue
+        seen.add((user_id, product_id, action))
+        batch.append(Interaction(
+            user_id=user_id, product_id=product_id, action=action,
+            created_at=datetime.fromtimestamp(timestamp, tz=dt_timezone.utc),
+        ))
+    Interaction.objects.bulk_create(batch, batch_size=5000)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    return len(batch)
+
+
+class Command(BaseCommand):
+    help = (
+        'Captures EXPLAIN QUERY PLAN for the hot Interaction queries and fails on full table scans '
+        'or temp B-tree sorts. With --seed, runs against a synthetic interaction table that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, metavar='N',
+                            help='Insert N synthetic interactions (and ANALYZE) before checking; rolled back afterwards.')
+        parser.add_argument('--users', type=int, default=10_000, help='Synthetic users to spread --seed over.')
+        parser.add_argument('--products', type=int, default=50_000, help='Synthetic products to spread --seed over.')
+        parser.add_argument('--verbose-plans', action='store_true', help='Print every plan, not just failures.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError(f"Plan checks read SQLite's EXPLAIN QUERY PLAN; this database is {connection.vendor}.")
+
+        with transaction.atomic():
+            if options['seed']:
+                self.seed(options['seed'], options['users'], options['products'])
+            user_id = Interaction.objects.order_by().values_list('user_id', flat=True).first() or 1
+            failures = self.check_plans(user_id, options['verbose_plans'])
+            # Never keep the synthetic rows or statistics.
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError(f"{len(failures)} query plan(s) regressed: {', '.join(failures)}")
+        self.stdout.write(self.style.SUCCESS("All hot Interaction queries use indexes without temp B-tree sorts."))
+
+    def check_plans(self, user_id, verbose):
+        failures = []
+        for name, queryset in hot_queries(user_id).items():
+            plan = queryset.explain()
+            problems = plan_problems(plan)
+            if problems:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f"FAIL {name}: {'; '.join(problems)}"))
+            else:
+                self.stdout.write(f"ok   {name}")
+            if problems or verbose:
+                self.stdout.write(f"     {queryset.query}")
+                for line in plan.splitlines():
+                    self.stdout.write(f"       {line}")
+        return failures
+
+    def seed(self, n, n_users, n_products):
+        started = time.perf_counter()
+        seeded = seed_interactions(n, n_users, n_products)
+        self.stdout.write(f"Seeded {seeded} interactions in {time.perf_counter() - started:.1f}s.")
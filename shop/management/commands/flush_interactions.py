@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from shop.events import spool
+
+
+class Command(BaseCommand):
+    help = 'Writes spooled product views to the database, including those left behind by exited processes.'
+
+    def handle(self, *args, **options):
+        spool.flush()
+        remaining = list(spool.directory.glob('*.sealed')) if spool.directory.exists() else []
+        if remaining:
+            self.stderr.write(f"{len(remaining)} spool files could not be flushed; see the log.")
+        else:
+            self.stdout.write(self.style.SUCCESS("Interaction spool flushed."))
@@ -0,0 +1,103 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from shop.models import Interaction
+
+
+def zipf_weights(n, skew):
+    """Normalized popularity of ranks 1..n under a Zipf law; skew 0 is uniform."""
+    weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** skew
+    return weights / weights.sum()
+
+
+class Command(BaseCommand):
+    help = 'Writes a synthetic catalog (users.csv, products.csv, interactions.csv) for load_demo_data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_dir', type=Path)
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--tags', type=int, default=2_000, help='Size of the tag vocabulary.')
+        parser.add_argument('--tags-per-product', type=int, default=6)
+        parser.add_argument('--categories', type=int, default=200,
+                            help='Products of a category draw their tags from a shared pool.')
+        parser.add_argument('--users', type=int, default=20_000)
+        parser.add_argument('--interactions', type=int, default=1_000_000,
+                            help='Interactions sampled; repeated (user, product, action) triples are dropped.')
+        parser.add_argument('--skew', type=float, default=1.0,
+                            help='Zipf exponent of product popularity and user activity (0 = uniform).')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        self.rng = np.random.default_rng(options['seed'])
+        output_dir = options['output_dir']
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        self.write_users(output_dir / 'users.csv', options['users'])
+        self.write_products(output_dir / 'products.csv', options)
+        n_interactions = self.write_interactions(output_dir / 'interactions.csv', options)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {options['users']} users, {options['products']} products and {n_interactions} interactions "
+            f"to {output_dir} in {time.perf_counter() - started:.1f}s."
+        ))
+
+    def write_users(self, path, n_users):
+        usernames = pd.Series(np.arange(n_users)).map('user{}'.format)
+        pd.DataFrame({
+            'username': usernames,
+            'email': usernames + '@example.com',
+            'first_name': 'Synthetic',
+            'last_name': usernames,
+        }).to_csv(path, index=False)
+
+    def write_products(self, path, options):
+        n_products, n_tags = options['products'], options['tags']
+        tags_per_product = options['tags_per_product']
+        categories = self.rng.integers(0, options['categories'], size=n_products)
+        pool_offsets = self.rng.integers(0, n_tags, size=options['categories'])
+
+        counts = self.rng.integers(1, 2 * tags_per_product, size=n_products)
+        rows = np.repeat(np.arange(n_products), counts)
+        tags = (np.repeat(pool_offsets[categories], counts)
+                + self.rng.integers(0, 4 * tags_per_product, size=len(rows))) % n_tags
+        tag_lists = (
+            pd.DataFrame({'row': rows, 'tag': tags}).drop_duplicates()
+            .assign(tag=lambda df: 'tag' + df['tag'].astype(str))
+            .groupby('row')['tag'].agg(','.join)
+        )
+
+        ids = np.arange(1, n_products + 1)
+        pd.DataFrame({
+            'id': ids,
+            'name': pd.Series(ids).map('Product {}'.format),
+            'category': pd.Series(categories).map('Category {}'.format),
+            'price': np.round(self.rng.uniform(1, 500, size=n_products), 2),
+            'tags': tag_lists.reindex(np.arange(n_products), fill_value='').to_numpy(),
+            'stock': self.rng.integers(0, 100, size=n_products),
+        }).to_csv(path, index=False)
+
+    def write_interactions(self, path, options):
+        """Samples (user, product, action) triples with Zipf-skewed users and products, without duplicates."""
+        n = options['interactions']
+        actions = np.array(Interaction.Action.values)
+        # VIEW is the most common action, PURCHASE the rarest.
+        action_weights = zipf_weights(len(actions), 1.5)
+
+        users = self.rng.choice(options['users'], size=n, p=zipf_weights(options['users'], options['skew']))
+        # Shuffle which product IDs are popular so popularity is independent of ID order.
+        popular = self.rng.permutation(options['products']) + 1
+        products = popular[self.rng.choice(options['products'], size=n, p=zipf_weights(options['products'], options['skew']))]
+        action_codes = self.rng.choice(len(actions), size=n, p=action_weights)
+
+        # The (user, product, action) triple is unique in the database.
+        frame = pd.DataFrame({'user': users, 'product_id': products, 'action': action_codes}).drop_duplicates()
+        frame['username'] = frame['user'].map('user{}'.format)
+        frame['action'] = actions[frame['action'].to_numpy()]
+        frame['rating'] = np.where(frame['action'] == Interaction.Action.VIEW, 0, self.rng.integers(1, 6, size=len(frame)))
+        frame[['username', 'product_id', 'action', 'rating']].to_csv(path, index=False)
+        return len(frame)
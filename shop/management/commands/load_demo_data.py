@@ -1,74 +1,169 @@
+import time
+
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
-from shop.models import Product, Tag, Interaction
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from shop import rollups, search
+from shop.models import (
+    Product, Tag, Interaction, ProductDailyStats, ProductTrendBucket, RollupCheckpoint, UserProductStats,
+)
+from shop.recommender import content, trending
+
 
 class Command(BaseCommand):
     help = 'Loads demo data from CSV files into the database.'
 
+    def add_arguments(self, parser):
+        default_dir = Path(__file__).resolve().parent.parent.parent.parent / 'data'
+        parser.add_argument('--data-dir', type=Path, default=default_dir,
+                            help='Directory containing users.csv, products.csv and interactions.csv.')
+        parser.add_argument('--chunk-size', type=int, default=50_000,
+                            help='CSV rows read into memory at a time.')
+        parser.add_argument('--batch-size', type=int, default=5_000,
+                            help='Rows per bulk INSERT statement.')
+
     def handle(self, *args, **options):
-        data_dir = Path(__file__).resolve().parent.parent.parent.parent / 'data'
-        products_csv = data_dir / 'products.csv'
-        users_csv = data_dir / 'users.csv'
-        interactions_csv = data_dir / 'interactions.csv'
+        data_dir = options['data_dir']
+        self.chunk_size = options['chunk_size']
+        self.batch_size = options['batch_size']
 
         self.stdout.write("Starting data loading process...")
 
         try:
             with transaction.atomic():
                 self.stdout.write("Clearing old data...")
-                Interaction.objects.all().delete()
-                Product.objects.all().delete()
-                Tag.objects.all().delete()
+                # Models without delete signals or cascades are deleted in one statement.
+                for model in (ProductDailyStats, UserProductStats, RollupCheckpoint, ProductTrendBucket,
+                              Product.tags.through):
+                    model.objects.all().delete()
+                # The rest have post_delete receivers, for which .delete() would load and
+                # signal every row; a plain DELETE skips them, as everything they keep
+                # up to date is rebuilt below. Children go first, for the foreign keys.
+                with connection.cursor() as cursor:
+                    for model in (Interaction, Product, Tag):
+                        cursor.execute(f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)}')
                 User.objects.filter(is_superuser=False).delete()
                 self.stdout.write("Old data cleared.")
 
-                self.stdout.write("Loading users...")
-                users_df = pd.read_csv(users_csv)
-                for _, row in users_df.iterrows():
-                    user, created = User.objects.get_or_create(
-                        username=row['username'],
-                        defaults={'email': row['email'], 'first_name': row['first_name'], 'last_name': row['last_name']}
-                    )
-                    if created:
-                        user.set_password('password')
-                        user.save()
-                self.stdout.write(f"{len(users_df)} users loaded.")
-
-                self.stdout.write("Loading products and tags...")
-                products_df = pd.read_csv(products_csv)
-                for _, row in products_df.iterrows():
-                    product = Product.objects.create(
-                        id=row['id'],
-                        name=row['name'],
-                        description=row.get('description', ''), # <-- GET NEW FIELD
-                        category=row['category'],
-                        price=row['price'],
-                        stock=row.get('stock', 0) # <-- GET NEW FIELD
-                    )
-                    tag_names = [t.strip() for t in row['tags'].split(',')]
-                    for tag_name in tag_names:
-                        tag, _ = Tag.objects.get_or_create(name=tag_name)
-                        product.tags.add(tag)
-                self.stdout.write(f"{len(products_df)} products loaded.")
-
-                self.stdout.write("Loading interactions...")
-                interactions_df = pd.read_csv(interactions_csv)
-                for _, row in interactions_df.iterrows():
-                    try:
-                        user = User.objects.get(username=row['username'])
-                        product = Product.objects.get(id=row['product_id'])
-                        Interaction.objects.create(user=user, product=product, action=row['action'], rating=row['rating'])
-                    except User.DoesNotExist:
-                        self.stderr.write(f"User '{row['username']}' not found. Skipping interaction.")
-                    except Product.DoesNotExist:
-                        self.stderr.write(f"Product ID '{row['product_id']}' not found. Skipping interaction.")
-                self.stdout.write(f"{len(interactions_df)} interactions loaded.")
+                user_ids = self.load_users(data_dir / 'users.csv')
+                product_ids = self.load_products(data_dir / 'products.csv')
+                self.load_interactions(data_dir / 'interactions.csv', user_ids, product_ids)
+
+                # Products were inserted with explicit IDs; move the sequence past them.
+                with connection.cursor() as cursor:
+                    for sql in connection.ops.sequence_reset_sql(no_style(), [Product]):
+                        cursor.execute(sql)
 
         except Exception as e:
             self.stderr.write(self.style.ERROR(f"An error occurred: {e}"))
             raise e
 
-        self.stdout.write(self.style.SUCCESS("Demo data loaded successfully!"))
\ No newline at end of file
+        # Bulk inserts send no model signals, so refresh the recommender and search state directly.
+        content.rebuild_product_tag_matrix()
+        search.rebuild_search_index()
+        cache.delete(rollups.CHECKPOINT_KEY)
+        trending.rebuild_trending()
+        content.invalidate_user_recommendations(*user_ids.values())
+
+        self.stdout.write(self.style.SUCCESS("Demo data loaded successfully!"))
+
+    def read_chunks(self, path):
+        return pd.read_csv(path, chunksize=self.chunk_size)
+
+    def report(self, label, count, started):
+        elapsed = time.perf_counter() - started
+        rate = count / elapsed if elapsed > 0 else float('inf')
+        self.stdout.write(f"{count} {label} loaded in {elapsed:.1f}s ({rate:,.0f} rows/sec).")
+
+    def load_users(self, path):
+        """Inserts users in bulk and returns a username -> id map."""
+        self.stdout.write("Loading users...")
+        started = time.perf_counter()
+        # Every demo user shares the same password, so hash it once rather than per row.
+        password = make_password('password')
+        count = 0
+        for chunk in self.read_chunks(path):
+            users = [
+                User(username=username, email=email, first_name=first_name, last_name=last_name, password=password)
+                for username, email, first_name, last_name in chunk[
+                    ['username', 'email', 'first_name', 'last_name']
+                ].itertuples(index=False)
+            ]
+            # Existing (e.g. superuser) accounts with the same username are kept as-is.
+            User.objects.bulk_create(users, batch_size=self.batch_size, ignore_conflicts=True)
+            count += len(users)
+        self.report("users", count, started)
+        return dict(User.objects.values_list('username', 'id'))
+
+    def load_products(self, path):
+        """Inserts products, tags and product-tag links in bulk; returns the loaded product IDs."""
+        self.stdout.write("Loading products and tags...")
+        started = time.perf_counter()
+        tag_ids = {}
+        loaded = []
+        through = Product.tags.through
+        for chunk in self.read_chunks(path):
+            if 'description' not in chunk:
+                chunk['description'] = ''
+            if 'stock' not in chunk:
+                chunk['stock'] = 0
+            chunk['description'] = chunk['description'].fillna('')
+
+            products = [
+                Product(id=pid, name=name, description=description, category=category, price=price, stock=stock)
+                for pid, name, description, category, price, stock in chunk[
+                    ['id', 'name', 'description', 'category', 'price', 'stock']
+                ].itertuples(index=False)
+            ]
+            Product.objects.bulk_create(products, batch_size=self.batch_size)
+            loaded.append(chunk['id'].to_numpy(dtype=np.int64))
+
+            # One (product_id, tag_name) row per tag, with names resolved through an in-memory map.
+            links = chunk[['id', 'tags']].dropna().assign(tags=chunk['tags'].str.split(',')).explode('tags')
+            links['tags'] = links['tags'].str.strip()
+            links = links[links['tags'] != ''].drop_duplicates()
+
+            new_names = set(links['tags']) - tag_ids.keys()
+            if new_names:
+                Tag.objects.bulk_create([Tag(name=name) for name in new_names], batch_size=self.batch_size)
+                tag_ids.update(Tag.objects.filter(name__in=new_names).values_list('name', 'id'))
+
+            through.objects.bulk_create(
+                [
+                    through(product_id=pid, tag_id=tag_id)
+                    for pid, tag_id in zip(links['id'], links['tags'].map(tag_ids))
+                ],
+                batch_size=self.batch_size,
+            )
+        product_ids = np.concatenate(loaded) if loaded else np.array([], dtype=np.int64)
+        self.report("products", len(product_ids), started)
+        self.stdout.write(f"{len(tag_ids)} tags loaded.")
+        return product_ids
+
+    def load_interactions(self, path, user_ids, product_ids):
+        self.stdout.write("Loading interactions...")
+        started = time.perf_counter()
+        count = skipped = 0
+        for chunk in self.read_chunks(path):
+            chunk['user_id'] = chunk['username'].map(user_ids)
+            known = chunk['user_id'].notna() & np.isin(chunk['product_id'].to_numpy(), product_ids)
+            skipped += int((~known).sum())
+            chunk = chunk[known]
+
+            interactions = [
+                Interaction(user_id=int(user_id), product_id=product_id, action=action, rating=rating)
+                for user_id, product_id, action, rating in chunk[
+                    ['user_id', 'product_id', 'action', 'rating']
+                ].itertuples(index=False)
+            ]
+            Interaction.objects.bulk_create(interactions, batch_size=self.batch_size, ignore_conflicts=True)
+            count += len(interactions)
+        if skipped:
+            self.stderr.write(f"Skipped {skipped} interactions with an unknown user or product.")
+        self.report("interactions", count, started)
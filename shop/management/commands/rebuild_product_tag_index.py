@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.recommender import content
+
+
+class Command(BaseCommand):
+    help = 'Builds and publishes a new version of the product-tag index (and its LSH table, if enabled).'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        content.rebuild_product_tag_matrix()
+        matrix = content.get_product_tag_matrix()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Published {content.TAG_ENCODING} index: {len(matrix)} products, {matrix.nnz} tags set, "
+            f"in {elapsed:.1f}s ({content.product_tag_index_root()})."
+        ))
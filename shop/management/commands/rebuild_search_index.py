@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop import search
+
+
+class Command(BaseCommand):
+    help = 'Builds and publishes a new version of the product search index.'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        search.rebuild_search_index()
+        index = search.get_search_index()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Published search index: {len(index)} products, {len(index.vocabulary)} terms, "
+            f"{len(index.rows)} postings, in {elapsed:.1f}s ({search.search_index_root()})."
+        ))
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.recommender import trending
+
+
+class Command(BaseCommand):
+    help = (
+        'Refills the trending products\' time buckets from the interaction rollups and the raw '
+        'interactions since, e.g. after a bulk load, and caches the new trending list.'
+    )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        trending_ids = trending.rebuild_trending()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt the trending buckets in {time.perf_counter() - start:.1f}s; "
+            f"top products: {', '.join(map(str, trending_ids[:10])) or 'none'}."
+        ))
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from shop import rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Folds new interactions into the per-day and per-user stats tables, then deletes '
+        'rolled-up VIEW rows older than the retention period. Safe to run repeatedly (e.g. from cron).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=None,
+                            help='Keep raw VIEW rows this many days (default: INTERACTION_VIEW_RETENTION_DAYS).')
+        parser.add_argument('--no-prune', action='store_true', help='Only roll up; delete nothing.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows deleted per DELETE statement.')
+        parser.add_argument('--window-hours', type=float, default=None,
+                            help='Hours of interactions folded per transaction (default: INTERACTION_ROLLUP_WINDOW_HOURS).')
+        parser.add_argument('--chunk-size', type=int, default=20000, help='Rows fetched per round trip while rolling up.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        folded = rollups.rollup_interactions(
+            window_hours=options['window_hours'], chunk_size=options['chunk_size']
+        )
+        self.stdout.write(
+            f"Rolled up {folded} interactions up to {timezone.localtime(rollups.checkpoint()):%Y-%m-%d %H:%M:%S %Z} "
+            f"in {time.perf_counter() - start:.1f}s."
+        )
+        if options['no_prune']:
+            return
+        start = time.perf_counter()
+        deleted = rollups.prune_views(options['retention_days'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted} rolled-up views in {time.perf_counter() - start:.1f}s."
+        ))
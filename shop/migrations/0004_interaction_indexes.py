@@ -0,0 +1,25 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_product_image_alter_product_description'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='interaction',
+            index=models.Index(fields=['user', 'action', 'created_at'], name='interaction_user_action_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interaction',
+            index=models.Index(fields=['action', 'created_at'], name='interaction_action_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interaction',
+            index=models.Index(fields=['created_at'], name='interaction_created_idx'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0004_interaction_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCheckpoint',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('rolled_up_to', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserProductStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('last_viewed', models.DateTimeField(blank=True, null=True)),
+                ('last_seen', models.DateTimeField()),
+                ('max_rating', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_stats', to='shop.product')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='product_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProductDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('likes', models.PositiveIntegerField(default=0)),
+                ('purchases', models.PositiveIntegerField(default=0)),
+                ('last_seen', models.DateTimeField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='shop.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day'], name='product_daily_stats_day_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productdailystats',
+            constraint=models.UniqueConstraint(fields=('product', 'day'), name='unique_product_day'),
+        ),
+        migrations.AddConstraint(
+            model_name='userproductstats',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='unique_user_product_stats'),
+        ),
+    ]
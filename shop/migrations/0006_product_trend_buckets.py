@@ -0,0 +1,30 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_interaction_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductTrendBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.BigIntegerField()),
+                ('weight', models.FloatField(default=0.0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trend_buckets', to='shop.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket'], name='product_trend_bucket_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='producttrendbucket',
+            constraint=models.UniqueConstraint(fields=('product', 'bucket'), name='unique_product_trend_bucket'),
+        ),
+    ]
@@ -41,10 +41,99 @@ class Interaction(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
+        # Only the admin relies on this; hot-path queries call .order_by() to skip the sort.
         ordering = ['-created_at']
         constraints = [
             models.UniqueConstraint(fields=['user', 'product', 'action'], name='unique_user_product_action')
         ]
+        # Checked by `manage.py check_query_plans`. The unique constraint's index
+        # already serves a user's product IDs (and is covering for them).
+        indexes = [
+            # A user's interactions, optionally narrowed to some actions, newest first.
+            models.Index(fields=['user', 'action', 'created_at'], name='interaction_user_action_idx'),
+            # The admin changelist, newest first, optionally filtered by action and/or date.
+            models.Index(fields=['action', 'created_at'], name='interaction_action_date_idx'),
+            models.Index(fields=['created_at'], name='interaction_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.action} - {self.product.name}"
+
+
+class ProductDailyStats(models.Model):
+    """
+    Interactions with a product per day, folded from ``Interaction`` by
+    ``manage.py rollup_interactions``. Counts are of rolled-up rows: a view
+    is counted each time a user's (upserted) VIEW row is refreshed.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_stats')
+    day = models.DateField()
+    views = models.PositiveIntegerField(default=0)
+    likes = models.PositiveIntegerField(default=0)
+    purchases = models.PositiveIntegerField(default=0)
+    last_seen = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'day'], name='unique_product_day')
+        ]
+        indexes = [
+            models.Index(fields=['day'], name='product_daily_stats_day_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product.name} - {self.day}"
+
+
+class UserProductStats(models.Model):
+    """
+    One user's interactions with one product, folded from ``Interaction`` by
+    ``manage.py rollup_interactions``. Raw VIEW rows are pruned once rolled up
+    (see INTERACTION_VIEW_RETENTION_DAYS), so this is where old views live on.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='product_stats')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='user_stats')
+    views = models.PositiveIntegerField(default=0)
+    last_viewed = models.DateTimeField(null=True, blank=True)
+    last_seen = models.DateTimeField()
+    max_rating = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='unique_user_product_stats')
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.product.name}"
+
+
+class RollupCheckpoint(models.Model):
+    """How far (by ``Interaction.created_at``) a rollup has folded the raw rows."""
+    name = models.CharField(max_length=50, primary_key=True)
+    rolled_up_to = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} @ {self.rolled_up_to}"
+
+
+class ProductTrendBucket(models.Model):
+    """
+    The weighted interactions with a product during one TRENDING_BUCKET_MINUTES
+    time bucket, added to as they happen (see ``shop.recommender.trending``).
+    ``bucket`` is the bucket's start as a Unix timestamp, so the decay can be
+    applied to a plain numeric column.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='trend_buckets')
+    bucket = models.BigIntegerField()
+    weight = models.FloatField(default=0.0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'bucket'], name='unique_product_trend_bucket')
+        ]
+        indexes = [
+            models.Index(fields=['bucket'], name='product_trend_bucket_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.user.username} - {self.action} - {self.product.name}"
\ No newline at end of file
+        return f"{self.product.name} @ {self.bucket}"
@@ -0,0 +1,210 @@
+from itertools import chain
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+from shop import rollups
+from shop.models import Interaction
+from .content import interaction_weights
+from .neighbors import NeighborTable, open_table
+
+NEIGHBOR_TABLE_FILENAME = 'collaborative_neighbors.npy'
+
+
+def neighbor_table_path():
+    """Location of the item-item table written by ``manage.py build_similar_products --engine collaborative``."""
+    return Path(settings.RECOMMENDER_DATA_DIR) / NEIGHBOR_TABLE_FILENAME
+
+
+class ItemUserMatrix:
+    """
+    A weighted item-user matrix built from the ``Interaction`` table.
+
+    Entries are kept twice, in CSR order by item (``item_indptr``/``item_users``/
+    ``item_weights``) and by user (``user_indptr``/``user_items``/``user_weights``),
+    so co-occurrences can be expanded item -> users -> items without a Python loop.
+    Items and users are addressed by their position in the sorted ``item_ids`` and
+    ``user_ids`` arrays.
+    """
+
+    def __init__(self, item_ids, user_ids, rows, columns, weights):
+        self.item_ids = item_ids
+        self.user_ids = user_ids
+        self.item_indptr, self.item_users, self.item_weights = _compress(rows, columns, weights, len(item_ids))
+        self.user_indptr, self.user_items, self.user_weights = _compress(columns, rows, weights, len(user_ids))
+        # Reciprocal row norms; every item row has at least one entry.
+        norms = np.sqrt(np.bincount(rows, weights=weights.astype(np.float64) ** 2, minlength=len(item_ids)))
+        self.inv_norms = np.zeros(len(item_ids), dtype=np.float32)
+        np.divide(1.0, norms, out=self.inv_norms, where=norms > 0, casting='unsafe')
+
+    @classmethod
+    def from_db(cls, chunk_size: int = 20000):
+        """
+        Builds the matrix in bulk from ``Interaction``.
+
+        Each action is streamed with its own numeric ``values_list`` query and
+        weighted by RECOMMENDER_ACTION_WEIGHTS, scaled by ``1 + rating / 5``; a
+        user's weights for the same product are summed across actions.
+        """
+        product_ids, user_ids, weights = [], [], []
+        for action, action_weight in settings.RECOMMENDER_ACTION_WEIGHTS.items():
+            if action == Interaction.Action.VIEW:
+                # Old views may have been pruned into UserProductStats.
+                triples = rollups.view_triples(chunk_size)
+            else:
+                rows = (
+                    Interaction.objects.filter(action=action)
+                    .order_by()
+                    .values_list('product_id', 'user_id', 'rating')
+                )
+                triples = np.fromiter(
+                    chain.from_iterable(rows.iterator(chunk_size=chunk_size)),
+                    dtype=np.int64,
+                ).reshape(-1, 3)
+            product_ids.append(triples[:, 0])
+            user_ids.append(triples[:, 1])
+            weights.append(action_weight * (1 + triples[:, 2] / 5))
+
+        product_ids, user_ids = np.concatenate(product_ids), np.concatenate(user_ids)
+        weights = np.concatenate(weights).astype(np.float32)
+
+        item_ids, rows = np.unique(product_ids, return_inverse=True)
+        user_ids, columns = np.unique(user_ids, return_inverse=True)
+        # Merge repeated (item, user) pairs into one entry.
+        n_users = max(1, len(user_ids))
+        keys, inverse = np.unique(rows * n_users + columns, return_inverse=True)
+        weights = np.bincount(inverse, weights=weights, minlength=len(keys)).astype(np.float32)
+        rows, columns = np.divmod(keys, n_users)
+        return cls(item_ids, user_ids, rows, columns, weights)
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    @property
+    def nnz(self):
+        return len(self.item_users)
+
+    def expansion_costs(self):
+        """Number of (item, co-interacted item) pairs each item row expands into."""
+        user_degrees = np.diff(self.user_indptr)
+        item_of_entry = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.item_indptr))
+        return np.bincount(item_of_entry, weights=user_degrees[self.item_users], minlength=len(self)).astype(np.int64)
+
+    def co_occurrences(self, start: int, end: int):
+        """
+        Returns the weighted co-occurrence dot products of items ``start:end``
+        with every item sharing at least one user with them.
+
+        Returns:
+            A ``(rows, columns, dots)`` triple: the local row (0-based within the
+            block), the co-occurring item position and their dot product.
+        """
+        lo, hi = self.item_indptr[start], self.item_indptr[end]
+        users, user_weights = self.item_users[lo:hi], self.item_weights[lo:hi]
+        local_rows = np.repeat(np.arange(end - start, dtype=np.int64), np.diff(self.item_indptr[start:end + 1]))
+
+        starts, lengths = self.user_indptr[users], np.diff(self.user_indptr)[users]
+        offsets = _range_offsets(starts, lengths)
+        pair_rows = np.repeat(local_rows, lengths)
+        pair_weights = np.repeat(user_weights, lengths) * self.user_weights[offsets]
+
+        keys, inverse = np.unique(pair_rows * len(self) + self.user_items[offsets], return_inverse=True)
+        dots = np.bincount(inverse, weights=pair_weights, minlength=len(keys))
+        rows, columns = np.divmod(keys, len(self))
+        return rows, columns, dots
+
+
+def _compress(rows, columns, weights, n_rows):
+    """Sorts (row, column, weight) entries into CSR ``(indptr, columns, weights)`` arrays."""
+    order = np.lexsort((columns, rows))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, columns[order].astype(np.int64), weights[order]
+
+
+def _range_offsets(starts, lengths):
+    """Concatenates ``range(start, start + length)`` for every pair, without a Python loop."""
+    return np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+
+def build_neighbor_table(matrix: ItemUserMatrix, k: int, max_block_elements: int = 1 << 24, progress=None):
+    """
+    Computes every item's top ``k`` neighbors by cosine similarity of their
+    interaction columns.
+
+    Items are processed in blocks whose co-occurrence expansion stays under
+    ``max_block_elements`` pairs (a single item may exceed it on its own), so
+    peak memory is bounded however many interactions there are. ``progress``,
+    if given, is called with the number of items done after each block.
+    """
+    n_items = len(matrix)
+    table = np.full((n_items, k + 1), -1, dtype=np.int64)
+    table[:, 0] = matrix.item_ids
+
+    cumulative_costs = np.cumsum(matrix.expansion_costs())
+    start = 0
+    while start < n_items:
+        budget = (cumulative_costs[start - 1] if start else 0) + max_block_elements
+        end = max(start + 1, int(np.searchsorted(cumulative_costs, budget, side='right')))
+
+        rows, columns, dots = matrix.co_occurrences(start, end)
+        scores = dots * matrix.inv_norms[start + rows] * matrix.inv_norms[columns]
+        not_self = columns != start + rows
+        rows, columns, scores = rows[not_self], columns[not_self], scores[not_self]
+
+        # Group by row, best score first, and keep each row's first k entries.
+        order = np.lexsort((-scores, rows))
+        rows, columns = rows[order], columns[order]
+        group_starts = np.searchsorted(rows, np.arange(end - start))
+        ranks = np.arange(len(rows)) - group_starts[rows]
+        keep = ranks < k
+        table[start + rows[keep], 1 + ranks[keep]] = matrix.item_ids[columns[keep]]
+
+        start = end
+        if progress is not None:
+            progress(end)
+
+    return NeighborTable(table)
+
+
+def similar_product_ids(product_id: int, k: int = 5):
+    """
+    Returns up to k products most often interacted with by the same users,
+    most similar first. Products missing from the built table have none.
+    """
+    table = open_table(neighbor_table_path())
+    if table is None:
+        return []
+    return table.lookup(product_id, min(k, table.k)) or []
+
+
+def recommended_product_ids(user, k: int = 5):
+    """
+    Item-based collaborative filtering: every product the user has interacted
+    with votes for its neighbors with the interaction's weight (see
+    ``content.interaction_weights``), discounted by the neighbor's rank.
+    Products the user has already interacted with are excluded.
+    """
+    table = open_table(neighbor_table_path())
+    if table is None:
+        return []
+    product_ids, weights = interaction_weights(user.pk)
+    if not len(product_ids):
+        return []
+
+    table_ids = table.table[:, 0]
+    rows = np.searchsorted(table_ids, product_ids)
+    known = rows < len(table_ids)
+    known[known] = table_ids[rows[known]] == product_ids[known]
+    if not known.any():
+        return []
+
+    neighbors = np.asarray(table.table[rows[known], 1:])
+    votes = weights[known, None] / np.arange(1, table.k + 1, dtype=np.float32)
+    valid = (neighbors >= 0) & ~np.isin(neighbors, product_ids)
+    candidates, inverse = np.unique(neighbors[valid], return_inverse=True)
+    scores = np.bincount(inverse, weights=votes[valid], minlength=len(candidates))
+
+    best = np.argsort(-scores, kind='stable')[:k]
+    return candidates[best].tolist()
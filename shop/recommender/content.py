@@ -1,132 +1,469 @@
-import pandas as pd
+import logging
+import threading
+import time
+from functools import partial
+from pathlib import Path
+
 import numpy as np
+from django.conf import settings
 from django.core.cache import cache
-from shop.models import Product, Tag, Interaction
+from django.db import connection
+from shop import rollups
+from shop.models import Product, Interaction
+from .index import (
+    BitPackedTagIndex, FileLock, MinHashTagIndex, ProductTagIndex, current_version, load_version, publish_index,
+    read_state, state_revision, write_state,
+)
+from .neighbors import open_table
+from .py_similarity import minhash_similarity_top_k
+
+logger = logging.getLogger(__name__)
 
 # --- Try to import the compiled Cython module, with a fallback to pure Python ---
 try:
-    from .cy_similarity import cosine_similarity_top_k
+    from .cy_similarity import cosine_similarity_top_k, cosine_similarity_top_k_batch, popcount_similarity_top_k
     print("INFO: Cython `cy_similarity` module loaded successfully.")
     SIMILARITY_FUNCTION = cosine_similarity_top_k
+    SIMILARITY_BATCH_FUNCTION = cosine_similarity_top_k_batch
 except ImportError:
-    from .py_similarity import cosine_similarity_top_k
+    from .py_similarity import cosine_similarity_top_k, cosine_similarity_top_k_batch, popcount_similarity_top_k
     print("WARNING: Could not load Cython module. Falling back to pure Python `py_similarity`.")
     SIMILARITY_FUNCTION = cosine_similarity_top_k
+    SIMILARITY_BATCH_FUNCTION = cosine_similarity_top_k_batch
+
+# 'sparse' keeps rows as CSR tag lists; 'bitset' also packs them into uint64
+# words and scores with popcounts, which suits smaller tag vocabularies;
+# 'minhash' adds an LSH table and only re-ranks the rows sharing a bucket with
+# the query, an approximate search for very large catalogs.
+TAG_ENCODING = settings.RECOMMENDER_TAG_ENCODING
+TAG_INDEX_OPTIONS = {}
+if TAG_ENCODING == 'bitset':
+    TAG_INDEX_CLASS = BitPackedTagIndex
+    SIMILARITY_FUNCTION = popcount_similarity_top_k
+elif TAG_ENCODING == 'minhash':
+    TAG_INDEX_CLASS = MinHashTagIndex
+    TAG_INDEX_OPTIONS = {
+        'n_bands': settings.RECOMMENDER_MINHASH_BANDS,
+        'band_rows': settings.RECOMMENDER_MINHASH_BAND_ROWS,
+    }
+    # The LSH layout is part of the artifact name, so changing it forces a rebuild.
+    TAG_ENCODING = f"minhash{TAG_INDEX_OPTIONS['n_bands']}x{TAG_INDEX_OPTIONS['band_rows']}"
+    SIMILARITY_FUNCTION = partial(
+        minhash_similarity_top_k,
+        probe_bands=settings.RECOMMENDER_MINHASH_PROBE_BANDS,
+        exact_function=SIMILARITY_FUNCTION,
+    )
+else:
+    TAG_INDEX_CLASS = ProductTagIndex
+
+
+PRODUCT_TAG_MATRIX_KEY = f'product_tag_matrix:{TAG_ENCODING}:v{ProductTagIndex.FORMAT_VERSION}'
+PRODUCT_TAG_MATRIX_TIMEOUT = 3600  # Hard expiry: cache for 1 hour
+PRODUCT_TAG_MATRIX_REFRESH_AFTER = 2700  # Start a background rebuild after 45 minutes
+REBUILD_LOCK_FILENAME = 'rebuild.lock'
+OVERLAY_LOCK_FILENAME = 'overlay.lock'
+OVERLAY_FILENAME = 'overlay.pickle'
+
+
+def product_tag_index_root():
+    """Directory holding the published, memory-mappable versions of the index."""
+    return Path(settings.RECOMMENDER_DATA_DIR) / f'product_tag_index_{TAG_ENCODING}_v{ProductTagIndex.FORMAT_VERSION}'
 
 
 def get_product_tag_matrix():
     """
-    Builds and caches a binary product-tag matrix.
-    Rows are product IDs, columns are tag IDs.
+    Builds and caches a sparse binary product-tag index.
+    Rows are products, columns are tag IDs.
+
+    The index itself lives on disk as versioned ``.npy`` files that every
+    worker memory-maps read-only, so all processes share one copy through the
+    OS page cache. The cache only holds the current version name and its
+    refresh deadline; a worker re-maps when it sees a version it has not
+    opened yet. Once the version is due for refresh, a single worker (holding
+    the rebuild lease) rebuilds it in a background thread while every request
+    keeps being served from the current version. Tag edits made since the
+    build live in a small overlay (see ``get_tag_overlay``) that queries
+    consult and the next build absorbs.
+
+    Returns:
+        The current ``ProductTagIndex``; its sorted ``product_ids`` array maps
+        rows to product IDs (and back, via ``position``/``positions``).
+    """
+    artifact = cache.get(PRODUCT_TAG_MATRIX_KEY)
+    if artifact is None:
+        artifact = _adopt_or_build()
+    elif time.time() >= artifact['refresh_at']:
+        _start_background_rebuild()
+
+    return _map_version(artifact['version'])
+
+
+_mapped_index = (None, None)  # (version, index) currently mapped by this process
+_map_lock = threading.Lock()
+
+
+def _map_version(version):
+    """Returns this process's read-only mapping of ``version``, opening it on first use."""
+    global _mapped_index
+    mapped_version, matrix = _mapped_index
+    if mapped_version != version:
+        with _map_lock:
+            mapped_version, matrix = _mapped_index
+            if mapped_version != version:
+                matrix, _ = load_version(product_tag_index_root(), version)
+                _mapped_index = (version, matrix)
+    return matrix
+
+
+def _adopt_or_build():
+    """
+    On a cache miss, adopts the version already published on disk (e.g. after
+    a restart or cache flush) instead of rebuilding; builds only if there is none.
     """
-    matrix = cache.get('product_tag_matrix')
-    product_map = cache.get('product_map') # Maps matrix index to product ID
-    if matrix is not None and product_map is not None:
-        return matrix, product_map
+    version = current_version(product_tag_index_root())
+    if version is None:
+        return _build_on_miss()
+    return _adopt(version)
+
 
-    products = Product.objects.all().prefetch_related('tags')
-    tags = Tag.objects.all()
+def _adopt(version):
+    _, meta = load_version(product_tag_index_root(), version)
+    artifact = {'version': version, 'refresh_at': meta['built_at'] + PRODUCT_TAG_MATRIX_REFRESH_AFTER}
+    cache.add(PRODUCT_TAG_MATRIX_KEY, artifact, timeout=PRODUCT_TAG_MATRIX_TIMEOUT)
+    return cache.get(PRODUCT_TAG_MATRIX_KEY) or artifact
 
-    if not products or not tags:
-        return np.array([]), {}
 
-    # Create mapping from ID to matrix index
-    product_map = {p.id: i for i, p in enumerate(products)}
-    tag_map = {t.id: i for i, t in enumerate(tags)}
+def _rebuild_lease():
+    """The rebuild lease: a file lock next to ``CURRENT``, so it is shared by every worker on the host."""
+    return FileLock(product_tag_index_root() / REBUILD_LOCK_FILENAME)
 
-    # Initialize a zero matrix
-    matrix = np.zeros((len(products), len(tags)), dtype=np.int8)
 
-    # Populate the matrix
-    for prod_idx, product in enumerate(products):
-        for tag in product.tags.all():
-            tag_idx = tag_map[tag.id]
-            matrix[prod_idx, tag_idx] = 1
+def _rebuild():
+    """
+    Builds the index from the database and publishes it as a new version, then
+    drops the overlay entries it has absorbed: those unchanged since the build
+    started. Later edits stay in the overlay until the next build.
+    """
+    stamps_before = dict(_read_overlay()['stamps'])
+    version = publish_index(TAG_INDEX_CLASS.from_db(**TAG_INDEX_OPTIONS), product_tag_index_root())
+    artifact = {'version': version, 'refresh_at': time.time() + PRODUCT_TAG_MATRIX_REFRESH_AFTER}
+    cache.set(PRODUCT_TAG_MATRIX_KEY, artifact, timeout=PRODUCT_TAG_MATRIX_TIMEOUT)
+    with _overlay_lock():
+        overlay = _read_overlay()
+        for product_id, stamp in stamps_before.items():
+            if overlay['stamps'].get(product_id) == stamp:
+                del overlay['stamps'][product_id]
+                del overlay['rows'][product_id]
+        write_state(_overlay_path(), overlay)
+    return artifact
+
+
+def _build_on_miss():
+    """
+    Cold start: one worker builds while the others wait on its lease, then
+    adopt the version it published. A builder that dies drops the lease with
+    it, and the next waiter in line builds instead.
+    """
+    with _rebuild_lease():
+        version = current_version(product_tag_index_root())
+        if version is not None:
+            return _adopt(version)
+        return _rebuild()
 
-    cache.set('product_tag_matrix', matrix, timeout=3600)  # Cache for 1 hour
-    cache.set('product_map', product_map, timeout=3600)
-    
-    return matrix, product_map
 
+def _start_background_rebuild():
+    lease = _rebuild_lease()
+    if not lease.acquire(blocking=False):
+        return  # Another worker is already rebuilding.
 
-def similar_products(product_id: int, k: int = 5):
+    def run():
+        try:
+            _rebuild()
+        except Exception:
+            logger.exception("Background rebuild of the product-tag index failed.")
+        finally:
+            lease.release()
+            connection.close()
+
+    threading.Thread(target=run, name='product-tag-matrix-rebuild', daemon=True).start()
+
+
+def _overlay_lock():
+    return FileLock(product_tag_index_root() / OVERLAY_LOCK_FILENAME)
+
+
+def _overlay_path():
+    # Next to CURRENT rather than in the cache, which may cull it.
+    return product_tag_index_root() / OVERLAY_FILENAME
+
+
+def _read_overlay():
+    return read_state(_overlay_path())[1] or {'stamps': {}, 'rows': {}}
+
+
+_overlay = (None, {})  # (revision, rows) of the overlay this process last read
+
+
+def get_tag_overlay():
+    """
+    Returns the tag edits made since the index was built, as ``{product_id:
+    tag_ids}``: a sorted int32 array of the product's current tags, or None
+    for a deleted product. Queries let these rows override the index's.
+
+    Every call stats the overlay file, and reads it only once it changed.
+    """
+    global _overlay
+    if state_revision(_overlay_path()) != _overlay[0]:
+        revision, overlay = read_state(_overlay_path())
+        _overlay = (revision, overlay['rows'] if overlay else {})
+    return _overlay[1]
+
+
+def _update_overlay(product_id: int, tag_ids):
+    """
+    Records a product's current tags in the overlay. Writers are serialized by
+    a file lock, so concurrent edits never drop each other; once the overlay
+    reaches RECOMMENDER_TAG_OVERLAY_LIMIT products a background rebuild merges it.
+    """
+    with _overlay_lock():
+        if tag_ids is not None:
+            tag_ids = np.unique(np.fromiter(tag_ids, dtype=np.int32))
+        overlay = _read_overlay()
+        overlay['stamps'][product_id] = time.time_ns()
+        overlay['rows'][product_id] = tag_ids
+        write_state(_overlay_path(), overlay)
+    if len(overlay['rows']) >= settings.RECOMMENDER_TAG_OVERLAY_LIMIT:
+        _start_background_rebuild()
+
+
+def refresh_product_tags(product_id: int):
+    """Re-reads one product's tags into the overlay; the next build folds them into the index."""
+    # The queryset is lazy, so the tags are read under the overlay lock.
+    _update_overlay(product_id, Product.tags.through.objects.filter(product_id=product_id).values_list('tag_id', flat=True))
+
+
+def remove_product(product_id: int):
+    """Marks a deleted product in the overlay, so queries stop returning it."""
+    _update_overlay(product_id, None)
+
+
+def rebuild_product_tag_matrix():
+    """
+    Rebuilds and publishes the index right away, e.g. after a bulk import that
+    bypassed the model signals which normally keep it up to date.
     """
-    Finds the top k most similar products to a given product.
-    
+    with _rebuild_lease():
+        _rebuild()
+
+
+def invalidate_product_tag_matrix():
+    """
+    Marks the cached index as due for a rebuild. It keeps being served until
+    the background rebuild publishes its replacement.
+    """
+    artifact = cache.get(PRODUCT_TAG_MATRIX_KEY)
+    if artifact is None:
+        return
+    artifact['refresh_at'] = 0
+    cache.set(PRODUCT_TAG_MATRIX_KEY, artifact, timeout=PRODUCT_TAG_MATRIX_TIMEOUT)
+
+
+NEIGHBOR_TABLE_FILENAME = 'content_neighbors.npy'
+
+
+def neighbor_table_path():
+    """Location of the precomputed table written by ``manage.py build_similar_products``."""
+    return Path(settings.RECOMMENDER_DATA_DIR) / NEIGHBOR_TABLE_FILENAME
+
+
+def similar_product_ids(product_id: int, k: int = 5):
+    """
+    Finds the top k most similar products to a given product, by tag overlap.
+
+    Neighbors are read from the precomputed neighbor table when it covers the
+    product; otherwise they are computed live against the product-tag index.
+
     Args:
         product_id (int): The ID of the product to find similar items for.
         k (int): The number of similar products to return.
-        
+
     Returns:
-        A Django QuerySet of Product objects.
+        A list of up to k product IDs, most similar first.
     """
-    matrix, product_map = get_product_tag_matrix()
+    overlay = get_tag_overlay()
+    if product_id not in overlay:
+        table = open_table(neighbor_table_path())
+        if table is not None:
+            neighbor_ids = table.lookup(product_id, k)
+            if neighbor_ids is not None:
+                return neighbor_ids
+
+    matrix = get_product_tag_matrix()
 
-    if not product_map or product_id not in product_map:
-        return Product.objects.none()
+    # Get the product's tags: edited ones from the overlay, the rest from the index
+    if product_id in overlay:
+        tag_ids = overlay[product_id]
+        if tag_ids is None:
+            return []  # Deleted
+    else:
+        product_idx = matrix.position(product_id)
+        if product_idx is None:
+            return []
+        tag_ids = matrix.row_indices(product_idx)
 
-    # Get the index for the given product_id
-    product_idx = product_map.get(product_id)
-    if product_idx is None:
-        return Product.objects.none()
-        
     # Get the target vector for the product
-    target_vector = matrix[product_idx, :].reshape(1, -1)
-    
+    target_vector = np.zeros((1, max(matrix.n_features, int(tag_ids.max(initial=-1)) + 1)), dtype=np.float32)
+    target_vector[0, tag_ids] = 1.0
+
     # Compute similarity against all other products
     # We ask for k+1 because the most similar item will be the product itself.
-    similar_indices = SIMILARITY_FUNCTION(matrix, target_vector, k=k + 1)
-    
-    # Get the product IDs from the matrix indices, excluding the first one (itself)
-    inverse_product_map = {v: k for k, v in product_map.items()}
-    similar_product_ids = [inverse_product_map[i] for i in similar_indices if i != product_idx][:k]
+    similar_ids = _top_k_product_ids(matrix, overlay, target_vector, k=k + 1)
+    return similar_ids[similar_ids != product_id][:k].tolist()
+
+
+def _top_k_product_ids(matrix, overlay, vector: np.ndarray, k: int):
+    """
+    Runs SIMILARITY_FUNCTION over the index with the overlay's rows patched in:
+    the index's candidates are widened by the overlay's size, overlaid products
+    are dropped from them, and the survivors and the overlay's live rows are
+    re-ranked together by cosine score. Without an overlay this is the plain kernel.
+    Either way only products scoring above 0 (sharing a tag) are returned.
+
+    Returns:
+        np.ndarray: Up to k product IDs, most similar first.
+    """
+    if not overlay:
+        return matrix.product_ids[SIMILARITY_FUNCTION(matrix, vector[:, :matrix.n_features], k=k)]
+
+    rows = SIMILARITY_FUNCTION(matrix, vector[:, :matrix.n_features], k=k + len(overlay))
+    rows = rows[~np.isin(matrix.product_ids[rows], np.fromiter(overlay, dtype=np.int64))]
+    flat = vector.ravel()
+    tag_columns, lengths = matrix.gather_rows(rows)
+    scores = np.bincount(
+        np.repeat(np.arange(len(rows)), lengths), weights=flat[tag_columns], minlength=len(rows)
+    ) * matrix.inv_norms[rows]
+
+    overlay_ids = [product_id for product_id, tag_ids in overlay.items() if tag_ids is not None and len(tag_ids)]
+    overlay_scores = [
+        flat[tag_ids[tag_ids < len(flat)]].sum() / np.sqrt(len(tag_ids))
+        for tag_ids in (overlay[product_id] for product_id in overlay_ids)
+    ]
+    candidate_ids = np.concatenate((matrix.product_ids[rows], np.array(overlay_ids, dtype=np.int64)))
+    scores = np.concatenate((scores, np.array(overlay_scores, dtype=np.float64)))
+    top = np.argsort(-scores, kind='stable')[:k]
+    return candidate_ids[top[scores[top] > 0]]
+
 
-    return Product.objects.filter(id__in=similar_product_ids)
+USER_RECOMMENDATIONS_KEY = 'user_recommendations:{user_id}'
+USER_PROFILE_KEY = 'user_profile:{user_id}'
 
 
-def recommendations_for_user(user, k: int = 5):
+def invalidate_user_recommendations(*user_ids: int):
+    """Drops users' cached recommendations and profiles, e.g. after their interactions change."""
+    cache.delete_many(
+        [USER_RECOMMENDATIONS_KEY.format(user_id=user_id) for user_id in user_ids]
+        + [USER_PROFILE_KEY.format(user_id=user_id) for user_id in user_ids]
+    )
+
+
+def interaction_weights(user_id: int):
+    """
+    Reads all of a user's interactions with one ``values_list`` query, plus
+    (once ``manage.py rollup_interactions`` has run) one for their rolled-up
+    views, which may since have been pruned from the raw table.
+
+    Each interaction is weighted by its action's weight (RECOMMENDER_ACTION_WEIGHTS),
+    scaled by ``1 + rating / 5`` and halved every RECOMMENDER_PROFILE_HALF_LIFE_DAYS
+    days of age. A product's views count once, as of its latest view.
+
+    Returns:
+        A ``(product_ids, weights)`` pair of int64 and float32 arrays, one entry
+        per interaction (a product may appear once per action).
+    """
+    interactions = list(
+        Interaction.objects.filter(user_id=user_id).order_by().values_list('product_id', 'action', 'rating', 'created_at')
+    )
+    views = {product_id: (0, last_viewed) for product_id, last_viewed in rollups.user_views(user_id).items()}
+    if views:
+        # A view both rolled up and still in the raw table counts once, as of its latest time.
+        for product_id, action, rating, created_at in interactions:
+            if action == Interaction.Action.VIEW and created_at >= views.get(product_id, (0, created_at))[1]:
+                views[product_id] = (rating, created_at)
+        interactions = [row for row in interactions if row[1] != Interaction.Action.VIEW]
+        interactions += [
+            (product_id, Interaction.Action.VIEW, rating, created_at) for product_id, (rating, created_at) in views.items()
+        ]
+    if not interactions:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+    product_ids, actions, ratings, created_at = zip(*interactions)
+    action_weights = settings.RECOMMENDER_ACTION_WEIGHTS
+    weights = np.array([action_weights.get(action, 0.0) for action in actions], dtype=np.float32)
+    weights *= 1 + np.array(ratings, dtype=np.float32) / 5
+    age_days = (time.time() - np.array([ts.timestamp() for ts in created_at])) / 86400
+    weights *= np.exp2(-np.maximum(age_days, 0) / settings.RECOMMENDER_PROFILE_HALF_LIFE_DAYS).astype(np.float32)
+    return np.array(product_ids, dtype=np.int64), weights
+
+
+def user_profile(user_id: int, matrix, overlay):
+    """
+    Builds a user's tag preference profile from all of their interactions.
+
+    Every interacted product contributes its tags at the interaction's weight
+    (see ``interaction_weights``); all product rows are gathered in one
+    vectorized step, and products edited since the index was built take their
+    tags from ``overlay``. The sparse result is cached alongside the recommendations.
+
+    Returns:
+        A ``(columns, weights, interacted_ids)`` tuple: the profile's non-zero tag
+        columns, their float32 weights, and the IDs of every product the user
+        has interacted with.
+    """
+    key = USER_PROFILE_KEY.format(user_id=user_id)
+    profile = cache.get(key)
+    if profile is not None:
+        return profile
+
+    product_ids, weights = interaction_weights(user_id)
+    overlaid = np.isin(product_ids, np.fromiter(overlay, dtype=np.int64))
+    rows = matrix.positions(product_ids)
+    known = (rows >= 0) & ~overlaid
+    tag_columns, lengths = matrix.gather_rows(rows[known])
+    tag_weights = np.repeat(weights[known], lengths)
+    for product_id, weight in zip(product_ids[overlaid], weights[overlaid]):
+        if overlay[product_id] is not None:
+            tag_columns = np.concatenate((tag_columns, overlay[product_id]))
+            tag_weights = np.concatenate((tag_weights, np.full(len(overlay[product_id]), weight)))
+    dense = np.bincount(tag_columns, weights=tag_weights, minlength=matrix.n_features).astype(np.float32)
+    columns = np.flatnonzero(dense).astype(np.int32)
+
+    profile = (columns, dense[columns], np.unique(product_ids))
+    cache.set(key, profile, timeout=settings.RECOMMENDER_USER_CACHE_TIMEOUT)
+    return profile
+
+
+def recommended_product_ids(user, k: int = 5):
     """
     Generates personalized product recommendations for a logged-in user.
-    It builds a user preference vector based on liked/purchased items.
-    """
-    matrix, product_map = get_product_tag_matrix()
-
-    if matrix.size == 0 or not product_map:
-        return Product.objects.none()
-
-    # Get all products the user has liked or purchased
-    positive_interactions = Interaction.objects.filter(
-        user=user,
-        action__in=[Interaction.Action.LIKE, Interaction.Action.PURCHASE]
-    ).select_related('product')
-
-    positive_interacted_pids = [i.product_id for i in positive_interactions]
-    if not positive_interacted_pids:
-        return Product.objects.none()# No positive interactions, no recommendations
-
-    # Build user preference vector by summing tag vectors of liked/purchased items
-    user_preference_vector = np.zeros(matrix.shape[1], dtype=np.int8)
-    for pid in positive_interacted_pids:
-        if pid in product_map:
-            product_idx = product_map[pid]
-            user_preference_vector += matrix[product_idx, :]
-    
-    # Normalize to a binary vector
-    user_preference_vector = (user_preference_vector > 0).astype(np.int8).reshape(1, -1)
-
-    # Find items similar to the user's aggregated preference
-    similar_indices = SIMILARITY_FUNCTION(matrix, user_preference_vector, k=k + len(positive_interacted_pids))
-
-    # Exclude items the user has already interacted with
-    inverse_product_map = {v: k for k, v in product_map.items()}
-    all_interacted_pids = set(Interaction.objects.filter(user=user).values_list('product_id', flat=True))
-
-    recommended_ids = []
-    for idx in similar_indices:
-        pid = inverse_product_map.get(idx)
-        if pid and pid not in all_interacted_pids:
-            recommended_ids.append(pid)
-        if len(recommended_ids) >= k:
-            break
-
-    return Product.objects.filter(id__in=recommended_ids)
\ No newline at end of file
+    It scores the catalog against the user's weighted, time-decayed tag profile
+    (see ``user_profile``) and returns up to k product IDs, best first.
+    """
+    matrix = get_product_tag_matrix()
+    overlay = get_tag_overlay()
+
+    if matrix.nnz == 0 and not overlay:
+        return []
+
+    columns, weights, interacted_ids = user_profile(user.pk, matrix, overlay)
+    if not len(columns):
+        return []  # No (weighted) interactions, no recommendations
+
+    user_preference_vector = np.zeros((1, max(matrix.n_features, int(columns[-1]) + 1)), dtype=np.float32)
+    user_preference_vector[0, columns] = weights
+
+    # Find items similar to the user's aggregated preference, with room to
+    # drop the ones they have already interacted with
+    candidate_ids = _top_k_product_ids(matrix, overlay, user_preference_vector, k=k + len(interacted_ids))
+    recommended_ids = candidate_ids[~np.isin(candidate_ids, interacted_ids)][:k]
+
+    return recommended_ids.tolist()
@@ -6,76 +6,270 @@
 
 import numpy as np
 cimport numpy as np
+from cython.parallel cimport prange
 from libc.math cimport sqrt
+from libc.stdint cimport uint64_t
+
+from .py_similarity import pack_bits
+
+cdef extern from *:
+    """
+    #if defined(_MSC_VER)
+    #include <intrin.h>
+    #define cy_popcount64(x) ((int)__popcnt64(x))
+    #else
+    #define cy_popcount64(x) __builtin_popcountll(x)
+    #endif
+    """
+    int cy_popcount64(uint64_t x) nogil
 
 # Define the data types for arrays
-ctypedef np.int8_t DTYPE_t
-ctypedef np.float64_t FLOAT_t
+ctypedef np.int64_t INDPTR_t
+ctypedef np.int32_t INDEX_t
+ctypedef np.float32_t VALUE_t
 
 def cosine_similarity_top_k(
-    np.ndarray[DTYPE_t, ndim=2] matrix,
-    np.ndarray[DTYPE_t, ndim=2] vector,
+    matrix,
+    vector,
     int k=5
 ):
     """
     Cython-optimized cosine similarity calculation to find top k items.
-    
+
     This function computes the cosine similarity between a query vector and all
-    rows of a matrix, returning the indices of the top k most similar rows.
+    rows of a sparse binary product-tag index (see ``ProductTagIndex``),
+    returning the indices of the top k most similar rows. Rows scoring 0
+    (sharing no tag with the query) are never returned.
     """
     # --- Variable Declarations ---
-    cdef int n_products = matrix.shape[0]
-    cdef int n_features = matrix.shape[1]
-    
-    # Arrays for results
-    cdef np.ndarray[FLOAT_t, ndim=1] similarities = np.zeros(n_products, dtype=np.float64)
-    
+    cdef const INDPTR_t[::1] indptr = matrix.indptr
+    cdef const INDEX_t[::1] indices = matrix.indices
+    cdef const VALUE_t[::1] inv_norms = matrix.inv_norms
+    cdef const VALUE_t[::1] query = np.ascontiguousarray(vector, dtype=np.float32).ravel()
+    cdef Py_ssize_t n_products = indptr.shape[0] - 1
+    cdef Py_ssize_t n_features = query.shape[0]
+
     # Loop variables
-    cdef int i, j
-    
+    cdef Py_ssize_t i, j, p, size = 0
+    cdef Py_ssize_t top_k = min(k, n_products)
+
     # Calculation variables
     cdef double dot_product
-    cdef double matrix_norm_sq, vector_norm_sq
-    cdef double matrix_norm, vector_norm
-    cdef double sim
+    cdef double vector_norm_sq
+    cdef double vector_norm, inv_vector_norm
+
+    # Results: a size-k min-heap, sorted in place at the end
+    result_scores = np.empty(top_k, dtype=np.float32)
+    result_indices = np.empty(top_k, dtype=np.int64)
+    cdef VALUE_t[::1] heap_scores = result_scores
+    cdef INDPTR_t[::1] heap_indices = result_indices
 
     # --- Pre-calculate the norm of the input vector ---
     vector_norm_sq = 0.0
     for j in range(n_features):
-        vector_norm_sq += vector[0, j] * vector[0, j]
+        vector_norm_sq += query[j] * query[j]
     vector_norm = sqrt(vector_norm_sq)
 
     # If the vector norm is zero, all similarities will be zero, so we can exit early.
-    if vector_norm == 0.0:
-        return np.array([], dtype=np.int32)
+    if vector_norm == 0.0 or top_k == 0:
+        return np.array([], dtype=np.int64)
+    inv_vector_norm = 1.0 / vector_norm
 
     # --- Main Loop: Iterate over each product in the matrix ---
+    # Row norms are precomputed on the index (inv_norms is 0 for untagged rows),
+    # so each row costs one sparse dot product and a multiply.
+    with nogil:
+        for i in range(n_products):
+            # Rows are binary: the dot product gathers the query at the row's tags.
+            dot_product = 0.0
+            for p in range(indptr[i], indptr[i + 1]):
+                dot_product += query[indices[p]]
+
+            if dot_product * inv_norms[i] > 0.0:
+                size = _heap_push(&heap_scores[0], &heap_indices[0], size, top_k,
+                                  <VALUE_t>(dot_product * inv_norms[i] * inv_vector_norm), i)
+
+        # --- Find Top K ---
+        # A bounded heap avoids argpartition, which degrades badly on the many
+        # tied scores that binary tag vectors produce.
+        _heap_sort(&heap_scores[0], &heap_indices[0], size)
+
+    return result_indices[:size]
+
+
+cdef inline void _sift_down(VALUE_t* scores, INDPTR_t* indices, Py_ssize_t size, Py_ssize_t pos) noexcept nogil:
+    """Restores the min-heap property below ``pos`` (smallest score at the root)."""
+    cdef Py_ssize_t child
+    cdef VALUE_t score = scores[pos]
+    cdef INDPTR_t index = indices[pos]
+    while True:
+        child = 2 * pos + 1
+        if child >= size:
+            break
+        if child + 1 < size and scores[child + 1] < scores[child]:
+            child += 1
+        if scores[child] >= score:
+            break
+        scores[pos] = scores[child]
+        indices[pos] = indices[child]
+        pos = child
+    scores[pos] = score
+    indices[pos] = index
+
+
+cdef inline void _sift_up(VALUE_t* scores, INDPTR_t* indices, Py_ssize_t pos) noexcept nogil:
+    """Moves a newly appended heap entry up to its place."""
+    cdef Py_ssize_t parent
+    cdef VALUE_t score = scores[pos]
+    cdef INDPTR_t index = indices[pos]
+    while pos > 0:
+        parent = (pos - 1) // 2
+        if scores[parent] <= score:
+            break
+        scores[pos] = scores[parent]
+        indices[pos] = indices[parent]
+        pos = parent
+    scores[pos] = score
+    indices[pos] = index
+
+
+cdef inline Py_ssize_t _heap_push(
+    VALUE_t* scores, INDPTR_t* indices, Py_ssize_t size, Py_ssize_t k, VALUE_t score, INDPTR_t index
+) noexcept nogil:
+    """Offers one scored row to a size-k min-heap and returns the new heap size."""
+    if size < k:
+        scores[size] = score
+        indices[size] = index
+        _sift_up(scores, indices, size)
+        return size + 1
+    if score > scores[0]:
+        scores[0] = score
+        indices[0] = index
+        _sift_down(scores, indices, size, 0)
+    return size
+
+
+cdef inline void _heap_sort(VALUE_t* scores, INDPTR_t* indices, Py_ssize_t size) noexcept nogil:
+    """Sorts a min-heap in place into descending order of score."""
+    # Repeatedly moving the smallest entry to the end leaves the heap sorted descending.
+    while size > 1:
+        size = size - 1
+        scores[0], scores[size] = scores[size], scores[0]
+        indices[0], indices[size] = indices[size], indices[0]
+        _sift_down(scores, indices, size, 0)
+
+
+cdef void _top_k_for_query(
+    const INDPTR_t[::1] indptr,
+    const INDEX_t[::1] indices,
+    const VALUE_t[::1] inv_norms,
+    const VALUE_t[::1] query,
+    VALUE_t inv_query_norm,
+    VALUE_t* heap_scores,
+    INDPTR_t* heap_indices,
+    Py_ssize_t k,
+) noexcept nogil:
+    """
+    Scores every row against one query, keeping the best k in a min-heap,
+    then heap-sorts them in place into descending order of similarity.
+    Rows scoring 0 are skipped, leaving the rest of the heap as it was (-1).
+    """
+    cdef Py_ssize_t n_products = indptr.shape[0] - 1
+    cdef Py_ssize_t i, p, size = 0
+    cdef VALUE_t dot_product, score
+
     for i in range(n_products):
         dot_product = 0.0
-        matrix_norm_sq = 0.0
-
-        # Calculate dot product and matrix row norm simultaneously
-        for j in range(n_features):
-            dot_product += matrix[i, j] * vector[0, j]
-            matrix_norm_sq += matrix[i, j] * matrix[i, j]
-        
-        matrix_norm = sqrt(matrix_norm_sq)
-
-        # Calculate cosine similarity and store it
-        if matrix_norm > 0.0:
-            sim = dot_product / (matrix_norm * vector_norm)
-            similarities[i] = sim
-        else:
-            similarities[i] = 0.0
-
-    # --- Find Top K using NumPy ---
-    # Using argpartition is more efficient than a full sort for finding the top k elements.
-    if n_products > k:
-        top_k_indices = np.argpartition(similarities, -k)[-k:]
-        # Sort only the top k results to get them in the correct descending order
-        sorted_top_k = top_k_indices[np.argsort(similarities[top_k_indices])][::-1]
-    else:
-        # If there are fewer items than k, sort all of them
-        sorted_top_k = np.argsort(similarities)[::-1]
-        
-    return sorted_top_k
\ No newline at end of file
+        for p in range(indptr[i], indptr[i + 1]):
+            dot_product = dot_product + query[indices[p]]
+        score = dot_product * inv_norms[i] * inv_query_norm
+        if score > 0:
+            size = _heap_push(heap_scores, heap_indices, size, k, score, i)
+
+    _heap_sort(heap_scores, heap_indices, size)
+
+
+def cosine_similarity_top_k_batch(matrix, queries, int k=5):
+    """
+    Batched Cython cosine similarity for a (Q, n_features) block of queries.
+
+    Queries are scored in parallel (OpenMP, with the GIL released), each with its
+    own size-k heap, so no (Q, n_products) score matrix is ever materialized.
+    Returns a (Q, min(k, n_products)) array of row indices, best match first,
+    padded with -1 where fewer rows score above 0.
+    """
+    cdef const INDPTR_t[::1] indptr = matrix.indptr
+    cdef const INDEX_t[::1] indices = matrix.indices
+    cdef const VALUE_t[::1] inv_norms = matrix.inv_norms
+    cdef const VALUE_t[:, ::1] query_block = np.ascontiguousarray(
+        np.asarray(queries, dtype=np.float32).reshape(-1, matrix.n_features)
+    )
+    cdef Py_ssize_t n_queries = query_block.shape[0]
+    cdef Py_ssize_t top_k = min(k, indptr.shape[0] - 1)
+
+    query_norms = np.linalg.norm(np.asarray(query_block), axis=1)
+    cdef VALUE_t[::1] inv_query_norms = np.zeros(n_queries, dtype=np.float32)
+    np.divide(1.0, query_norms, out=np.asarray(inv_query_norms), where=query_norms > 0)
+
+    result_scores = np.empty((n_queries, top_k), dtype=np.float32)
+    result_indices = np.full((n_queries, top_k), -1, dtype=np.int64)
+    if top_k == 0:
+        return result_indices
+    cdef VALUE_t[:, ::1] heap_scores = result_scores
+    cdef INDPTR_t[:, ::1] heap_indices = result_indices
+
+    cdef Py_ssize_t q
+    for q in prange(n_queries, nogil=True, schedule='dynamic'):
+        _top_k_for_query(
+            indptr, indices, inv_norms, query_block[q], inv_query_norms[q],
+            &heap_scores[q, 0], &heap_indices[q, 0], top_k,
+        )
+
+    return result_indices
+
+
+def popcount_similarity_top_k(
+    matrix,
+    vector,
+    int k=5
+):
+    """
+    Cython cosine similarity over bit-packed rows (see ``BitPackedTagIndex``).
+
+    Binary dot products are popcounts of AND-ed words; the query is binarized.
+    Rows scoring 0 are never returned.
+    """
+    cdef const uint64_t[:, ::1] bits = matrix.bits
+    cdef const VALUE_t[::1] inv_norms = matrix.inv_norms
+    cdef const uint64_t[::1] query = pack_bits(
+        np.asarray(vector).reshape(1, -1)[:, :matrix.n_features]
+    )[0]
+    cdef Py_ssize_t n_products = bits.shape[0]
+    cdef Py_ssize_t n_words = min(bits.shape[1], query.shape[0])
+    cdef Py_ssize_t i, w, size = 0
+    cdef Py_ssize_t top_k = min(k, n_products)
+    cdef long query_bits = 0, overlap
+    cdef double inv_vector_norm
+
+    result_scores = np.empty(top_k, dtype=np.float32)
+    result_indices = np.empty(top_k, dtype=np.int64)
+    cdef VALUE_t[::1] heap_scores = result_scores
+    cdef INDPTR_t[::1] heap_indices = result_indices
+
+    for w in range(query.shape[0]):
+        query_bits += cy_popcount64(query[w])
+    if query_bits == 0 or top_k == 0:
+        return np.array([], dtype=np.int64)
+    inv_vector_norm = 1.0 / sqrt(<double>query_bits)
+
+    with nogil:
+        for i in range(n_products):
+            overlap = 0
+            for w in range(n_words):
+                overlap += cy_popcount64(bits[i, w] & query[w])
+            if overlap > 0 and inv_norms[i] > 0.0:
+                size = _heap_push(&heap_scores[0], &heap_indices[0], size, top_k,
+                                  <VALUE_t>(overlap * inv_norms[i] * inv_vector_norm), i)
+        _heap_sort(&heap_scores[0], &heap_indices[0], size)
+
+    return result_indices[:size]
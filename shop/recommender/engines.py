@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from shop.models import Product
+from . import collaborative, content, trending
+
+# Every engine module exposes similar_product_ids(product_id, k) and
+# recommended_product_ids(user, k), both returning ranked product ID lists.
+ENGINES = {
+    'content': content,
+    'collaborative': collaborative,
+    'trending': trending,
+}
+
+
+def _blend(rank_lists, weights, k):
+    """
+    Merges ranked ID lists by weighted reciprocal rank: an ID at (0-based) rank
+    r in an engine's list scores ``weight / (r + 1)``, summed over engines.
+    """
+    scores = {}
+    for name, ids in rank_lists.items():
+        for rank, product_id in enumerate(ids):
+            scores[product_id] = scores.get(product_id, 0.0) + weights[name] / (rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+def _ranked_ids(method, *args, k):
+    """Calls ``method`` on the engine selected by RECOMMENDER_ENGINE, blending if it is 'blend'."""
+    if settings.RECOMMENDER_ENGINE != 'blend':
+        return getattr(ENGINES[settings.RECOMMENDER_ENGINE], method)(*args, k=k)
+    weights = settings.RECOMMENDER_BLEND_WEIGHTS
+    rank_lists = {name: getattr(ENGINES[name], method)(*args, k=k) for name in weights}
+    return _blend(rank_lists, weights, k)
+
+
+def similar_products(product_id: int, k: int = 5):
+    """
+    Finds the top k most similar products to a given product, using the
+    engine(s) configured by RECOMMENDER_ENGINE, or the trending products when
+    they find none (e.g. an untagged product).
+
+    Returns:
+        A Django QuerySet of Product objects.
+    """
+    similar_product_ids = _ranked_ids('similar_product_ids', product_id, k=k)
+    if not similar_product_ids:
+        similar_product_ids = trending.similar_product_ids(product_id, k=k)
+    if not similar_product_ids:
+        return Product.objects.none()
+    return Product.objects.filter(id__in=similar_product_ids)
+
+
+def recommendations_for_user(user, k: int = 5):
+    """
+    Generates personalized product recommendations for a logged-in user, using
+    the engine(s) configured by RECOMMENDER_ENGINE.
+
+    The ranked product IDs are cached per user for RECOMMENDER_USER_CACHE_TIMEOUT
+    seconds and invalidated whenever one of the user's interactions is created or
+    deleted (see ``content.invalidate_user_recommendations``), so returning users
+    cost a single ``Product`` query. Users the engines have nothing for (e.g. no
+    likes or purchases yet) get the cached trending products instead.
+    """
+    key = content.USER_RECOMMENDATIONS_KEY.format(user_id=user.pk)
+    cached = cache.get(key)
+    if cached is not None and cached['k'] >= k and cached.get('engine') == settings.RECOMMENDER_ENGINE:
+        recommended_ids = cached['ids'][:k]
+    else:
+        recommended_ids = _ranked_ids('recommended_product_ids', user, k=k)
+        cache.set(
+            key,
+            {'k': k, 'engine': settings.RECOMMENDER_ENGINE, 'ids': recommended_ids},
+            timeout=settings.RECOMMENDER_USER_CACHE_TIMEOUT,
+        )
+
+    if not recommended_ids:
+        # Not cached per user, so it stays as fresh as the trending list.
+        recommended_ids = trending.recommended_product_ids(user, k=k)
+    if not recommended_ids:
+        return Product.objects.none()
+    return Product.objects.filter(id__in=recommended_ids)
@@ -0,0 +1,339 @@
+import fcntl
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from itertools import chain
+from pathlib import Path
+
+import numpy as np
+from django.db.models import Max
+from shop.models import Product, Tag
+from .py_similarity import band_keys, minhash_parameters, minhash_signatures
+
+
+class ProductTagIndex:
+    """
+    A binary product-tag matrix stored in compressed sparse row (CSR) form.
+
+    Row ``i`` describes the product ``product_ids[i]``, which is kept sorted so
+    that ID-to-row lookups are a binary search and row-to-ID lookups a plain
+    array index, with no per-process dict to build. Its tags are the column
+    indices ``indices[indptr[i]:indptr[i + 1]]``. Columns are tag primary keys,
+    so a newly created tag never forces existing rows to be renumbered.
+    Every stored value is an implicit 1, which is why no ``data`` array is kept.
+
+    ``inv_norms`` carries the reciprocal L2 norm of every row (0 for untagged
+    rows), so cosine scoring is a single sparse dot product and a multiply.
+    Bump ``FORMAT_VERSION`` whenever the stored layout changes; it is part of
+    the cache key and storage path, so artifacts from older code are never read.
+    """
+
+    FORMAT_VERSION = 4
+    ARRAYS = ('product_ids', 'indptr', 'indices', 'inv_norms')
+
+    def __init__(self, product_ids, indptr, indices, n_features):
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.n_features = int(n_features)
+        self.inv_norms = _inverse_norms(np.diff(self.indptr))
+
+    @classmethod
+    def from_db(cls, chunk_size: int = 20000, **options):
+        """
+        Builds the index in bulk from the ``Product.tags.through`` table.
+
+        Only two columns are read from the through table, streamed in chunks,
+        so no ``Product`` or ``Tag`` model instances are created. Extra
+        ``options`` are passed on to the index class.
+        """
+        product_ids = np.fromiter(
+            Product.objects.order_by('id').values_list('id', flat=True).iterator(chunk_size=chunk_size),
+            dtype=np.int64,
+        )
+        through = Product.tags.through.objects.order_by('product_id', 'tag_id').values_list('product_id', 'tag_id')
+        pairs = np.fromiter(
+            chain.from_iterable(through.iterator(chunk_size=chunk_size)),
+            dtype=np.int64,
+        ).reshape(-1, 2)
+
+        # Products created after the id list was read have no row yet; drop them.
+        rows = np.searchsorted(product_ids, pairs[:, 0])
+        known = rows < len(product_ids)
+        known[known] = product_ids[rows[known]] == pairs[known, 0]
+        rows, tag_ids = rows[known], pairs[known, 1]
+
+        indptr = np.zeros(len(product_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(product_ids)), out=indptr[1:])
+
+        max_tag_id = Tag.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+        if len(tag_ids):
+            max_tag_id = max(max_tag_id, int(tag_ids.max()))
+
+        return cls(product_ids, indptr, tag_ids, max_tag_id + 1, **options)
+
+    def save(self, directory) -> None:
+        """Writes every array to ``<directory>/<name>.npy`` plus a ``meta.json``."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(directory / f'{name}.npy', getattr(self, name))
+        meta = {'class': type(self).__name__, 'n_features': self.n_features, 'built_at': time.time()}
+        (directory / 'meta.json').write_text(json.dumps(meta))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Opens an index written by ``save``. With the default ``mmap_mode='r'``
+        the arrays are read-only views of the files, so every process that opens
+        the same version shares its pages through the OS page cache.
+        """
+        directory = Path(directory)
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, np.load(directory / f'{name}.npy', mmap_mode=mmap_mode))
+        meta = json.loads((directory / 'meta.json').read_text())
+        index.n_features = meta['n_features']
+        return index
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    @property
+    def shape(self):
+        return len(self.product_ids), self.n_features
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def positions(self, product_ids) -> np.ndarray:
+        """Returns the row of each product ID, or -1 for IDs not in the index."""
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        rows = np.searchsorted(self.product_ids, product_ids)
+        found = rows < len(self.product_ids)
+        found[found] = self.product_ids[rows[found]] == product_ids[found]
+        return np.where(found, rows, -1)
+
+    def position(self, product_id: int):
+        """Returns the row of ``product_id``, or None if it is not in the index."""
+        row = int(np.searchsorted(self.product_ids, product_id))
+        if row < len(self.product_ids) and self.product_ids[row] == product_id:
+            return row
+        return None
+
+    def gather_rows(self, rows):
+        """
+        Returns the concatenated tag columns of ``rows`` and each row's tag count,
+        without a Python loop over the rows.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        lengths = ends - starts
+        # Offset of every gathered element: its row's start plus its rank within the row.
+        offsets = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return self.indices[offsets], lengths
+
+    def row_indices(self, idx: int) -> np.ndarray:
+        """Returns the tag columns set in row ``idx``."""
+        return self.indices[self.indptr[idx]:self.indptr[idx + 1]]
+
+    def row_vector(self, idx: int) -> np.ndarray:
+        """Returns row ``idx`` as a dense ``(1, n_features)`` float32 vector."""
+        vector = np.zeros((1, self.n_features), dtype=np.float32)
+        vector[0, self.row_indices(idx)] = 1.0
+        return vector
+
+
+class BitPackedTagIndex(ProductTagIndex):
+    """
+    A ``ProductTagIndex`` that also keeps every row packed into uint64 words.
+
+    ``bits[i]`` holds row ``i`` one bit per tag, which is 8x smaller than a dense
+    int8 matrix and lets the popcount kernels score a row with a handful of
+    AND + popcount instructions. The bitset grows with the tag vocabulary
+    (``ceil(n_features / 64)`` words per row), so it pays off for catalogs with
+    a modest number of tags; the CSR arrays are kept for row access.
+    """
+
+    ARRAYS = ProductTagIndex.ARRAYS + ('bits',)
+
+    def __init__(self, product_ids, indptr, indices, n_features):
+        super().__init__(product_ids, indptr, indices, n_features)
+        n_words = (self.n_features + 63) // 64
+        self.bits = np.zeros((len(self.product_ids), n_words), dtype=np.uint64)
+        rows = np.repeat(np.arange(len(self.product_ids)), np.diff(self.indptr))
+        _set_bits(self.bits, rows, self.indices)
+
+
+class MinHashTagIndex(ProductTagIndex):
+    """
+    A ``ProductTagIndex`` with a MinHash locality-sensitive hashing table on top.
+
+    Each row's tag set gets a ``n_bands * band_rows`` MinHash signature; rows
+    whose signatures agree on a whole band land in the same bucket, so rows
+    with a high Jaccard overlap are likely to collide in at least one band.
+    More bands (or fewer rows per band) raise recall and candidate counts.
+    Buckets are stored as ``band_keys`` (each band's keys, sorted) and
+    ``band_order`` (the row behind each key), so a lookup is a binary search per
+    band and the whole table memory-maps like the rest of the index.
+    """
+
+    ARRAYS = ProductTagIndex.ARRAYS + ('hash_params', 'signatures', 'band_keys', 'band_order')
+
+    def __init__(self, product_ids, indptr, indices, n_features, n_bands=32, band_rows=2, seed=0):
+        super().__init__(product_ids, indptr, indices, n_features)
+        self.hash_params = minhash_parameters(n_bands * band_rows, seed)
+        self.signatures = minhash_signatures(self.indptr, self.indices, self.hash_params)
+        self._index_bands(n_bands)
+
+    @property
+    def n_bands(self):
+        return self.band_keys.shape[0]
+
+    def _index_bands(self, n_bands: int) -> None:
+        keys = band_keys(self.signatures, n_bands)
+        self.band_order = np.argsort(keys, axis=1, kind='stable').astype(np.int32)
+        self.band_keys = np.take_along_axis(keys, self.band_order, axis=1)
+
+
+def _inverse_norms(tag_counts):
+    """Reciprocal L2 norms of binary rows with the given tag counts (0 for empty rows)."""
+    counts = np.asarray(tag_counts, dtype=np.float32)
+    inv = np.zeros_like(counts)
+    np.divide(1.0, np.sqrt(counts), out=inv, where=counts > 0)
+    return inv
+
+
+def _set_bits(bits, rows, columns):
+    """Sets bit ``columns % 64`` of word ``columns // 64`` in each of the given rows."""
+    columns = np.asarray(columns, dtype=np.uint64)
+    np.bitwise_or.at(bits, (rows, columns // np.uint64(64)), np.uint64(1) << (columns % np.uint64(64)))
+
+
+class FileLock:
+    """
+    An exclusive ``flock`` on ``path``, shared by every thread and process on
+    this host (unlike a lease in a per-process cache). The OS drops it when
+    the holder's file is closed, including when the holder dies, so it never
+    has to time out.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Takes the lock, waiting for it unless ``blocking`` is False; returns whether it was taken."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+INDEX_CLASSES = {cls.__name__: cls for cls in (ProductTagIndex, BitPackedTagIndex, MinHashTagIndex)}
+CURRENT_POINTER = 'CURRENT'
+
+
+def publish_index(index, root, keep: int = 3) -> str:
+    """
+    Writes ``index`` as a new version directory under ``root`` and atomically
+    points ``root/CURRENT`` at it. Returns the version name.
+
+    Older versions beyond ``keep`` are deleted; processes that still have them
+    mapped keep reading the unlinked pages until they reload.
+    """
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    version = str(time.time_ns())
+    staging = Path(tempfile.mkdtemp(dir=root, prefix='.staging-'))
+    try:
+        index.save(staging)
+        os.replace(staging, root / version)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    fd, tmp_pointer = tempfile.mkstemp(dir=root, prefix='.pointer-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(version)
+    os.replace(tmp_pointer, root / CURRENT_POINTER)
+
+    versions = sorted(p.name for p in root.iterdir() if p.is_dir() and p.name.isdigit())
+    for old in versions[:-keep]:
+        shutil.rmtree(root / old, ignore_errors=True)
+    return version
+
+
+def current_version(root):
+    """Returns the version ``root/CURRENT`` points at, or None if nothing is published."""
+    try:
+        return (Path(root) / CURRENT_POINTER).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_version(root, version, mmap_mode='r'):
+    """Opens a published version, returning ``(index, meta)``."""
+    directory = Path(root) / version
+    meta = json.loads((directory / 'meta.json').read_text())
+    return INDEX_CLASSES[meta['class']].load(directory, mmap_mode=mmap_mode), meta
+
+
+def write_state(path, state) -> None:
+    """
+    Atomically replaces the pickle at ``path`` with ``state``, so readers see
+    either the old or the new file. Writers must serialize on a ``FileLock``.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def state_revision(path):
+    """
+    Identifies the file ``write_state`` last put at ``path`` (every write
+    replaces the inode), or None if there is none. Costs one ``stat``.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def read_state(path):
+    """Returns ``(revision, state)`` of the pickle at ``path``, or ``(None, None)`` if there is none."""
+    try:
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            return (st.st_ino, st.st_mtime_ns), pickle.load(f)
+    except FileNotFoundError:
+        return None, None
@@ -0,0 +1,114 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+
+class NeighborTable:
+    """
+    A precomputed table of each product's top K most similar products.
+
+    The table is a single ``(n_products, K + 1)`` int64 array: column 0 holds
+    the product ID (sorted ascending) and columns 1..K its neighbor IDs, most
+    similar first, padded with -1. Keeping everything in one ``.npy`` file lets
+    a rebuild be published with one atomic rename and lets readers map it with
+    ``mmap_mode='r'``, so lookups never load the whole table into memory.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    @classmethod
+    def build(cls, matrix, k, similarity_batch_function, block_size=256, progress=None):
+        """
+        Computes the top ``k`` neighbors of every row of a ``ProductTagIndex``.
+
+        Rows are scored ``block_size`` at a time with ``similarity_batch_function``.
+        Only products sharing a tag (scoring above 0) are neighbors, so an
+        untagged product has none. ``progress``, if given, is called with the
+        number of rows done after each block.
+        """
+        n_products = len(matrix)
+        table = np.full((n_products, k + 1), -1, dtype=np.int64)
+        table[:, 0] = matrix.product_ids
+
+        for start in range(0, n_products, block_size):
+            end = min(start + block_size, n_products)
+            queries = np.zeros((end - start, matrix.n_features), dtype=np.float32)
+            for offset in range(end - start):
+                queries[offset, matrix.row_indices(start + offset)] = 1.0
+
+            # Ask for one extra neighbor because each row is most similar to itself.
+            similar = similarity_batch_function(matrix, queries, k=k + 1)
+            for offset, row in enumerate(similar):
+                # The kernel pads rows with fewer matches with -1.
+                row = row[(row >= 0) & (row != start + offset)][:k]
+                table[start + offset, 1:len(row) + 1] = matrix.product_ids[row]
+
+            if progress is not None:
+                progress(end)
+
+        return cls(table)
+
+    @property
+    def k(self):
+        return self.table.shape[1] - 1
+
+    def __len__(self):
+        return len(self.table)
+
+    def lookup(self, product_id: int, k: int):
+        """
+        Returns up to ``k`` neighbor IDs of ``product_id``, or None if the product
+        is not in the table or the table holds fewer than ``k`` neighbors per row.
+        """
+        if k > self.k:
+            return None
+        ids = self.table[:, 0]
+        row = np.searchsorted(ids, product_id)
+        if row >= len(ids) or ids[row] != product_id:
+            return None
+        neighbors = self.table[row, 1:k + 1]
+        return neighbors[neighbors >= 0].tolist()
+
+    def save(self, path):
+        """Atomically writes the table to ``path``, replacing any previous version."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, self.table)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a table written by ``save``."""
+        return cls(np.load(path, mmap_mode='r'))
+
+
+_open_tables = {}
+
+
+def open_table(path):
+    """
+    Returns the memory-mapped table at ``path``, or None if it has not been built.
+
+    Opened tables are memoized per process and re-opened when a rebuild has
+    replaced the file, which costs one ``stat`` call per lookup.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        _open_tables.pop(path, None)
+        return None
+    # A rebuild is published with os.replace, which gives the file a new inode.
+    version = (stat.st_ino, stat.st_mtime_ns)
+    cached = _open_tables.get(path)
+    if cached is None or cached[0] != version:
+        cached = _open_tables[path] = (version, NeighborTable.load(path))
+    return cached[1]
@@ -1,35 +1,81 @@
 import numpy as np
 
-def cosine_similarity_top_k(matrix: np.ndarray, vector: np.ndarray, k: int = 5) -> np.ndarray:
+# Popcount of every byte value, for NumPy versions without np.bitwise_count.
+_BYTE_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def pack_bits(dense: np.ndarray) -> np.ndarray:
+    """
+    Packs the non-zero pattern of a (n_rows, n_features) array into uint64 words.
+
+    Column ``c`` maps to bit ``c % 64`` of word ``c // 64``.
+
+    Returns:
+        np.ndarray: A C-contiguous (n_rows, ceil(n_features / 64)) uint64 array.
+    """
+    dense = np.atleast_2d(dense)
+    n_words = (dense.shape[1] + 63) // 64
+    packed = np.zeros((dense.shape[0], n_words * 8), dtype=np.uint8)
+    bytes_ = np.packbits(dense != 0, axis=1, bitorder='little')
+    packed[:, :bytes_.shape[1]] = bytes_
+    return packed.view('<u8').astype(np.uint64, copy=False)
+
+
+def popcount_rows(words: np.ndarray) -> np.ndarray:
+    """Returns the number of set bits in each row of a 2D uint64 array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+    return _BYTE_POPCOUNT[np.ascontiguousarray(words).view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+def sparse_dot(indptr: np.ndarray, indices: np.ndarray, dense: np.ndarray) -> np.ndarray:
+    """
+    Multiplies a binary CSR matrix by a dense array.
+
+    Args:
+        indptr (np.ndarray): The CSR row pointer array, of length n_rows + 1.
+        indices (np.ndarray): The CSR column indices.
+        dense (np.ndarray): A (n_features,) vector or (n_features, b) block.
+
+    Returns:
+        np.ndarray: A (n_rows,) or (n_rows, b) float32 array of row dot products.
+    """
+    n_rows = len(indptr) - 1
+    out = np.zeros((n_rows,) + dense.shape[1:], dtype=np.float32)
+    if len(indices) == 0:
+        return out
+    starts = indptr[:-1]
+    # reduceat misbehaves on empty segments, so only reduce rows that have tags.
+    # Each remaining segment then runs exactly to the start of the next non-empty row.
+    nonempty = starts < indptr[1:]
+    out[nonempty] = np.add.reduceat(dense[indices], starts[nonempty], axis=0)
+    return out
+
+
+def cosine_similarity_top_k(matrix, vector: np.ndarray, k: int = 5) -> np.ndarray:
     """
     Pure Python/NumPy implementation of cosine similarity to find top k items.
-    
+
     Args:
-        matrix (np.ndarray): The (n_products, n_features) matrix.
+        matrix (ProductTagIndex): The sparse (n_products, n_features) product-tag index.
         vector (np.ndarray): The (1, n_features) vector to compare against.
         k (int): The number of top similar indices to return.
-        
+
     Returns:
-        np.ndarray: An array of the top k most similar row indices from the matrix.
+        np.ndarray: An array of (at most) the top k most similar row indices
+        from the matrix. Rows scoring 0 (sharing no tag with the query) are
+        never returned, so a zero query returns none.
     """
     # Ensure vector is 1D for dot product calculations
-    vector_1d = vector.flatten()
+    vector_1d = np.asarray(vector, dtype=np.float32).ravel()
 
-    # Calculate dot product
-    dot_product = matrix.dot(vector_1d)
-
-    # Calculate norms
-    matrix_norms = np.linalg.norm(matrix, axis=1)
+    # Row norms are precomputed on the index, so scoring is one sparse
+    # dot product scaled by the reciprocal norms.
     vector_norm = np.linalg.norm(vector_1d)
-    
-    # Avoid division by zero for products with no tags
-    # or if the query vector is all zeros.
-    denominator = matrix_norms * vector_norm
-    # Create a zero-filled array for similarities
-    similarities = np.zeros_like(denominator)
-    # Only compute similarity where the denominator is not zero
-    valid_indices = denominator > 0
-    similarities[valid_indices] = dot_product[valid_indices] / denominator[valid_indices]
+    if vector_norm == 0:
+        return np.array([], dtype=np.int64)
+    dot_product = sparse_dot(matrix.indptr, matrix.indices, vector_1d)
+    similarities = dot_product * matrix.inv_norms * np.float32(1.0 / vector_norm)
 
     # Get the indices of the top k similarities, in descending order
     # argpartition is faster than argsort for finding top k
@@ -40,5 +86,192 @@ def cosine_similarity_top_k(matrix: np.ndarray, vector: np.ndarray, k: int = 5)
     else:
         # If there are fewer items than k, just sort them all
         sorted_top_k = np.argsort(similarities)[::-1]
-        
-    return sorted_top_k
\ No newline at end of file
+
+    return sorted_top_k[similarities[sorted_top_k] > 0]
+
+
+def cosine_similarity_top_k_batch(matrix, queries: np.ndarray, k: int = 5,
+                                  max_block_elements: int = 1 << 24) -> np.ndarray:
+    """
+    Vectorized cosine similarity for a block of query vectors.
+
+    Product rows are scored in chunks and merged into a running top k per query,
+    so peak memory stays around ``max_block_elements`` floats however large the
+    catalog is.
+
+    Args:
+        matrix (ProductTagIndex): The sparse (n_products, n_features) product-tag index.
+        queries (np.ndarray): The (Q, n_features) block of query vectors.
+        k (int): The number of top similar indices to return per query.
+        max_block_elements (int): Upper bound on the size of intermediate score blocks.
+
+    Returns:
+        np.ndarray: A (Q, min(k, n_products)) array of row indices, each row in
+        descending order of similarity. Rows scoring 0 are left out, so a row
+        with fewer matches (or a zero query's) is padded with -1.
+    """
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, matrix.n_features)
+    n_queries, n_products = len(queries), len(matrix)
+    k = min(k, n_products)
+
+    query_norms = np.linalg.norm(queries, axis=1)
+    inv_query_norms = np.zeros_like(query_norms)
+    np.divide(1.0, query_norms, out=inv_query_norms, where=query_norms > 0)
+    queries_t = np.ascontiguousarray(queries.T)
+
+    best_scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+    best_indices = np.full((n_queries, k), -1, dtype=np.int64)
+    if k == 0:
+        return best_indices
+
+    # Gathering a chunk costs (chunk nnz x Q) floats; size chunks to fit the budget.
+    avg_row_nnz = max(1, matrix.nnz // max(1, n_products))
+    chunk_rows = max(1, max_block_elements // (max(1, n_queries) * avg_row_nnz))
+
+    for start in range(0, n_products, chunk_rows):
+        end = min(start + chunk_rows, n_products)
+        lo, hi = matrix.indptr[start], matrix.indptr[end]
+        dot_product = sparse_dot(matrix.indptr[start:end + 1] - lo, matrix.indices[lo:hi], queries_t)
+        chunk_scores = (dot_product * matrix.inv_norms[start:end, None]).T * inv_query_norms[:, None]
+
+        # Merge this chunk into the running top k of every query.
+        candidate_scores = np.hstack((best_scores, chunk_scores))
+        candidate_indices = np.hstack((
+            best_indices,
+            np.broadcast_to(np.arange(start, end, dtype=np.int64), (n_queries, end - start)),
+        ))
+        keep = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(candidate_scores, keep, axis=1)
+        best_indices = np.take_along_axis(candidate_indices, keep, axis=1)
+
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    best_indices = np.take_along_axis(best_indices, order, axis=1)
+    best_indices[np.take_along_axis(best_scores, order, axis=1) <= 0] = -1
+    return best_indices
+
+
+def popcount_similarity_top_k(matrix, vector: np.ndarray, k: int = 5) -> np.ndarray:
+    """
+    Cosine similarity over bit-packed binary rows, via popcounts of AND-ed words.
+
+    The query is binarized (any non-zero weight counts as the tag being set).
+
+    Args:
+        matrix (BitPackedTagIndex): An index carrying a (n_products, n_words) uint64 ``bits`` array.
+        vector (np.ndarray): The (1, n_features) vector to compare against.
+        k (int): The number of top similar indices to return.
+
+    Returns:
+        np.ndarray: An array of (at most) the top k most similar row indices
+        from the matrix. Rows scoring 0 are never returned, as in
+        ``cosine_similarity_top_k``.
+    """
+    query = pack_bits(np.asarray(vector).reshape(1, -1)[:, :matrix.n_features])
+    query_bits = popcount_rows(query)[0]
+    if query_bits == 0:
+        return np.array([], dtype=np.int64)
+    overlap = popcount_rows(matrix.bits & query)
+    similarities = overlap * matrix.inv_norms * np.float32(1.0 / np.sqrt(query_bits))
+
+    if len(similarities) > k:
+        top_k_indices = np.argpartition(similarities, -k)[-k:]
+        sorted_top_k = top_k_indices[np.argsort(similarities[top_k_indices])][::-1]
+    else:
+        sorted_top_k = np.argsort(similarities)[::-1]
+
+    return sorted_top_k[similarities[sorted_top_k] > 0]
+
+
+MINHASH_PRIME = np.uint64((1 << 31) - 1)  # Mersenne prime modulus of the MinHash hash family
+_BAND_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def minhash_parameters(n_hashes: int, seed: int = 0) -> np.ndarray:
+    """Draws ``n_hashes`` universal hash functions ``(a * x + b) mod p`` as a (2, n_hashes) uint64 array."""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, int(MINHASH_PRIME), size=n_hashes, dtype=np.uint64)
+    b = rng.integers(0, int(MINHASH_PRIME), size=n_hashes, dtype=np.uint64)
+    return np.stack((a, b))
+
+
+def minhash_signatures(indptr: np.ndarray, indices: np.ndarray, hash_params: np.ndarray) -> np.ndarray:
+    """
+    Computes the MinHash signature of every row of a binary CSR matrix.
+
+    Returns:
+        np.ndarray: A (n_rows, n_hashes) uint32 array; empty rows hold the
+        modulus in every slot, a value no hashed column can take.
+    """
+    n_rows, n_hashes = len(indptr) - 1, hash_params.shape[1]
+    signatures = np.full((n_rows, n_hashes), MINHASH_PRIME, dtype=np.uint32)
+    starts = indptr[:-1]
+    nonempty = starts < indptr[1:]
+    if not nonempty.any():
+        return signatures
+    columns = np.asarray(indices, dtype=np.uint64)
+    for j in range(n_hashes):
+        hashed = (hash_params[0, j] * columns + hash_params[1, j]) % MINHASH_PRIME
+        signatures[nonempty, j] = np.minimum.reduceat(hashed, starts[nonempty])
+    return signatures
+
+
+def band_keys(signatures: np.ndarray, n_bands: int) -> np.ndarray:
+    """Folds each band of ``signatures`` into one uint64 bucket key, returning a (n_bands, n_rows) array."""
+    n_rows = signatures.shape[0]
+    bands = signatures.reshape(n_rows, n_bands, -1).astype(np.uint64)
+    keys = np.zeros((n_rows, n_bands), dtype=np.uint64)
+    for r in range(bands.shape[2]):
+        keys = (keys * _BAND_MIX) ^ bands[:, :, r]
+    return np.ascontiguousarray(keys.T)
+
+
+def minhash_similarity_top_k(matrix, vector: np.ndarray, k: int = 5, probe_bands=None,
+                             exact_function=None) -> np.ndarray:
+    """
+    Approximate cosine top k over a ``MinHashTagIndex`` via locality-sensitive hashing.
+
+    Candidates are the rows sharing a bucket with the query in at least one
+    of the first ``probe_bands`` bands (all bands by default); probing fewer
+    bands trades recall for latency. Buckets are keyed on the binarized query,
+    but candidates are re-ranked by exact (weighted) cosine similarity. If the
+    buckets yield fewer than k candidates, ``exact_function`` (the NumPy
+    ``cosine_similarity_top_k`` by default) scans the whole index instead.
+
+    Args:
+        matrix (MinHashTagIndex): The index, with its signatures and sorted band tables.
+        vector (np.ndarray): The (1, n_features) vector to compare against.
+        k (int): The number of top similar indices to return.
+        probe_bands (int | None): How many bands to look up.
+        exact_function (callable | None): The exact kernel used as a fallback.
+
+    Returns:
+        np.ndarray: An array of (at most) the top k most similar row indices.
+    """
+    vector_1d = np.asarray(vector, dtype=np.float32).ravel()[:matrix.n_features]
+    columns = np.flatnonzero(vector_1d)
+    if len(columns) == 0:
+        return np.array([], dtype=np.int64)
+
+    n_bands = matrix.band_keys.shape[0]
+    probe_bands = n_bands if probe_bands is None else max(1, min(probe_bands, n_bands))
+    hash_params = np.asarray(matrix.hash_params)
+    hashed = (hash_params[0, :, None] * columns.astype(np.uint64) + hash_params[1, :, None]) % MINHASH_PRIME
+    query_keys = band_keys(hashed.min(axis=1).astype(np.uint32)[None, :], n_bands)[:, 0]
+
+    candidates = []
+    for band in range(probe_bands):
+        keys = matrix.band_keys[band]
+        lo = np.searchsorted(keys, query_keys[band], side='left')
+        hi = np.searchsorted(keys, query_keys[band], side='right')
+        candidates.append(matrix.band_order[band, lo:hi])
+    candidates = np.unique(np.concatenate(candidates))
+    if len(candidates) < k:
+        return (exact_function or cosine_similarity_top_k)(matrix, vector_1d, k)
+
+    # Exact re-ranking of the candidates; every candidate shares a bucket, so none is empty.
+    tag_columns, lengths = matrix.gather_rows(candidates)
+    dot_product = np.add.reduceat(vector_1d[tag_columns], np.cumsum(lengths) - lengths)
+    similarities = dot_product * matrix.inv_norms[candidates]
+    top_k = np.argpartition(similarities, -k)[-k:] if len(similarities) > k else np.arange(len(similarities))
+    top_k = top_k[np.argsort(similarities[top_k])[::-1]]
+    return candidates[top_k[similarities[top_k] > 0]]
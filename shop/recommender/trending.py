@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from itertools import chain
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Case, F, When
+
+from shop import rollups
+from shop.models import Interaction, ProductDailyStats, ProductTrendBucket
+from .index import FileLock
+
+logger = logging.getLogger(__name__)
+
+TRENDING_KEY = 'trending_product_ids'
+REFRESH_LOCK_FILENAME = 'trending.lock'
+UPDATE_CHUNK_SIZE = 300  # Products per UPDATE, each adding one CASE branch
+
+
+def bucket_of(timestamp: float) -> int:
+    """Start (as a Unix timestamp) of the TRENDING_BUCKET_MINUTES bucket holding ``timestamp``."""
+    width = settings.TRENDING_BUCKET_MINUTES * 60
+    return int(timestamp // width * width)
+
+
+def window_start() -> int:
+    """The oldest bucket still in the TRENDING_WINDOW_DAYS window."""
+    return bucket_of(time.time() - settings.TRENDING_WINDOW_DAYS * 86400)
+
+
+def record(events):
+    """
+    Adds interactions to their products' trend buckets, weighted by
+    RECOMMENDER_ACTION_WEIGHTS; ``events`` are ``(product_id, action,
+    created_at)`` triples. Events older than TRENDING_WINDOW_DAYS are ignored.
+    """
+    action_weights = settings.RECOMMENDER_ACTION_WEIGHTS
+    first = window_start()
+    buckets = {}
+    for product_id, action, created_at in events:
+        bucket = bucket_of(created_at.timestamp())
+        if bucket >= first:
+            weights = buckets.setdefault(bucket, {})
+            weights[product_id] = weights.get(product_id, 0.0) + action_weights.get(action, 0.0)
+    _add(buckets)
+
+
+def _add(buckets):
+    """
+    Adds ``{bucket: {product_id: weight}}`` to the stored buckets: per
+    chunk of products, one insert of the missing rows and one ``UPDATE``
+    adding every product's weight in place, so concurrent writers never
+    overwrite each other.
+    """
+    with transaction.atomic():
+        for bucket, weights in buckets.items():
+            weights = list(weights.items())
+            for start in range(0, len(weights), UPDATE_CHUNK_SIZE):
+                chunk = dict(weights[start:start + UPDATE_CHUNK_SIZE])
+                ProductTrendBucket.objects.bulk_create(
+                    [ProductTrendBucket(product_id=product_id, bucket=bucket) for product_id in chunk],
+                    ignore_conflicts=True,
+                )
+                ProductTrendBucket.objects.filter(bucket=bucket, product_id__in=chunk).update(
+                    weight=Case(*(When(product_id=product_id, then=F('weight') + weight) for product_id, weight in chunk.items()))
+                )
+
+
+def top_product_ids(limit: int, chunk_size: int = 20000):
+    """
+    Ranks products by their bucket weights, each halved every
+    TRENDING_HALF_LIFE_HOURS of the bucket's age: the window's buckets are
+    streamed with one numeric ``values_list`` query and summed per product.
+    """
+    rows = ProductTrendBucket.objects.filter(bucket__gte=window_start()).order_by().values_list(
+        'product_id', 'bucket', 'weight'
+    )
+    # float64 holds the IDs and timestamps exactly.
+    rows = np.fromiter(chain.from_iterable(rows.iterator(chunk_size=chunk_size)), dtype=np.float64).reshape(-1, 3)
+    age_hours = (bucket_of(time.time()) - rows[:, 1]) / 3600
+    product_ids, inverse = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+    scores = np.bincount(
+        inverse, weights=rows[:, 2] * np.exp2(-np.maximum(age_hours, 0) / settings.TRENDING_HALF_LIFE_HOURS),
+        minlength=len(product_ids),
+    )
+    top = np.flatnonzero(scores > 0)
+    if len(top) > limit:
+        top = top[np.argpartition(-scores[top], limit - 1)[:limit]]
+    # Highest score first; ties by product ID, so the list is stable between refreshes.
+    top = top[np.lexsort((product_ids[top], -scores[top]))]
+    return product_ids[top].tolist()
+
+
+def refresh_trending():
+    """Recomputes and caches the trending list, dropping buckets that have left the window."""
+    ProductTrendBucket.objects.filter(bucket__lt=window_start()).delete()
+    cached = {'computed_at': time.time(), 'ids': top_product_ids(settings.TRENDING_LIMIT)}
+    # Kept until replaced, so a stale list is served while the next refresh runs.
+    cache.set(TRENDING_KEY, cached, timeout=None)
+    return cached
+
+
+def _start_background_refresh():
+    # A file lock, shared by every worker on the host (see ``index.FileLock``).
+    lease = FileLock(Path(settings.RECOMMENDER_DATA_DIR) / REFRESH_LOCK_FILENAME)
+    if not lease.acquire(blocking=False):
+        return  # Another worker is already refreshing.
+
+    def run():
+        try:
+            refresh_trending()
+        except Exception:
+            logger.exception("Background refresh of the trending products failed.")
+        finally:
+            lease.release()
+            connection.close()
+
+    threading.Thread(target=run, name='trending-refresh', daemon=True).start()
+
+
+def trending_product_ids(k: int):
+    """
+    Returns up to k trending product IDs, hottest first, from the cached list:
+    a single cache read, and never a write. A list older than
+    TRENDING_REFRESH_INTERVAL seconds keeps being served while one worker
+    recomputes it in the background; until the first one is computed (e.g.
+    on a cold cache) there are none.
+    """
+    cached = cache.get(TRENDING_KEY)
+    if cached is None or time.time() - cached['computed_at'] > settings.TRENDING_REFRESH_INTERVAL:
+        _start_background_refresh()
+    return cached['ids'][:k] if cached is not None else []
+
+
+def rebuild_trending():
+    """
+    Refills the buckets from scratch: rolled-up days from ``ProductDailyStats``
+    (each day's weight in the bucket of its last interaction) and raw
+    interactions newer than the rollup checkpoint. For backfills, e.g. after
+    bulk loads, which send no signals.
+    """
+    action_weights = settings.RECOMMENDER_ACTION_WEIGHTS
+    view, like, purchase = (
+        action_weights.get(action, 0.0)
+        for action in (Interaction.Action.VIEW, Interaction.Action.LIKE, Interaction.Action.PURCHASE)
+    )
+    first = window_start()
+    weights = {}
+
+    def add(product_id, weight, timestamp):
+        key = (product_id, bucket_of(timestamp))
+        weights[key] = weights.get(key, 0.0) + weight
+
+    days = ProductDailyStats.objects.filter(last_seen__gte=_datetime(first)).values_list(
+        'product_id', 'views', 'likes', 'purchases', 'last_seen'
+    )
+    for product_id, views, likes, purchases, last_seen in days.iterator():
+        add(product_id, views * view + likes * like + purchases * purchase, last_seen.timestamp())
+    since = _datetime(max(rollups.checkpoint().timestamp(), first))
+    raw = Interaction.objects.filter(created_at__gt=since).order_by().values_list('product_id', 'action', 'created_at')
+    for product_id, action, created_at in raw.iterator():
+        add(product_id, action_weights.get(action, 0.0), created_at.timestamp())
+
+    with transaction.atomic():
+        ProductTrendBucket.objects.all().delete()
+        ProductTrendBucket.objects.bulk_create(
+            [ProductTrendBucket(product_id=product_id, bucket=bucket, weight=weight) for (product_id, bucket), weight in weights.items()],
+            batch_size=5000,
+        )
+    return refresh_trending()['ids']
+
+
+def _datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+
+
+# The engine interface (see ``engines.ENGINES``): popularity, the same for everyone.
+
+def similar_product_ids(product_id: int, k: int = 5):
+    """The k most trending products other than ``product_id``."""
+    return [trending_id for trending_id in trending_product_ids(k + 1) if trending_id != product_id][:k]
+
+
+def recommended_product_ids(user, k: int = 5):
+    """The k most trending products."""
+    return trending_product_ids(k)
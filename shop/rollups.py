@@ -0,0 +1,236 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import Interaction, ProductDailyStats, RollupCheckpoint, UserProductStats
+
+INTERACTIONS_ROLLUP = 'interactions'
+CHECKPOINT_KEY = 'rollup_checkpoint:interactions'
+CHECKPOINT_TIMEOUT = 300
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+ACTION_COUNTS = {
+    Interaction.Action.VIEW: 'views',
+    Interaction.Action.LIKE: 'likes',
+    Interaction.Action.PURCHASE: 'purchases',
+}
+
+
+def checkpoint():
+    """
+    Returns how far raw interactions have been rolled up (EPOCH if never).
+    Cached; a stale (earlier) value only makes readers read more raw rows.
+    """
+    rolled_up_to = cache.get(CHECKPOINT_KEY)
+    if rolled_up_to is None:
+        rolled_up_to = (
+            RollupCheckpoint.objects.filter(name=INTERACTIONS_ROLLUP).values_list('rolled_up_to', flat=True).first()
+            or EPOCH
+        )
+        cache.set(CHECKPOINT_KEY, rolled_up_to, timeout=CHECKPOINT_TIMEOUT)
+    return rolled_up_to
+
+
+def rollup_interactions(upto=None, window_hours=None, chunk_size: int = 20000):
+    """
+    Folds the ``Interaction`` rows created (or refreshed) since the last
+    checkpoint, up to ``upto`` (default: INTERACTION_ROLLUP_LAG seconds ago,
+    so views still in a spool are not skipped), into ``ProductDailyStats`` and
+    ``UserProductStats``.
+
+    Rows are folded ``window_hours`` (default INTERACTION_ROLLUP_WINDOW_HOURS)
+    of ``created_at`` at a time, each window in its own transaction that also
+    advances the checkpoint, so a first run over a long history holds neither
+    all of it in memory nor the write lock throughout, and an interrupted run
+    resumes after its last window.
+
+    Returns:
+        The number of raw rows folded.
+    """
+    if upto is None:
+        upto = timezone.now() - timedelta(seconds=settings.INTERACTION_ROLLUP_LAG)
+    window = timedelta(hours=settings.INTERACTION_ROLLUP_WINDOW_HOURS if window_hours is None else window_hours)
+
+    folded = 0
+    while (window_folded := _rollup_window(upto, window, chunk_size)) is not None:
+        folded += window_folded
+    return folded
+
+
+def _rollup_window(upto, window, chunk_size):
+    """
+    Folds the rows of the next ``window`` after the checkpoint (but not after
+    ``upto``) and advances the checkpoint past them, in one transaction.
+
+    Returns:
+        The number of raw rows folded, or None once the checkpoint is at ``upto``.
+    """
+    with transaction.atomic():
+        state, _ = RollupCheckpoint.objects.select_for_update().get_or_create(
+            name=INTERACTIONS_ROLLUP, defaults={'rolled_up_to': EPOCH}
+        )
+        if upto <= state.rolled_up_to:
+            return None
+
+        pending = Interaction.objects.filter(created_at__gt=state.rolled_up_to, created_at__lte=upto).order_by()
+        # Windows start at the oldest pending row, skipping stretches without any (e.g. the
+        # decades before the first run's oldest row).
+        oldest = pending.aggregate(oldest=Min('created_at'))['oldest']
+        end = upto if oldest is None else min(oldest + window, upto)
+        rows = pending.filter(created_at__lte=end).values_list('user_id', 'product_id', 'action', 'rating', 'created_at')
+        daily, per_user = {}, {}
+        folded = 0
+        for user_id, product_id, action, rating, created_at in rows.iterator(chunk_size=chunk_size):
+            folded += 1
+            day = timezone.localdate(created_at)
+            stats = daily.get((product_id, day))
+            if stats is None:
+                stats = daily[product_id, day] = {'views': 0, 'likes': 0, 'purchases': 0, 'last_seen': created_at}
+            stats[ACTION_COUNTS[action]] += 1
+            stats['last_seen'] = max(stats['last_seen'], created_at)
+
+            stats = per_user.get((user_id, product_id))
+            if stats is None:
+                stats = per_user[user_id, product_id] = {
+                    'views': 0, 'last_viewed': None, 'last_seen': created_at, 'max_rating': rating,
+                }
+            if action == Interaction.Action.VIEW:
+                stats['views'] += 1
+                stats['last_viewed'] = max(stats['last_viewed'] or created_at, created_at)
+            stats['last_seen'] = max(stats['last_seen'], created_at)
+            stats['max_rating'] = max(stats['max_rating'], rating)
+
+        _merge_daily(daily)
+        _merge_per_user(per_user)
+        state.rolled_up_to = end
+        state.save(update_fields=['rolled_up_to'])
+        transaction.on_commit(lambda: cache.set(CHECKPOINT_KEY, end, timeout=CHECKPOINT_TIMEOUT))
+    return folded
+
+
+def _merge_daily(daily, chunk_size: int = 500):
+    """Adds the folded counts to the existing rows (read a chunk of products at a time) and upserts them."""
+    if not daily:
+        return
+    days = [day for _, day in daily]
+    product_ids = sorted({product_id for product_id, _ in daily})
+    for start in range(0, len(product_ids), chunk_size):
+        # A window spans a day or two, so only those days of the window's products are read.
+        existing = ProductDailyStats.objects.filter(
+            day__gte=min(days), day__lte=max(days), product_id__in=product_ids[start:start + chunk_size],
+        ).values_list('product_id', 'day', 'views', 'likes', 'purchases', 'last_seen')
+        for product_id, day, views, likes, purchases, last_seen in existing.iterator():
+            stats = daily.get((product_id, day))
+            if stats is not None:
+                stats['views'] += views
+                stats['likes'] += likes
+                stats['purchases'] += purchases
+                stats['last_seen'] = max(stats['last_seen'], last_seen)
+    ProductDailyStats.objects.bulk_create(
+        [ProductDailyStats(product_id=product_id, day=day, **stats) for (product_id, day), stats in daily.items()],
+        update_conflicts=True,
+        unique_fields=['product', 'day'],
+        update_fields=['views', 'likes', 'purchases', 'last_seen'],
+        batch_size=1000,
+    )
+
+
+def _merge_per_user(per_user, chunk_size: int = 500):
+    """Adds the folded counts to the existing rows (read a chunk of users at a time) and upserts them."""
+    user_ids = sorted({user_id for user_id, _ in per_user})
+    for start in range(0, len(user_ids), chunk_size):
+        existing = UserProductStats.objects.filter(user_id__in=user_ids[start:start + chunk_size]).values_list(
+            'user_id', 'product_id', 'views', 'last_viewed', 'last_seen', 'max_rating'
+        )
+        for user_id, product_id, views, last_viewed, last_seen, max_rating in existing.iterator():
+            stats = per_user.get((user_id, product_id))
+            if stats is not None:
+                stats['views'] += views
+                if last_viewed is not None:
+                    stats['last_viewed'] = max(stats['last_viewed'] or last_viewed, last_viewed)
+                stats['last_seen'] = max(stats['last_seen'], last_seen)
+                stats['max_rating'] = max(stats['max_rating'], max_rating)
+    UserProductStats.objects.bulk_create(
+        [UserProductStats(user_id=user_id, product_id=product_id, **stats) for (user_id, product_id), stats in per_user.items()],
+        update_conflicts=True,
+        unique_fields=['user', 'product'],
+        update_fields=['views', 'last_viewed', 'last_seen', 'max_rating'],
+        batch_size=1000,
+    )
+
+
+def prune_views(retention_days=None, batch_size: int = 5000):
+    """
+    Deletes raw VIEW rows older than ``retention_days`` (default
+    INTERACTION_VIEW_RETENTION_DAYS) that have been rolled up, ``batch_size``
+    rows per statement so no delete holds the write lock for long.
+
+    Returns:
+        The number of rows deleted.
+    """
+    if retention_days is None:
+        retention_days = settings.INTERACTION_VIEW_RETENTION_DAYS
+    rolled_up_to = RollupCheckpoint.objects.filter(name=INTERACTIONS_ROLLUP).values_list('rolled_up_to', flat=True).first()
+    if rolled_up_to is None:
+        return 0
+    cutoff = min(timezone.now() - timedelta(days=retention_days), rolled_up_to)
+
+    stale = Interaction.objects.filter(action=Interaction.Action.VIEW, created_at__lte=cutoff).order_by()
+    table = connection.ops.quote_name(Interaction._meta.db_table)
+    deleted = 0
+    while ids := list(stale.values_list('id', flat=True)[:batch_size]):
+        # A plain DELETE, without post_delete signals (which .delete() would load
+        # every row to send): the views live on in UserProductStats, so nobody's
+        # recommendations change.
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+        deleted += len(ids)
+    return deleted
+
+
+def user_views(user_id: int):
+    """
+    Returns ``{product_id: last_viewed}`` for one user's rolled-up views;
+    callers merge in the raw VIEW rows, keeping the latest view per product.
+    """
+    return dict(
+        UserProductStats.objects.filter(user_id=user_id, last_viewed__isnull=False)
+        .values_list('product_id', 'last_viewed')
+    )
+
+
+def view_triples(chunk_size: int = 20000):
+    """
+    Returns every ``(product_id, user_id, rating)`` VIEW pair as an int64
+    array: the raw rows not yet pruned plus the rolled-up ones (which carry
+    no rating), each pair once.
+    """
+    raw = _triples(
+        Interaction.objects.filter(action=Interaction.Action.VIEW)
+        .order_by().values_list('product_id', 'user_id', 'rating'),
+        chunk_size,
+    )
+    if checkpoint() == EPOCH:
+        return raw
+    rolled = _triples(
+        UserProductStats.objects.filter(last_viewed__isnull=False)
+        .order_by().values_list('product_id', 'user_id', 'max_rating'),
+        chunk_size,
+    )
+    rolled[:, 2] = 0
+    triples = np.concatenate([raw, rolled])
+    # A pair both rolled up and still raw counts once, at its best rating.
+    triples = triples[np.lexsort((-triples[:, 2], triples[:, 1], triples[:, 0]))]
+    first = np.ones(len(triples), dtype=bool)
+    first[1:] = (triples[1:, :2] != triples[:-1, :2]).any(axis=1)
+    return triples[first]
+
+
+def _triples(rows, chunk_size):
+    return np.fromiter(chain.from_iterable(rows.iterator(chunk_size=chunk_size)), dtype=np.int64).reshape(-1, 3)
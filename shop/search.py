@@ -0,0 +1,645 @@
+import json
+import logging
+import math
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from .models import Product
+from .recommender.index import FileLock, current_version, publish_index, read_state, state_revision, write_state
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+# Term weight of one occurrence in each field; a name match counts for more than a description match.
+FIELD_WEIGHTS = {'name': 3.0, 'category': 2.0, 'tags': 2.0, 'description': 1.0}
+# Filter terms (exact category / tag name) share the vocabulary but never match a
+# query token: tokens are [a-z0-9]+, and these sort before all of them.
+CATEGORY_FILTER = '\x01category:'
+TAG_FILTER = '\x01tag:'
+BM25_K1 = 1.2
+BM25_B = 0.75
+# The last query token matches as a prefix once it is this long, expanding to at most
+# MAX_PREFIX_EXPANSIONS (the most common) terms; a single letter would match nearly everything.
+MIN_PREFIX_LENGTH = 2
+MAX_PREFIX_EXPANSIONS = 50
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def document_terms(name, category, description, tag_names):
+    """
+    Returns ``(weights, filters)`` for one product: the weighted frequency of
+    every token across its fields, and its exact category/tag filter terms
+    (mapped to their display labels).
+    """
+    weights = {}
+    for field, text in (('name', name), ('category', category), ('description', description),
+                        ('tags', ' '.join(tag_names))):
+        for token in tokenize(text):
+            weights[token] = weights.get(token, 0.0) + FIELD_WEIGHTS[field]
+    filters = {CATEGORY_FILTER + (category or '').strip().lower(): (category or '').strip()}
+    filters.update((TAG_FILTER + tag_name.strip().lower(), tag_name.strip()) for tag_name in tag_names)
+    return weights, filters
+
+
+class PackedStrings:
+    """
+    A list of strings packed CSR-style: string ``i`` is the UTF-8 bytes
+    ``data[indptr[i]:indptr[i + 1]]``. Unlike a fixed-width numpy string array,
+    where every entry is as wide as the longest, each string costs only its
+    own length. Sorted lists are searched with ``search``.
+    """
+
+    def __init__(self, data, indptr):
+        self.data = data
+        self.indptr = indptr
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode() for string in strings]
+        indptr = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=indptr[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8).copy(), indptr)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.indptr[i]:self.indptr[i + 1]].tobytes().decode()
+
+    def tolist(self):
+        return [self[i] for i in range(len(self))]
+
+    def search(self, value, lo=0, hi=None):
+        """Like ``np.searchsorted(strings[lo:hi], value) + lo`` (side 'left'), on a sorted list."""
+        return bisect_left(self, value, lo, len(self) if hi is None else hi)
+
+
+class SearchIndex:
+    """
+    A tokenized inverted index over product names, descriptions, categories and tags.
+
+    Like ``ProductTagIndex`` it is a set of flat arrays: ``product_ids`` (sorted)
+    numbers the documents, ``vocabulary`` holds every term in sorted order, and
+    term ``t``'s postings are the document rows ``rows[indptr[t]:indptr[t + 1]]``
+    (sorted) with their field-weighted term frequencies in ``weights``.
+    Sorted postings make AND queries a chain of binary-search intersections,
+    and a sorted vocabulary turns a prefix into a contiguous range of terms.
+    Exact category and tag filters are stored as extra terms with weight 0.
+    The vocabulary and labels are ``PackedStrings``.
+
+    The filter terms sort first in the vocabulary, so they are terms
+    ``0..n_filter_terms - 1``. For facet counts (see ``shop.facets``) they
+    also have display labels in ``filter_labels``, and a forward index from
+    document row ``r`` to its filter terms,
+    ``filter_terms[filter_indptr[r]:filter_indptr[r + 1]]``.
+    """
+
+    ARRAYS = ('product_ids', 'doc_lengths', 'indptr', 'rows', 'weights', 'filter_indptr', 'filter_terms')
+    STRINGS = ('vocabulary', 'filter_labels')
+
+    def __init__(self, product_ids, doc_lengths, vocabulary, indptr, rows, weights,
+                 filter_labels, filter_indptr, filter_terms):
+        self.product_ids = product_ids
+        self.doc_lengths = doc_lengths
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.rows = rows
+        self.weights = weights
+        self.filter_labels = filter_labels
+        self.filter_indptr = filter_indptr
+        self.filter_terms = filter_terms
+        self._init_stats()
+
+    def _init_stats(self):
+        self.avg_doc_length = float(np.mean(self.doc_lengths)) if len(self.doc_lengths) else 1.0
+        document_frequencies = np.diff(self.indptr).astype(np.float64)
+        self.idf = np.log1p((len(self.product_ids) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        # The BM25 length normalization of every document, so queries only look it up.
+        self.length_norms = (
+            BM25_K1 * (1 - BM25_B + BM25_B * np.asarray(self.doc_lengths) / self.avg_doc_length)
+        ).astype(np.float32)
+
+    @classmethod
+    def from_documents(cls, documents):
+        """
+        Builds the index from ``(product_id, name, category, description, tag_names)``
+        tuples, which must come in ascending product ID order.
+        """
+        term_ids, labels = {}, {}
+        product_ids, doc_lengths = array('q'), array('f')
+        # Compact typed buffers: a million products make tens of millions of entries.
+        entry_rows, entry_terms, entry_weights = array('i'), array('q'), array('f')
+        filter_counts, filter_entries = array('q'), array('q')
+        for row, (product_id, name, category, description, tag_names) in enumerate(documents):
+            weights, filters = document_terms(name, category, description, tag_names)
+            product_ids.append(product_id)
+            doc_lengths.append(sum(weights.values()))
+            for term, weight in weights.items():
+                entry_rows.append(row)
+                entry_terms.append(term_ids.setdefault(term, len(term_ids)))
+                entry_weights.append(weight)
+            filter_counts.append(len(filters))
+            for term, label in filters.items():
+                labels.setdefault(term, label)
+                entry_rows.append(row)
+                entry_terms.append(term_ids.setdefault(term, len(term_ids)))
+                entry_weights.append(0.0)
+                filter_entries.append(entry_terms[-1])
+
+        # Renumber terms in sorted order, then group the entries by term (rows stay sorted).
+        vocabulary = sorted(term_ids)
+        rank = np.empty(len(term_ids), dtype=np.int64)
+        rank[[term_ids[term] for term in vocabulary]] = np.arange(len(term_ids))
+        terms = rank[np.frombuffer(entry_terms, dtype=np.int64)]
+        rows = np.frombuffer(entry_rows, dtype=np.int32)
+        order = np.lexsort((rows, terms))
+
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocabulary)), out=indptr[1:])
+        filter_indptr = np.zeros(len(product_ids) + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(filter_counts, dtype=np.int64), out=filter_indptr[1:])
+        n_filter_terms = len(labels)
+        return cls(
+            np.frombuffer(product_ids, dtype=np.int64).copy(),
+            np.frombuffer(doc_lengths, dtype=np.float32).copy(),
+            PackedStrings.from_strings(vocabulary),
+            indptr,
+            rows[order],
+            np.frombuffer(entry_weights, dtype=np.float32)[order],
+            PackedStrings.from_strings(labels[term] for term in vocabulary[:n_filter_terms]),
+            filter_indptr,
+            rank[np.frombuffer(filter_entries, dtype=np.int64)].astype(np.int32),
+        )
+
+    @classmethod
+    def from_db(cls, chunk_size: int = 20000):
+        """Builds the index by streaming products and their tag names, both in product ID order."""
+        products = Product.objects.order_by('id').values_list('id', 'name', 'category', 'description')
+        tag_links = (
+            Product.tags.through.objects.order_by('product_id')
+            .values_list('product_id', 'tag__name')
+            .iterator(chunk_size=chunk_size)
+        )
+        tags_by_product = groupby(tag_links, key=lambda link: link[0])
+        pending = next(tags_by_product, None)
+
+        def documents():
+            nonlocal pending
+            for product_id, name, category, description in products.iterator(chunk_size=chunk_size):
+                # Merge-join the two ordered streams.
+                while pending is not None and pending[0] < product_id:
+                    pending = next(tags_by_product, None)
+                tag_names = []
+                if pending is not None and pending[0] == product_id:
+                    tag_names = [tag_name for _, tag_name in pending[1]]
+                    pending = next(tags_by_product, None)
+                yield product_id, name, category, description, tag_names
+
+        return cls.from_documents(documents())
+
+    def save(self, directory) -> None:
+        """Writes every array to ``<directory>/<name>.npy`` plus a ``meta.json``."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(directory / f'{name}.npy', getattr(self, name))
+        for name in self.STRINGS:
+            np.save(directory / f'{name}_data.npy', getattr(self, name).data)
+            np.save(directory / f'{name}_indptr.npy', getattr(self, name).indptr)
+        (directory / 'meta.json').write_text(json.dumps({'class': type(self).__name__, 'built_at': time.time()}))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Opens an index written by ``save``, memory-mapped read-only by default."""
+        directory = Path(directory)
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, np.load(directory / f'{name}.npy', mmap_mode=mmap_mode))
+        for name in cls.STRINGS:
+            setattr(index, name, PackedStrings(
+                np.load(directory / f'{name}_data.npy', mmap_mode=mmap_mode),
+                np.load(directory / f'{name}_indptr.npy', mmap_mode=mmap_mode),
+            ))
+        index._init_stats()
+        return index
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def term(self, term):
+        """Returns the ID of ``term``, or None if no document contains it."""
+        idx = self.vocabulary.search(term)
+        if idx < len(self.vocabulary) and self.vocabulary[idx] == term:
+            return idx
+        return None
+
+    def prefix_terms(self, prefix, limit=MAX_PREFIX_EXPANSIONS):
+        """Returns the IDs of (at most ``limit`` of the most common) terms starting with ``prefix``."""
+        lo = self.vocabulary.search(prefix)
+        hi = self.vocabulary.search(prefix + '\uffff', lo)
+        terms = np.arange(lo, hi)
+        if len(terms) > limit:
+            terms = terms[np.argpartition(-np.diff(self.indptr)[lo:hi], limit - 1)[:limit]]
+        return terms.tolist()
+
+    def postings(self, term_id):
+        return self.rows[self.indptr[term_id]:self.indptr[term_id + 1]]
+
+    def query(self, tokens, filters=(), exclude_ids=(), limit=20):
+        """
+        Runs a parsed query (see ``parse_query``): each token matches its own
+        term, and the last token also every term it is a prefix of.
+        """
+        term_groups = []
+        for position, token in enumerate(tokens):
+            term_ids = self.prefix_terms(token) if _is_prefix(tokens, position) else []
+            exact = self.term(token)
+            if exact is not None and exact not in term_ids:
+                term_ids.append(exact)
+            term_groups.append(term_ids)
+        filter_terms = [self.term(term) for term in filters]
+        if None in filter_terms:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+        return self.search(term_groups, filter_terms, exclude_ids=exclude_ids, limit=limit)
+
+    def search(self, term_groups, filter_terms=(), exclude_ids=(), limit=20):
+        """
+        Ranks the documents matching every group of ``term_groups`` (a group
+        matches if any of its term IDs does; an empty group matches nothing)
+        and every filter term, by BM25 over the matched terms.
+
+        Groups are matched smallest first: the first one yields the candidate
+        rows and their scores, and each later one either binary-searches its
+        postings for the surviving candidates or, when that would cost more,
+        walks its postings once; either way adding its scores as it goes.
+
+        Returns:
+            A ``(product_ids, scores)`` pair, best first.
+        """
+        groups = [(group, True) for group in term_groups] + [([term_id], False) for term_id in filter_terms]
+        if not groups or any(not group for group, _ in groups):
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+        groups.sort(key=lambda item: self._postings_size(item[0]))
+
+        candidates, scores = self._match_group(*groups[0])
+        for group, scored in groups[1:]:
+            if not len(candidates):
+                break
+            if len(group) * len(candidates) > self._postings_size(group):
+                # Cheaper to walk the group's postings once than to search them per candidate.
+                matched, group_scores = self._accumulate(group, scored)
+                matched = matched[candidates]
+                if group_scores is not None:
+                    scores = scores + group_scores[candidates]
+                candidates, scores = candidates[matched], scores[matched]
+                continue
+            matched = np.zeros(len(candidates), dtype=bool)
+            group_scores = np.zeros(len(candidates), dtype=np.float64)
+            for term_id in group:
+                rows = self.postings(term_id)
+                if not len(rows):
+                    continue
+                positions = np.minimum(np.searchsorted(rows, candidates), len(rows) - 1)
+                hit = rows[positions] == candidates
+                matched |= hit
+                if scored:
+                    group_scores[hit] += self._term_scores(term_id, self.indptr[term_id] + positions[hit], candidates[hit])
+            candidates, scores = candidates[matched], scores[matched] + group_scores[matched]
+
+        if len(exclude_ids) and len(candidates):
+            keep = ~np.isin(self.product_ids[candidates], exclude_ids)
+            candidates, scores = candidates[keep], scores[keep]
+        if len(candidates) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(candidates))
+        # Ties (e.g. filter-only browsing) fall back to product ID order.
+        top = top[np.lexsort((candidates[top], -scores[top]))]
+        return self.product_ids[candidates[top]], scores[top]
+
+    def _match_group(self, group, scored):
+        """Returns the sorted rows matching any term of ``group``, with their summed BM25 scores."""
+        if len(group) == 1:
+            start, end = self.indptr[group[0]], self.indptr[group[0] + 1]
+            rows = np.asarray(self.rows[start:end])
+            scores = self._term_scores(group[0], slice(start, end), rows) if scored else np.zeros(len(rows))
+            return rows, scores
+        # A prefix expansion: accumulate the union in per-document arrays rather than sorting it.
+        matched, scores = self._accumulate(group, scored)
+        rows = np.flatnonzero(matched)
+        return rows, (scores[rows] if scores is not None else np.zeros(len(rows)))
+
+    def _accumulate(self, group, scored):
+        """Per-document arrays of whether any term of ``group`` matches, and the summed scores (or None)."""
+        group = np.asarray(group)
+        rows = np.concatenate([self.postings(term_id) for term_id in group])
+        if not scored:
+            matched = np.zeros(len(self.product_ids), dtype=bool)
+            matched[rows] = True
+            return matched, None
+        tf = np.concatenate([self.weights[self.indptr[term_id]:self.indptr[term_id + 1]] for term_id in group])
+        idf = np.repeat(self.idf[group], self.indptr[group + 1] - self.indptr[group])
+        # One pass over all the group's postings; every matched term adds a positive score.
+        scores = np.bincount(rows, weights=idf * tf * (BM25_K1 + 1) / (tf + self.length_norms[rows]),
+                             minlength=len(self.product_ids))
+        return scores > 0, scores
+
+    def _postings_size(self, group):
+        return sum(int(self.indptr[term_id + 1] - self.indptr[term_id]) for term_id in group)
+
+    def _term_scores(self, term_id, entries, rows):
+        """BM25 contribution of one term to ``rows``, whose term frequencies are ``weights[entries]``."""
+        tf = self.weights[entries]
+        return self.idf[term_id] * tf * (BM25_K1 + 1) / (tf + self.length_norms[rows])
+
+    def bm25(self, weights, terms, doc_length):
+        """Scores a document outside the index (see ``search``) against the index's statistics."""
+        score = 0.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_length / self.avg_doc_length)
+        for term in terms:
+            tf = weights.get(term, 0.0)
+            term_id = self.term(term)
+            df = 0 if term_id is None else self.indptr[term_id + 1] - self.indptr[term_id]
+            idf = math.log1p((len(self) - df + 0.5) / (df + 0.5))
+            score += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return score
+
+
+def _is_prefix(tokens, position):
+    return position == len(tokens) - 1 and len(tokens[position]) >= MIN_PREFIX_LENGTH
+
+
+# --- Published index and incremental updates ---
+#
+# The index is published like the product-tag index (versioned directories
+# under SEARCH_INDEX_DIR, memory-mapped by every worker). Product changes
+# between rebuilds go to a small delta, pickled next to CURRENT rather than
+# kept in the cache, which may cull it: each changed product's new terms (or
+# None once deleted). Writers serialize on a file lock and replace the file,
+# which gives it a new revision, so each worker re-reads the delta (and
+# re-indexes it for queries) only after it changed. Queries skip
+# those products in the index and match them against the delta; once it
+# outgrows SEARCH_INDEX_DELTA_LIMIT, or has held changes for longer than
+# SEARCH_INDEX_REFRESH_AFTER, one worker rebuilds the index in the background.
+
+DELTA_FILENAME = 'delta.v2.pickle'
+SEARCH_INDEX_REFRESH_AFTER = 2700  # Fold a non-empty delta in after 45 minutes
+REBUILD_LOCK_FILENAME = 'rebuild.lock'
+DELTA_LOCK_FILENAME = 'delta.lock'
+
+_opened = (None, None)  # (version, index) opened by this process
+_open_lock = threading.Lock()
+
+
+def search_index_root():
+    return Path(settings.SEARCH_INDEX_DIR)
+
+
+def get_search_index():
+    """Returns this process's mapping of the current index, building the first one if none is published."""
+    global _opened
+    version = current_version(search_index_root())
+    if version is None or version != _opened[0]:
+        with _open_lock:
+            version = current_version(search_index_root())
+            if version is None:
+                version = _build_on_miss()
+            if version != _opened[0]:
+                try:
+                    index = SearchIndex.load(search_index_root() / version)
+                except FileNotFoundError:
+                    # Published by an older release with other arrays.
+                    version = _build_on_miss(unusable=version)
+                    index = SearchIndex.load(search_index_root() / version)
+                _opened = (version, index)
+    return _opened[1]
+
+
+def _rebuild_lease():
+    """The rebuild lease: a file lock next to ``CURRENT``, so it is shared by every worker on the host."""
+    return FileLock(search_index_root() / REBUILD_LOCK_FILENAME)
+
+
+def _build_on_miss(unusable=None):
+    """
+    Cold start: one worker builds while the others wait on its lease, then
+    open the version it published (any but ``unusable``). A builder that dies
+    drops the lease with it, and the next waiter in line builds instead.
+    """
+    with _rebuild_lease():
+        version = current_version(search_index_root())
+        if version is None or version == unusable:
+            version = rebuild_search_index()
+        return version
+
+
+class SearchDelta:
+    """
+    One revision of the delta: ``entries`` maps every changed product to its
+    ``(weights, filters, doc_length)`` (or None once deleted), and ``postings``
+    maps every term of theirs to the products containing it, so queries look
+    terms up rather than checking every entry. ``terms`` sorts those terms,
+    for prefix matches.
+    """
+
+    def __init__(self, revision, entries):
+        self.revision = revision
+        self.entries = entries
+        self.product_ids = np.fromiter(entries, dtype=np.int64, count=len(entries))
+        self.postings = {}
+        for product_id, entry in entries.items():
+            if entry is not None:
+                for term in (*entry[0], *entry[1]):
+                    self.postings.setdefault(term, set()).add(product_id)
+        self.terms = sorted(self.postings)
+
+    def prefix_terms(self, prefix):
+        lo = bisect_left(self.terms, prefix)
+        return self.terms[lo:bisect_left(self.terms, prefix + '\uffff', lo)]
+
+    def query(self, tokens, filters=()):
+        """
+        Matches a parsed query against the changed products, by the rules of
+        ``SearchIndex.query`` (but with no limit on prefix expansions). Returns
+        ``{product_id: matched_terms}``, the terms to score each product by;
+        with no tokens and no filters every live product matches.
+        """
+        term_groups = [
+            self.prefix_terms(token) if _is_prefix(tokens, position) else [token]
+            for position, token in enumerate(tokens)
+        ]
+        groups = [
+            set().union(*(self.postings.get(term, ()) for term in group))
+            for group in [[term] for term in filters] + term_groups
+        ]
+        if groups:
+            matches = set.intersection(*sorted(groups, key=len))
+        else:
+            matches = {product_id for product_id, entry in self.entries.items() if entry is not None}
+        return {
+            product_id: [term for group in term_groups for term in group if term in self.entries[product_id][0]]
+            for product_id in matches
+        }
+
+
+_delta = SearchDelta(None, {})  # This process's copy of the latest delta it read
+
+
+def get_delta():
+    """
+    Returns the current ``SearchDelta``. Every call stats the delta file for
+    its revision, and reads the delta itself only once that changed.
+
+    Also starts a background rebuild once the published index is older than
+    SEARCH_INDEX_REFRESH_AFTER and the delta holds changes, so edits too few to
+    fill the delta are folded in all the same.
+    """
+    global _delta
+    if state_revision(_delta_path()) != _delta.revision:
+        revision, delta = read_state(_delta_path())
+        _delta = SearchDelta(revision, (delta or _empty_delta())['entries'])
+    version = _opened[0]
+    if _delta.entries and version is not None and time.time_ns() - int(version) > SEARCH_INDEX_REFRESH_AFTER * 10**9:
+        _start_background_rebuild()
+    return _delta
+
+
+def _delta_lock():
+    return FileLock(search_index_root() / DELTA_LOCK_FILENAME)
+
+
+def _delta_path():
+    return search_index_root() / DELTA_FILENAME
+
+
+def _empty_delta():
+    return {'stamps': {}, 'entries': {}}
+
+
+def _read_delta():
+    return read_state(_delta_path())[1] or _empty_delta()
+
+
+def _write_delta(delta):
+    """Saves the delta under a new revision; the caller holds the delta lock."""
+    write_state(_delta_path(), delta)
+
+
+def rebuild_search_index():
+    """
+    Builds and publishes a new index version, then drops the delta entries it
+    has absorbed: those unchanged since the build started.
+    """
+    stamps_before = dict(_read_delta()['stamps'])
+    version = publish_index(SearchIndex.from_db(), search_index_root())
+    with _delta_lock():
+        delta = _read_delta()
+        for product_id, stamp in stamps_before.items():
+            if delta['stamps'].get(product_id) == stamp:
+                del delta['stamps'][product_id]
+                del delta['entries'][product_id]
+        _write_delta(delta)
+    return version
+
+
+def _update_delta(product_id, read_entry):
+    """
+    Records a product's current terms, as returned by ``read_entry()``, in the
+    delta. The product is read under the delta lock, so concurrent edits never
+    drop each other nor leave an older read last.
+    """
+    with _delta_lock():
+        delta = _read_delta()
+        delta['stamps'][product_id] = time.time_ns()
+        delta['entries'][product_id] = read_entry()
+        _write_delta(delta)
+    if len(delta['entries']) > settings.SEARCH_INDEX_DELTA_LIMIT:
+        _start_background_rebuild()
+
+
+def _read_product(product_id):
+    row = Product.objects.filter(id=product_id).values_list('name', 'category', 'description').first()
+    if row is None:
+        return None
+    tag_names = list(Product.tags.through.objects.filter(product_id=product_id).values_list('tag__name', flat=True))
+    weights, filters = document_terms(*row, tag_names)
+    return weights, filters, sum(weights.values())
+
+
+def refresh_product(product_id: int):
+    """Re-reads one product into the delta, e.g. after it was saved or retagged."""
+    _update_delta(product_id, lambda: _read_product(product_id))
+
+
+def remove_product(product_id: int):
+    _update_delta(product_id, lambda: None)
+
+
+def _start_background_rebuild():
+    lease = _rebuild_lease()
+    if not lease.acquire(blocking=False):
+        return  # Another worker is already rebuilding.
+
+    def run():
+        try:
+            rebuild_search_index()
+        except Exception:
+            logger.exception("Background rebuild of the search index failed.")
+        finally:
+            lease.release()
+            connection.close()
+
+    threading.Thread(target=run, name='search-index-rebuild', daemon=True).start()
+
+
+def invalidate_search_index():
+    """Schedules a rebuild, for changes the delta cannot describe (e.g. a deleted tag)."""
+    _start_background_rebuild()
+
+
+def parse_query(query: str, category: str = '', tag: str = ''):
+    """Splits a search into its query tokens and exact filter terms."""
+    filters = []
+    if category:
+        filters.append(CATEGORY_FILTER + category.strip().lower())
+    if tag:
+        filters.append(TAG_FILTER + tag.strip().lower())
+    return tokenize(query), filters
+
+
+def search_products(query: str, category: str = '', tag: str = '', limit: int = 20):
+    """
+    Searches products, returning up to ``limit`` product IDs, best first.
+
+    Every query token must match (AND); the last one also matches as a prefix
+    (of at least MIN_PREFIX_LENGTH characters), for search-as-you-type. ``category`` and ``tag`` restrict the results to an
+    exact category or tag name. With only filters, matches come in ID order.
+    """
+    tokens, filters = parse_query(query, category, tag)
+    if not tokens and not filters:
+        return []
+
+    index = get_search_index()
+    delta = get_delta()
+    ids, scores = index.query(tokens, filters, exclude_ids=delta.product_ids, limit=limit)
+    results = list(zip(ids.tolist(), scores.tolist()))
+
+    # Products changed since the index was built are matched in the delta, against the same rules.
+    for product_id, matched_terms in delta.query(tokens, filters).items():
+        weights, _, doc_length = delta.entries[product_id]
+        results.append((product_id, index.bm25(weights, matched_terms, doc_length)))
+
+    results.sort(key=lambda result: (-result[1], result[0]))
+    return [product_id for product_id, _ in results[:limit]]
@@ -1,7 +1,80 @@
 from decimal import Decimal
 from django.conf import settings
-from .models import Product
-import copy  # <-- 1. Import the copy module
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+from .models import Interaction, Product
+from .recommender import content, trending
+
+PRODUCT_SNAPSHOT_KEY = 'product_snapshot:{product_id}'
+PRODUCT_SNAPSHOT_TIMEOUT = 300  # Product saves invalidate sooner; this bounds drift from bulk updates
+
+
+class ProductSnapshot:
+    """
+    The few product fields the cart needs, cached so cart pages skip the database.
+    Exposes ``id``/``name``/``price``/``stock``/``category`` like a ``Product``.
+    """
+    __slots__ = ('id', 'name', 'price', 'stock', 'category', 'image_url')
+
+    def __init__(self, id, name, price, stock, category, image_url):
+        self.id = id
+        self.name = name
+        self.price = price
+        self.stock = stock
+        self.category = category
+        self.image_url = image_url
+
+    @classmethod
+    def from_product(cls, product):
+        return cls(product.id, product.name, product.price, product.stock, product.category,
+                   product.image.url if product.image else '')
+
+
+def product_snapshots(product_ids):
+    """
+    Returns ``{product_id: ProductSnapshot}`` for the given IDs, reading the
+    cache with one ``get_many`` and loading only the misses with one query.
+    Unknown (e.g. deleted) products are left out.
+    """
+    keys = {PRODUCT_SNAPSHOT_KEY.format(product_id=product_id): product_id for product_id in product_ids}
+    snapshots = {keys[key]: snapshot for key, snapshot in cache.get_many(keys).items()}
+
+    missing = [product_id for product_id in keys.values() if product_id not in snapshots]
+    if missing:
+        loaded = {
+            product.id: ProductSnapshot.from_product(product)
+            for product in Product.objects.only('id', 'name', 'price', 'stock', 'category', 'image').filter(id__in=missing)
+        }
+        cache.set_many(
+            {PRODUCT_SNAPSHOT_KEY.format(product_id=product_id): snapshot for product_id, snapshot in loaded.items()},
+            timeout=PRODUCT_SNAPSHOT_TIMEOUT,
+        )
+        snapshots.update(loaded)
+    return snapshots
+
+
+def product_snapshot(product_id):
+    """Returns one product's snapshot, or None if there is no such product."""
+    return product_snapshots([product_id]).get(product_id)
+
+
+def invalidate_product_snapshots(*product_ids):
+    """Drops cached snapshots, e.g. after a product's price or stock changed."""
+    cache.delete_many([PRODUCT_SNAPSHOT_KEY.format(product_id=product_id) for product_id in product_ids])
+
+
+class CartLine:
+    """One cart line as shown to templates; built from the session payload, never stored in it."""
+    __slots__ = ('product', 'quantity', 'price', 'total_price')
+
+    def __init__(self, product, quantity, price, total_price):
+        self.product = product
+        self.quantity = quantity
+        self.price = price
+        self.total_price = total_price
+
 
 def cart_context(request):
     """A context processor to make the cart available on all pages."""
@@ -11,69 +84,225 @@ def cart_context(request):
 class Cart:
     """
     A session-based shopping cart service.
+
+    The session payload keeps each line's quantity, unit price and line total,
+    plus running totals for the whole cart:
+
+        {'lines': {'<product_id>': {'quantity': 2, 'price': '9.50', 'total_price': '19.00'}},
+         'total_items': 2, 'total_price': '19.00'}
+
+    Totals are adjusted by the difference on every ``add``/``remove``, so
+    reading them (as ``base.html`` does on every page) costs no summing and no
+    ``Decimal`` conversions beyond one.
+
+    Iterating yields ``CartLine`` objects whose ``product`` is a cached
+    ``ProductSnapshot``. They are built once per ``Cart`` and rebuilt only
+    after a change, so iterating again in the same request costs nothing.
+    Building them re-prices lines whose catalog price has changed since they
+    were added and drops lines for deleted products, keeping the totals in step.
     """
+
     def __init__(self, request):
         """Initialize the cart."""
         self.session = request.session
         cart = self.session.get(settings.CART_SESSION_ID)
         if not cart:
-            cart = self.session[settings.CART_SESSION_ID] = {}
+            cart = self.session[settings.CART_SESSION_ID] = self._empty()
+        elif 'lines' not in cart:
+            # A session saved before totals were kept: {product_id: {'quantity', 'price'}}.
+            cart = self.session[settings.CART_SESSION_ID] = self._upgrade(cart)
         self.cart = cart
+        self._lines = None
+
+    @staticmethod
+    def _empty():
+        return {'lines': {}, 'total_items': 0, 'total_price': '0'}
+
+    @classmethod
+    def _upgrade(cls, lines):
+        cart = cls._empty()
+        total_price = Decimal(0)
+        for product_id, line in lines.items():
+            line_total = Decimal(line['price']) * line['quantity']
+            cart['lines'][product_id] = {**line, 'total_price': str(line_total)}
+            cart['total_items'] += line['quantity']
+            total_price += line_total
+        cart['total_price'] = str(total_price)
+        return cart
 
     def add(self, product, quantity=1, override_quantity=False):
-        """Add a product to the cart or update its quantity."""
+        """Add a product to the cart or update its quantity; returns the updated line."""
         product_id = str(product.id)
-        if product_id not in self.cart:
-            self.cart[product_id] = {'quantity': 0, 'price': str(product.price)}
-        
-        if override_quantity:
-            self.cart[product_id]['quantity'] = quantity
-        else:
-            self.cart[product_id]['quantity'] += quantity
+        line = self.cart['lines'].get(product_id)
+        if line is None:
+            line = self.cart['lines'][product_id] = {'quantity': 0, 'price': str(product.price), 'total_price': '0'}
+        self._set_line_quantity(line, quantity if override_quantity else line['quantity'] + quantity)
         self.save()
+        return line
+
+    def set_quantity(self, product_id, quantity):
+        """
+        Sets the quantity of a line already in the cart, without loading its product.
+        Returns the updated line, or None if the product is not in the cart.
+        """
+        line = self.cart['lines'].get(str(product_id))
+        if line is not None:
+            self._set_line_quantity(line, quantity)
+            self.save()
+        return line
+
+    def _set_line_quantity(self, line, quantity):
+        """Updates one line and moves the running totals by the difference."""
+        line_total = Decimal(line['price']) * quantity
+        self.cart['total_items'] += quantity - line['quantity']
+        self.cart['total_price'] = str(Decimal(self.cart['total_price']) + line_total - Decimal(line['total_price']))
+        line['quantity'] = quantity
+        line['total_price'] = str(line_total)
 
     def save(self):
         """Mark the session as "modified" to make sure it gets saved."""
         self.session.modified = True
+        self._lines = None
 
-    def remove(self, product):
+    def remove(self, product_id):
         """Remove a product from the cart."""
-        product_id = str(product.id)
-        if product_id in self.cart:
-            del self.cart[product_id]
+        if self._drop_line(str(product_id)):
             self.save()
 
+    def _drop_line(self, product_id):
+        line = self.cart['lines'].pop(product_id, None)
+        if line is None:
+            return False
+        self.cart['total_items'] -= line['quantity']
+        self.cart['total_price'] = str(Decimal(self.cart['total_price']) - Decimal(line['total_price']))
+        self.session.modified = True
+        return True
+
     def __iter__(self):
         """
-        Iterate over the items in the cart and get the products
-        from the database.
+        Iterate over the items in the cart, with their products read from the
+        cached snapshots (see ``product_snapshots``).
         """
-        product_ids = self.cart.keys()
-        products = Product.objects.filter(id__in=product_ids)
-        
-        # THE FIX: Use copy.deepcopy() to create a fully independent copy
-        # of the cart, preventing modification of the original session data.
-        cart = copy.deepcopy(self.cart)
-        
-        for product in products:
-            if str(product.id) in cart:
-                cart[str(product.id)]['product'] = product
-        
-        for item in cart.values():
-            item['price'] = Decimal(item['price'])
-            item['total_price'] = item['price'] * item['quantity']
-            yield item
+        if self._lines is None:
+            self._lines = self._build_lines()
+        return iter(self._lines)
+
+    def _build_lines(self):
+        lines = self.cart['lines']
+        products = product_snapshots([int(product_id) for product_id in lines])
+
+        cart_lines = []
+        for product_id, line in list(lines.items()):
+            product = products.get(int(product_id))
+            if product is None:
+                self._drop_line(product_id)  # Deleted since it was added
+                continue
+            if Decimal(line['price']) != product.price:
+                self._reprice_line(line, product.price)
+            cart_lines.append(
+                CartLine(product, line['quantity'], Decimal(line['price']), Decimal(line['total_price']))
+            )
+        return cart_lines
+
+    def _reprice_line(self, line, price):
+        line_total = price * line['quantity']
+        self.cart['total_price'] = str(Decimal(self.cart['total_price']) + line_total - Decimal(line['total_price']))
+        line['price'] = str(price)
+        line['total_price'] = str(line_total)
+        self.session.modified = True
+
+    def __len__(self):
+        """Return total number of items in the cart."""
+        return self.cart['total_items']
 
     def get_total_items(self):
         """Return total number of items in the cart."""
-        return sum(item['quantity'] for item in self.cart.values())
+        return self.cart['total_items']
 
     def get_total_price(self):
-        """Calculate the total cost of items in the cart."""
-        return sum(Decimal(item['price']) * item['quantity'] for item in self.cart.values())
+        """Return the total cost of items in the cart."""
+        return Decimal(self.cart['total_price'])
 
     def clear(self):
         """Remove cart from session."""
         if settings.CART_SESSION_ID in self.session:
             del self.session[settings.CART_SESSION_ID]
-            self.save()
\ No newline at end of file
+            self.save()
+        self.cart = self._empty()
+        self._lines = None
+
+
+class OutOfStockError(Exception):
+    """
+    Raised by ``place_order`` when a line asks for more than is in stock, or for
+    a product deleted since it was added; ``missing`` maps those products' IDs
+    to the names the cart knew them by.
+    """
+
+    def __init__(self, products, missing=None):
+        self.products = products
+        self.missing = missing or {}
+        problems = []
+        if products:
+            problems.append(f"Not enough stock for: {', '.join(product.name for product in products)}")
+        if self.missing:
+            problems.append("No longer available: " + ', '.join(
+                f"{name} (#{product_id})" for product_id, name in self.missing.items()
+            ))
+        # Restocked between the failed update and the re-read: nothing to name.
+        super().__init__('. '.join(problems) or "Stock changed during checkout, please try again")
+
+
+def place_order(user, cart):
+    """
+    Checks out ``cart`` for ``user`` in one transaction, with a constant
+    number of queries however many lines the cart has:
+
+    * one conditional ``UPDATE`` decrements every product's stock, matching a
+      row only while ``stock >= quantity``. If it matches fewer rows than
+      there are lines, someone else got there first and the whole order is
+      rolled back with ``OutOfStockError``, so stock never goes negative;
+    * one ``INSERT ... ON CONFLICT`` records (or refreshes) the purchase
+      interactions against the ``unique_user_product_action`` constraint.
+
+    Neither bulk statement sends model signals, so the affected product
+    snapshots and the user's recommendations are invalidated, and the
+    purchases added to the trending products, on commit.
+    """
+    quantities = {line.product.id: line.quantity for line in cart}
+    names = {line.product.id: line.product.name for line in cart}
+    if not quantities:
+        return
+
+    with transaction.atomic():
+        in_stock = Q()
+        for product_id, quantity in quantities.items():
+            in_stock |= Q(id=product_id, stock__gte=quantity)
+        updated = Product.objects.filter(in_stock).update(
+            stock=Case(*(When(id=product_id, then=F('stock') - quantity) for product_id, quantity in quantities.items()))
+        )
+        if updated != len(quantities):
+            # Undo the partial decrement; the shortfall is read once it is rolled back.
+            transaction.set_rollback(True)
+        else:
+            Interaction.objects.bulk_create(
+                [
+                    Interaction(user=user, product_id=product_id, action=Interaction.Action.PURCHASE, rating=5)
+                    for product_id in quantities
+                ],
+                update_conflicts=True,
+                unique_fields=['user', 'product', 'action'],
+                update_fields=['rating'],
+            )
+            transaction.on_commit(lambda: invalidate_product_snapshots(*quantities))
+            transaction.on_commit(lambda: content.invalidate_user_recommendations(user.pk))
+            purchased_at = timezone.now()
+            transaction.on_commit(lambda: trending.record(
+                (product_id, Interaction.Action.PURCHASE, purchased_at) for product_id in quantities
+            ))
+
+    if updated != len(quantities):
+        products = list(Product.objects.only('id', 'name', 'stock').filter(id__in=quantities))
+        found = {product.id for product in products}
+        missing = {product_id: names[product_id] for product_id in quantities if product_id not in found}
+        raise OutOfStockError([product for product in products if product.stock < quantities[product.id]], missing)
@@ -0,0 +1,89 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import search
+from .models import Interaction, Product, Tag
+from .recommender import content, trending
+from .services import invalidate_product_snapshots
+
+
+# Every index update and invalidation below runs through ``transaction.on_commit``:
+# inside an ``atomic()`` block it waits for the commit (and is dropped on
+# rollback), so the shared indexes never publish rows the database does not hold.
+# Values are bound before the callbacks are queued; a deleted instance's pk is
+# reset by the time they run.
+
+
+def _refresh_products(product_ids):
+    for product_id in product_ids:
+        content.refresh_product_tags(product_id)
+        search.refresh_product(product_id)
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def product_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Patches the cached product-tag and search indexes when a product's tags change."""
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            product_ids = [instance.pk]
+            transaction.on_commit(lambda: _refresh_products(product_ids))
+        return
+
+    # Changed from the tag side (``tag.products.add(...)``): pk_set holds product IDs.
+    if action == 'pre_clear':
+        instance._cleared_product_ids = list(instance.products.values_list('id', flat=True))
+    elif action in ('post_clear', 'post_add', 'post_remove'):
+        product_ids = getattr(instance, '_cleared_product_ids', []) if action == 'post_clear' else list(pk_set)
+        transaction.on_commit(lambda: _refresh_products(product_ids))
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, **kwargs):
+    """Gives a new product an (initially empty) row in the cached index."""
+    product_id = instance.pk
+    if created:
+        transaction.on_commit(lambda: content.refresh_product_tags(product_id))
+    else:
+        # Price or stock may have changed; carts re-read the snapshot.
+        transaction.on_commit(lambda: invalidate_product_snapshots(product_id))
+    # Name, category or description may have changed.
+    transaction.on_commit(lambda: search.refresh_product(product_id))
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(lambda: content.remove_product(product_id))
+    transaction.on_commit(lambda: search.remove_product(product_id))
+    transaction.on_commit(lambda: invalidate_product_snapshots(product_id))
+
+
+@receiver(post_delete, sender=Tag)
+def tag_deleted(sender, instance, **kwargs):
+    # Cascading deletes of through rows do not send m2m_changed, so rebuild.
+    transaction.on_commit(content.invalidate_product_tag_matrix)
+    transaction.on_commit(search.invalidate_search_index)
+
+
+@receiver(post_save, sender=Tag)
+def tag_saved(sender, instance, created, **kwargs):
+    # A renamed tag changes the terms of every product carrying it.
+    if not created:
+        transaction.on_commit(search.invalidate_search_index)
+
+
+@receiver(post_save, sender=Interaction)
+def interaction_saved(sender, instance, created, **kwargs):
+    # Updates (e.g. a repeat view bumping an existing row) don't change which
+    # products a user has interacted with, so only creations invalidate.
+    if created:
+        user_id, event = instance.user_id, (instance.product_id, instance.action, instance.created_at)
+        transaction.on_commit(lambda: content.invalidate_user_recommendations(user_id))
+        transaction.on_commit(lambda: trending.record([event]))
+
+
+@receiver(post_delete, sender=Interaction)
+def interaction_deleted(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: content.invalidate_user_recommendations(user_id))
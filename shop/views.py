@@ -1,35 +1,150 @@
+from urllib.parse import urlencode
+
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import Http404, JsonResponse, HttpResponseBadRequest
+from django.template.loader import render_to_string
 from django.views.decorators.http import require_POST
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
 
+from . import facets
 from .models import Product, Interaction
 from .forms import AddToCartForm, UpdateCartQuantityForm
-from .services import Cart
-from .recommender.content import similar_products, recommendations_for_user
+from .events import record_view
+from .search import search_products
+from .services import Cart, OutOfStockError, place_order, product_snapshot
+from .recommender.engines import similar_products, recommendations_for_user
+
+# Fields rendered by shop/partials/product_card.html
+PRODUCT_CARD_FIELDS = ('id', 'name', 'category', 'price')
+
+
+def _selected_filters(request):
+    """The ``category`` and ``tag`` (repeatable) facet filters of a product listing."""
+    category = request.GET.get('category', '').strip()
+    tags = sorted({tag.strip() for tag in request.GET.getlist('tag') if tag.strip()}, key=str.lower)
+    return category, tags
+
+
+def _filter_query(category, tags):
+    """The filter part of a listing URL's query string, with a trailing ``&`` when non-empty."""
+    params = {'category': category} if category else {}
+    if tags:
+        params['tag'] = tags
+    return urlencode(params, doseq=True) + '&' if params else ''
+
+
+def _product_page(request):
+    """
+    Returns one page of products after the ``after`` cursor (a product ID),
+    plus the cursor of the next page or None. Keyset pagination on the primary
+    key costs one index range scan per page, however deep the page is.
+
+    With facet filters, the page's IDs come from the facet engine instead,
+    which finds the cursor in its sorted rows by binary search.
+    """
+    try:
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        after = 0
+    page_size = settings.PRODUCTS_PAGE_SIZE
+    category, tags = _selected_filters(request)
+    if category or tags:
+        page_ids = facets.select(category, tags).page(after, page_size + 1).tolist()
+        # The cursor comes from the IDs, not the rows: products deleted since the
+        # index was built only shorten this page instead of ending the list.
+        next_cursor = page_ids[page_size - 1] if len(page_ids) > page_size else None
+        products = Product.objects.only(*PRODUCT_CARD_FIELDS).filter(id__in=page_ids[:page_size]).order_by('id')
+        return list(products), next_cursor
+    # One extra row tells whether there is a next page without a COUNT query.
+    products = list(Product.objects.only(*PRODUCT_CARD_FIELDS).filter(id__gt=after).order_by('id')[:page_size + 1])
+    next_cursor = products[page_size - 1].id if len(products) > page_size else None
+    return products[:page_size], next_cursor
+
+
+def _facet_links(category, tags):
+    """Facet counts for the sidebar, each with the URL that toggles it in the current selection."""
+    counts = facets.facet_counts(category, tags, limit=settings.PRODUCT_FACETS_LIMIT)
+    selected_tags = {tag.lower() for tag in tags}
+    links = {'category': [], 'tag': []}
+    for label, count in counts['category']:
+        selected = label.lower() == category.lower()
+        links['category'].append({
+            'label': label, 'count': count, 'selected': selected,
+            'url': '?' + _filter_query('' if selected else label, tags),
+        })
+    for label, count in counts['tag']:
+        selected = label.lower() in selected_tags
+        toggled = [tag for tag in tags if tag.lower() != label.lower()] if selected else [*tags, label]
+        links['tag'].append({
+            'label': label, 'count': count, 'selected': selected,
+            'url': '?' + _filter_query(category, toggled),
+        })
+    return links
+
 
-# ... (product_list, product_detail, etc. are unchanged) ...
 def product_list(request):
-    products = Product.objects.all().prefetch_related('tags')
+    products, next_cursor = _product_page(request)
+    category, tags = _selected_filters(request)
     user_recommendations = []
-    if request.user.is_authenticated:
-        user_recommendations = recommendations_for_user(request.user, k=4)
-    return render(request, 'shop/product_list.html', {'products': products, 'user_recommendations': user_recommendations})
+    # Recommendations are only shown above the first, unfiltered page.
+    if request.user.is_authenticated and 'after' not in request.GET and not (category or tags):
+        user_recommendations = recommendations_for_user(request.user, k=4).only(*PRODUCT_CARD_FIELDS)
+    return render(request, 'shop/product_list.html', {
+        'products': products,
+        'next_cursor': next_cursor,
+        'user_recommendations': user_recommendations,
+        'category': category,
+        'tags': tags,
+        'filter_query': _filter_query(category, tags),
+        'facets': _facet_links(category, tags),
+    })
+
+
+def product_list_page(request):
+    """Infinite-scroll endpoint: the next page's rendered cards and cursor as JSON."""
+    products, next_cursor = _product_page(request)
+    html = render_to_string('shop/partials/product_cards.html', {'products': products}, request=request)
+    return JsonResponse({'html': html, 'next_cursor': next_cursor})
+
+def search(request):
+    """Product search; ``q`` is matched against names, descriptions, categories and tags."""
+    query = request.GET.get('q', '').strip()
+    category = request.GET.get('category', '').strip()
+    tag = request.GET.get('tag', '').strip()
+    product_ids = search_products(query, category=category, tag=tag, limit=settings.SEARCH_RESULTS_LIMIT)
+    # in_bulk loses the ranking, so put the products back in result order.
+    found = Product.objects.only(*PRODUCT_CARD_FIELDS).in_bulk(product_ids)
+    products = [found[product_id] for product_id in product_ids if product_id in found]
+    return render(request, 'shop/search.html', {
+        'query': query,
+        'category': category,
+        'tag': tag,
+        'products': products,
+    })
 
 def product_detail(request, pk):
     product = get_object_or_404(Product, pk=pk)
     form = AddToCartForm()
     if request.user.is_authenticated:
-        Interaction.objects.update_or_create(user=request.user, product=product, action=Interaction.Action.VIEW)
-    similar_items = similar_products(product.id, k=4)
+        record_view(request.user.pk, product.pk)
+    similar_items = similar_products(product.id, k=4).only(*PRODUCT_CARD_FIELDS)
     return render(request, 'shop/product_detail.html', {'product': product, 'form': form, 'similar_items': similar_items})
 
+def _get_snapshot_or_404(product_id):
+    """The cart only needs a product's cached snapshot, not the full row."""
+    product = product_snapshot(product_id)
+    if product is None:
+        raise Http404("No Product matches the given query.")
+    return product
+
 @require_POST
 def add_to_cart(request, product_id):
     """Adds a product to the session-based cart."""
     cart = Cart(request)
-    product = get_object_or_404(Product, id=product_id)
+    product = _get_snapshot_or_404(product_id)
     form = AddToCartForm(request.POST)
 
     if form.is_valid():
@@ -47,8 +162,7 @@ def add_to_cart(request, product_id):
 
 def remove_from_cart(request, product_id):
     cart = Cart(request)
-    product = get_object_or_404(Product, id=product_id)
-    cart.remove(product)
+    cart.remove(product_id)
     return redirect('shop:cart_view')
 
 def cart_view(request):
@@ -59,27 +173,22 @@ def cart_view(request):
 def update_cart(request, product_id):
     """Updates the quantity of a product in the cart and returns JSON if AJAX."""
     cart = Cart(request)
-    product = get_object_or_404(Product, id=product_id)
     form = UpdateCartQuantityForm(request.POST)
 
     if form.is_valid():
         quantity = form.cleaned_data['quantity']
-        cart.add(product, quantity=quantity, override_quantity=True)
+        # Lines already in the cart carry their price, so no product lookup is needed.
+        line = cart.set_quantity(product_id, quantity)
+        if line is None:
+            line = cart.add(_get_snapshot_or_404(product_id), quantity=quantity, override_quantity=True)
 
         if request.headers.get('x-requested-with') == 'XMLHttpRequest':
-            # Use the iterable version to get total_price for this item
-            item_total_price = 0
-            for item in cart:
-                if item['product'].id == product.id:
-                    item_total_price = item['total_price']
-                    break
-
             # THE FIX: Convert Decimal values to float() before creating the JSON response.
             return JsonResponse({
                 'status': 'success',
                 'cart_total_price': float(cart.get_total_price()),
                 'cart_total_items': cart.get_total_items(),
-                'item_total_price': float(item_total_price),
+                'item_total_price': float(line['total_price']),
             })
 
     # Fallback for non-AJAX requests
@@ -91,10 +200,11 @@ def checkout(request):
     cart = Cart(request)
     if not cart: return redirect('shop:product_list')
     if request.method == 'POST':
-        user = request.user
-        for item in cart:
-            product = item['product']
-            Interaction.objects.update_or_create(user=user, product=product, action=Interaction.Action.PURCHASE, defaults={'rating': 5})
+        try:
+            place_order(request.user, cart)
+        except OutOfStockError as e:
+            messages.error(request, str(e))
+            return redirect('shop:cart_view')
         cart.clear()
         return render(request, 'shop/checkout.html')
     return redirect('shop:cart_view')